@@ -3,19 +3,380 @@
 Flask web application for the splitUp debt simplification tool
 """
 
-import csv
+import gzip
+import heapq
+import itertools
+import tempfile
+import threading
+import uuid
+import zlib
+from array import array
 from collections import namedtuple
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, make_response
-import io
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, make_response, Response, stream_with_context
 from werkzeug.utils import secure_filename
-from splitUp import readDataFromUpload, simplifyDebts2, PersonNode, splitUpGroups, Transaction
+from splitUp import readLedgerFromUpload, Ledger, LedgerSession, Transaction, centsToAmount, plainNumber
+from splitUp import SettlementCache, TransactionDigest, transactionDigest, RESULT_CACHE_BYTES, MAX_REPORTED_PARSE_ERRORS
+from splitUp import LedgerParseError, settleBalanceColumns, loadRateTable, convertCurrencies
+from splitUp import parseManualTransaction, manualCurrency, readLedgerFromNdjson, iterJsonArray, iterNdjson
+from splitUp import EXPORT_CHUNK_ROWS, gzipChunks, iterCsvChunks, iterSettlementNdjson, iterSettlementColumnar
+from instrumentation import StageTimer, MetricsRegistry
+from jobs import JobQueue, JobQueueFull, JOB_DONE, JOB_FAILED
+from ledgerStore import LedgerStore
+from resultStore import ResultStore, RESULT_STORE_BYTES
 
 def serializeNamedtupleList(namedtupleList):
     """Convert a list of named tuples to a list of dictionaries for JSON serialization"""
     return [item._asdict() if hasattr(item, '_asdict') else item for item in namedtupleList]
 
+# Everything the results page and its paged endpoints serve for one
+# settled ledger: the summary statistics, the interned names, the original
+# transactions as columns (see Ledger.getEdges), the per-pair totals for the
+# network view (see Ledger.getPairEdges), the required payments and each
+# person's balance
+SettledLedger = namedtuple('SettledLedger', ['summary', 'names', 'edges', 'pairEdges',
+                                             'transactions', 'peopleDetails', 'exact'])
+
+def summarizeSettlement(settlement, ledger, parseErrors=()):
+    """
+    Collects what the results page shows about a settled ledger
+
+    Extracts the required payments, each person's balance and the reduction
+    percentage. In exact mode amounts are integer minor units and are
+    converted back to currency amounts for display. The original
+    transactions stay in the ledger's columns and are only turned into
+    rows a page at a time (see resultRows).
+
+    @param settlement: tuple of columns (debtorIds, creditorIds, amounts)
+                       indexed by ledger id (see settleBalanceColumns)
+    @param ledger: Ledger the balances were settled from
+    @param parseErrors: list of LedgerParseError for rows that were skipped
+    @return: SettledLedger
+    """
+    exact = ledger.isExact()
+    toAmount = centsToAmount if exact else (lambda amount: amount)
+    transactionCount = ledger.getNumTransactions()
+    table = ledger.toBalanceTable()
+    names = table.names
+
+    # Extract transaction data for template, and everyone who takes part
+    # in a payment (creditors first, in order of appearance)
+    transactions = []
+    involved = {}
+    for debtorId, creditorId, amount in zip(*settlement):
+        transactions.append(Transaction(
+            debtor=names[debtorId],
+            creditor=names[creditorId],
+            amount=toAmount(plainNumber(amount))
+        ))
+        involved.setdefault(creditorId)
+        involved.setdefault(debtorId)
+    simplifiedTransactions = len(transactions)
+
+    # Calculate people details for display
+    peopleDetails = [{'name': names[personId],
+                      'total': toAmount(plainNumber(table.balances[personId]))}
+                     for personId in involved]
+
+    # Calculate reduction percentage
+    if transactionCount > 0:
+        reduction = round(((transactionCount - simplifiedTransactions) / transactionCount) * 100, 1)
+    else:
+        reduction = 0
+
+    summary = {
+        'original_transactions': transactionCount,
+        'simplified_transactions': simplifiedTransactions,
+        'reduction': reduction,
+        'people': len(ledger),
+        'skipped_rows': len(parseErrors),
+        'parse_errors': [str(error) for error in parseErrors[:MAX_REPORTED_PARSE_ERRORS]]
+    }
+    return SettledLedger(summary, ledger.getNames(), ledger.getEdges(),
+                         ledger.getPairEdges(), transactions, peopleDetails, exact)
+
+def streamedResponse(chunks, mimetype, compress=None):
+    """
+    Sends a generator of byte chunks as a chunked response
+
+    @param chunks: iterable of bytes
+    @param mimetype: str. Content type of the response
+    @param compress: bool or None. Gzip the stream (None = if the client
+                     accepts gzip)
+    @return: flask Response
+    """
+    if compress is None:
+        compress = request.accept_encodings['gzip'] > 0
+    response = Response(gzipChunks(chunks) if compress else chunks,
+                        mimetype=mimetype)
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 app = Flask(__name__)
 app.secret_key = 'splitup_secret_key_change_in_production'
+# Opt-in exact mode: amounts are settled as integer cents end to end
+app.config['EXACT_AMOUNTS'] = False
+
+# Strict parsing rejects an upload at its first malformed row; lenient
+# parsing skips malformed rows and lists them on the results page
+app.config['STRICT_PARSING'] = True
+
+# Path of a currency,rate csv (see splitUp.parseRateTable). When set,
+# uploaded rows may have a fourth currency column, and JSON transactions
+# a 'currency', converted to the base currency while they are parsed.
+# The file is re-read whenever it changes.
+app.config['CURRENCY_RATES'] = None
+
+def currencyRates():
+    """
+    Returns the RateTable of CURRENCY_RATES, or None if it isn't set
+    """
+    path = app.config['CURRENCY_RATES']
+    return None if path is None else loadRateTable(path)
+
+# Recently settled ledgers (SettledLedger), keyed by transactionDigest().
+# The key doubles as the result id the paged /results endpoints look up.
+app.config['RESULT_CACHE_BYTES'] = RESULT_CACHE_BYTES
+# The cache is created on first use, so the budget can be changed until then
+resultCache = None
+resultCacheLock = threading.Lock()
+
+def getResultCache():
+    """
+    Returns the app's SettlementCache, creating it from the config the first time
+    """
+    global resultCache
+    with resultCacheLock:
+        if resultCache is None:
+            resultCache = SettlementCache(app.config['RESULT_CACHE_BYTES'])
+        return resultCache
+
+# Every settled ledger is also spilled to RESULT_STORE_DIR, which the
+# results pages read back from whenever the cache has dropped a result or
+# never had room for it. The store is opened on first use. None means a
+# temporary directory of this process, removed when it exits; set a shared
+# directory when several worker processes serve the results pages.
+app.config['RESULT_STORE_DIR'] = None
+app.config['RESULT_STORE_BYTES'] = RESULT_STORE_BYTES
+resultStore = None
+resultStoreLock = threading.Lock()
+
+def getResultStore():
+    """
+    Returns the app's ResultStore, creating it from the config the first time
+    """
+    global resultStore
+    with resultStoreLock:
+        if resultStore is None:
+            resultStore = ResultStore(app.config['RESULT_STORE_DIR'],
+                                      app.config['RESULT_STORE_BYTES'])
+        return resultStore
+
+def saveResult(resultId, settled):
+    """
+    Keeps a settled ledger for its results page and caches it
+    """
+    getResultStore().put(resultId, settled)
+    getResultCache().put(resultId, settled)
+
+def loadResult(resultId):
+    """
+    Returns the SettledLedger of a result id, or None if it is unknown
+
+    Tries the result cache first and falls back to the result store.
+    """
+    settled = getResultCache().get(resultId)
+    if settled is None:
+        settled = getResultStore().get(resultId)
+        if settled is not None:
+            getResultCache().put(resultId, settled)
+    return settled
+
+# Per-stage timings of the /upload and /process_manual pipelines. Set
+# TRACK_ALLOCATIONS to also record allocation sizes (slows requests down).
+# It is applied before the first request, however the app is served.
+app.config['TRACK_ALLOCATIONS'] = False
+metrics = MetricsRegistry()
+instrumentationConfigured = False
+instrumentationLock = threading.Lock()
+
+def configureInstrumentation(config):
+    """
+    Applies the instrumentation settings of a config to the metrics registry
+
+    @param config: dict-like. The app's config
+    """
+    metrics.setTrackAllocations(config['TRACK_ALLOCATIONS'])
+
+@app.before_request
+def configureInstrumentationOnce():
+    """
+    Applies TRACK_ALLOCATIONS before the first request is handled
+    """
+    global instrumentationConfigured
+    if instrumentationConfigured:
+        return
+    with instrumentationLock:
+        if not instrumentationConfigured:
+            configureInstrumentation(app.config)
+            instrumentationConfigured = True
+
+def timedResponse(route, timer, html):
+    """
+    Records a finished request's stages and attaches a Server-Timing header
+    """
+    metrics.record(route, timer)
+    response = make_response(html)
+    response.headers['Server-Timing'] = timer.serverTimingHeader()
+    return response
+
+# Rows per page of the paged /results endpoints (and the most one request may ask for)
+RESULT_PAGE_ROWS = 200
+MAX_RESULT_PAGE_ROWS = 1000
+
+def renderResults(resultId, settled, timer):
+    """
+    Renders the results page, which only holds the summary statistics
+
+    The transaction lists and the network are fetched by results.js from
+    the paged /results/<resultId> endpoints, so the page has the same size
+    however big the ledger is.
+    """
+    with timer.stage('render', rows=settled.summary['simplified_transactions']):
+        return render_template('results.html', result_id=resultId,
+                               page_rows=RESULT_PAGE_ROWS, **settled.summary)
+
+def settleUpload(file, exact, strict, timer, progress=None, rates=None):
+    """
+    Runs an uploaded csv through the settlement pipeline, stage by stage
+
+    The upload is digested while it is parsed, so it is read once. If an
+    identical ledger was settled before, the cached result is returned
+    and the remaining stages are skipped; otherwise the new result is
+    cached under the digest.
+
+    @param file: binary file-like object holding the upload
+    @param exact: bool. Settle in integer minor units (EXACT_AMOUNTS)
+    @param strict: bool. Reject malformed rows (STRICT_PARSING)
+    @param timer: StageTimer recording the stages
+    @param progress: callable or None. Called as progress(stage, rows) when
+                     each stage starts and as rows are parsed
+    @param rates: RateTable or None. Exchange rates (CURRENCY_RATES)
+    @return: tuple (resultId, SettledLedger)
+    """
+    if progress is None:
+        progress = lambda stage, rows=None: None
+
+    # Decode, parse and digest the uploaded file (streamed, so all at once)
+    parseErrors = []
+    digest = TransactionDigest(exact)
+    progress('parse', 0)
+    with timer.stage('parse'):
+        ledger, _ = readLedgerFromUpload(
+            file, keepOriginal=False, exact=exact, strict=strict,
+            errors=parseErrors, progress=lambda rows: progress('parse', rows),
+            rates=rates, digest=digest)
+    transactionCount = ledger.getNumTransactions()
+    timer.setRows('parse', transactionCount)
+
+    # Identical uploads are served from the result cache. The skipped rows
+    # are part of the key, since the results page lists them.
+    digest.updateErrors(parseErrors)
+    resultId = digest.hexdigest()
+    settled = loadResult(resultId)
+    if settled is not None:
+        return resultId, settled
+
+    # Sum repeated payer/debtor pairs before building the graph
+    progress('aggregate')
+    with timer.stage('aggregate', rows=transactionCount):
+        ledger.getPairEdges()
+
+    progress('group')
+    with timer.stage('group', rows=len(ledger)):
+        table = ledger.toBalanceTable()
+
+    # Calculate simplified transactions (groups are independent)
+    progress('simplify')
+    with timer.stage('simplify', rows=len(table.names)):
+        settlement = settleBalanceColumns(table)
+
+    progress('extract')
+    with timer.stage('extract', rows=len(settlement[2])):
+        settled = summarizeSettlement(settlement, ledger, parseErrors)
+    saveResult(resultId, settled)
+    return resultId, settled
+
+def runUploadJob(progress, spooledFile, exact, strict, rates=None):
+    """
+    Settles a spooled upload on a job worker (see the /jobs routes)
+
+    The SettledLedger itself goes to the result cache and store (see
+    saveResult); the job keeps just its id.
+
+    @return: dict with the result id and stage timings
+    """
+    try:
+        timer = StageTimer()
+        resultId, _ = settleUpload(spooledFile, exact, strict, timer,
+                                   progress, rates)
+        metrics.record('upload_job', timer)
+        return {'result_id': resultId, 'stages': timer.getStages()}
+    finally:
+        spooledFile.close()
+
+# Large uploads settled in the background (see the /jobs routes). At most
+# MAX_CONCURRENT_JOBS run at once and MAX_PENDING_JOBS more may wait. The
+# queue is created on first use, so these can be changed until then.
+app.config['MAX_CONCURRENT_JOBS'] = 2
+app.config['MAX_PENDING_JOBS'] = 16
+app.config['FINISHED_JOBS_KEPT'] = 100
+# Uploads bigger than this are spooled to a temporary file, not memory
+UPLOAD_SPOOL_BYTES = 8 * 1024 * 1024
+jobQueue = None
+jobQueueLock = threading.Lock()
+
+def getJobQueue():
+    """
+    Returns the app's JobQueue, creating it from the config the first time
+    """
+    global jobQueue
+    with jobQueueLock:
+        if jobQueue is None:
+            jobQueue = JobQueue(app.config['MAX_CONCURRENT_JOBS'],
+                                app.config['MAX_PENDING_JOBS'],
+                                app.config['FINISHED_JOBS_KEPT'])
+        return jobQueue
+
+# Incremental ledger sessions by id (see the /session routes), each stored
+# as (LedgerSession, lock). ledgerSessionsLock only guards the dict; a
+# session is edited and settled under its own lock.
+ledgerSessions = {}
+ledgerSessionsLock = threading.Lock()
+
+def lookupSession(sessionId):
+    """
+    Returns the (LedgerSession, lock) of a session, or None if it is unknown
+    """
+    with ledgerSessionsLock:
+        return ledgerSessions.get(sessionId)
+
+# Persistent named ledgers (see the /ledgers routes), opened on first use
+app.config['LEDGER_DATABASE'] = 'ledgers.sqlite3'
+ledgerStore = None
+ledgerStoreLock = threading.Lock()
+
+def getLedgerStore():
+    """
+    Returns the app's LedgerStore, opening LEDGER_DATABASE the first time
+    """
+    global ledgerStore
+    with ledgerStoreLock:
+        if ledgerStore is None:
+            ledgerStore = LedgerStore(app.config['LEDGER_DATABASE'],
+                                      app.config['EXACT_AMOUNTS'])
+        return ledgerStore
 
 @app.route('/')
 def home():
@@ -52,51 +413,14 @@ def uploadFile():
 
     if file and file.filename.endswith('.csv'):
         try:
-            # Process the uploaded file
-            allGroups, originalTransactionsList = readDataFromUpload(file)
-            transactionCount = len(originalTransactionsList)
-
-            # Calculate simplified transactions
-            allPeople = []
-            for group in allGroups:
-                simplified_group = simplifyDebts2(list(group))
-                allPeople.extend(simplified_group)
-
-            # Extract transaction data for template
-            transactions = []
-            simplifiedTransactions = 0
-
-            for person in allPeople:
-                for creditor, amount in person.getOwersAndCreditors().items():
-                    if amount < 0:  # This person owes money
-                        transactions.append(Transaction(
-                            debtor=person.getName(),
-                            creditor=creditor.getName(),
-                            amount=abs(amount)
-                        ))
-                        simplifiedTransactions += 1
-
-            # Calculate people details for display
-            peopleDetails = []
-            for person in allPeople:
-                peopleDetails.append({
-                    'name': person.getName(),
-                    'total': person.getTotalMoney()
-                })
-
-            # Calculate reduction percentage
-            if transactionCount > 0:
-                reduction = round(((transactionCount - simplifiedTransactions) / transactionCount) * 100, 1)
-            else:
-                reduction = 0
+            exact = app.config['EXACT_AMOUNTS']
+            strict = app.config['STRICT_PARSING']
+            rates = currencyRates()
+            timer = StageTimer()
 
-            return render_template('results.html',
-                                 transactions=serializeNamedtupleList(transactions),
-                                 original_transactions=transactionCount,
-                                 original_transactions_list=serializeNamedtupleList(originalTransactionsList),
-                                 simplified_transactions=simplifiedTransactions,
-                                 reduction=reduction,
-                                 people_details=peopleDetails)
+            resultId, settled = settleUpload(file, exact, strict, timer, rates=rates)
+            html = renderResults(resultId, settled, timer)
+            return timedResponse('upload', timer, html)
 
         except Exception as e:
             flash(f'Error processing file: {str(e)}')
@@ -110,7 +434,7 @@ def processManual():
     """
     Processes manually entered transactions from the manual input form
 
-    Receives JSON data containing a list of transactions, creates PersonNode objects,
+    Receives JSON data containing a list of transactions, collects them in a Ledger,
     simplifies debts using the core algorithm, and returns results similar to file upload
     """
     try:
@@ -120,128 +444,574 @@ def processManual():
         if not transactionsData:
             return jsonify({'error': 'No transactions provided'}), 400
 
-        # Create PersonNode objects from manual input
-        people = {}
-        originalTransactions = []
-
-        for transaction in transactionsData:
-            debtor = transaction['debtor'].strip()
-            creditor = transaction['creditor'].strip()
-            amount = float(transaction['amount'])
-
-            # Store original transaction for display
-            originalTransactions.append(Transaction(
-                debtor=debtor,
-                creditor=creditor,
-                amount=amount
-            ))
-
-            # Create PersonNodes for each person
-            if debtor not in people:
-                people[debtor] = PersonNode(debtor)
-            if creditor not in people:
-                people[creditor] = PersonNode(creditor)
-
-            people[creditor].addDebt(people[debtor], amount)
-
-        # Process the transactions using existing logic
-        allGroups = splitUpGroups(list(people.values()))
-        transactionCount = len(transactionsData)
-
-        # Calculate simplified transactions
-        allPeople = []
-        for group in allGroups:
-            simplified_group = simplifyDebts2(list(group))
-            allPeople.extend(simplified_group)
-
-        # Extract transaction data for template
-        transactions = []
-        simplifiedTransactions = 0
-
-        for person in allPeople:
-            for creditor, amount in person.getOwersAndCreditors().items():
-                if amount < 0:  # This person owes money
-                    transactions.append(Transaction(
-                        debtor=person.getName(),
-                        creditor=creditor.getName(),
-                        amount=abs(amount)
-                    ))
-                    simplifiedTransactions += 1
-
-        # Calculate people details for display
-        peopleDetails = []
-        for person in allPeople:
-            peopleDetails.append({
-                'name': person.getName(),
-                'total': person.getTotalMoney()
-            })
-
-        # Calculate reduction percentage
-        if transactionCount > 0:
-            reduction = round(((transactionCount - simplifiedTransactions) / transactionCount) * 100, 1)
-        else:
-            reduction = 0
-
-        return render_template('results.html',
-                             transactions=serializeNamedtupleList(transactions),
-                             original_transactions=transactionCount,
-                             original_transactions_list=serializeNamedtupleList(originalTransactions),
-                             simplified_transactions=simplifiedTransactions,
-                             reduction=reduction,
-                             people_details=peopleDetails)
+        exact = app.config['EXACT_AMOUNTS']
+        timer = StageTimer()
+        rates = currencyRates()
+        with timer.stage('parse', rows=len(transactionsData)):
+            rows = [parseManualTransaction(transaction, exact) for transaction in transactionsData]
+            currencies = [manualCurrency(transaction, rates) for transaction in transactionsData]
+
+        # Convert every amount of a currency at once, before the digest
+        if any(currencies):
+            with timer.stage('convert', rows=len(rows)):
+                amounts = convertCurrencies(array('q' if exact else 'd',
+                                                  (amount for _, _, amount in rows)),
+                                            currencies, rates)
+                rows = [(creditor, debtor, amount)
+                        for (creditor, debtor, _), amount in zip(rows, amounts)]
+
+        # Identical transaction lists are served from the result cache
+        with timer.stage('digest'):
+            resultId = transactionDigest(rows, exact)
+            settled = loadResult(resultId)
+
+        if settled is None:
+            # Collect the manual input in a ledger
+            with timer.stage('ledger', rows=len(rows)):
+                ledger = Ledger(exact)
+                for creditor, debtor, amount in rows:
+                    ledger.addTransaction(creditor, debtor, amount)
+
+            # Sum repeated payer/debtor pairs before building the graph
+            with timer.stage('aggregate', rows=len(rows)):
+                ledger.getPairEdges()
+
+            # Process the transactions using existing logic
+            with timer.stage('group', rows=len(ledger)):
+                table = ledger.toBalanceTable()
+
+            # Calculate simplified transactions (groups are independent)
+            with timer.stage('simplify', rows=len(table.names)):
+                settlement = settleBalanceColumns(table)
+
+            with timer.stage('extract', rows=len(settlement[2])):
+                settled = summarizeSettlement(settlement, ledger)
+            saveResult(resultId, settled)
+
+        html = renderResults(resultId, settled, timer)
+        return timedResponse('process_manual', timer, html)
 
     except Exception as e:
         return jsonify({'error': f'Error processing transactions: {str(e)}'}), 500
 
-@app.route('/export_csv', methods=['POST'])
-def exportCsv():
+@app.route('/cache_stats', methods=['GET'])
+def cacheStats():
     """
-    Handles CSV export of combined transactions
+    Returns the result cache's hit/miss counters and memory use as JSON
+    """
+    return jsonify(getResultCache().getStats())
+
+@app.route('/metrics', methods=['GET'])
+def metricsReport():
+    """
+    Returns per-stage duration histograms, row and allocation totals as JSON
+    """
+    return jsonify(metrics.snapshot())
+
+@app.route('/jobs', methods=['POST'])
+def submitUploadJob():
+    """
+    Queues an uploaded CSV file for settlement in the background
 
-    Receives JSON data containing transactions and generates a downloadable CSV file
-    with the same format as input CSV files: creditor,debtor,amount (no header)
+    The upload is spooled to a temporary file and the request returns
+    straight away with the job id (202), however big the file is. Poll
+    /jobs/<id> for progress and fetch /jobs/<id>/result once it is done.
+    Returns 503 if too many jobs are already waiting.
     """
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    if not file.filename.endswith('.csv'):
+        return jsonify({'error': 'Please upload a CSV file'}), 400
+
+    spooledFile = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    file.save(spooledFile)
     try:
-        data = request.get_json()
+        jobId = getJobQueue().submit(runUploadJob, spooledFile,
+                                app.config['EXACT_AMOUNTS'],
+                                app.config['STRICT_PARSING'],
+                                currencyRates())
+    except JobQueueFull as e:
+        spooledFile.close()
+        return jsonify({'error': f'Server busy: {str(e)}'}), 503
+
+    return jsonify({
+        'job_id': jobId,
+        'status_url': url_for('uploadJobStatus', jobId=jobId),
+        'result_url': url_for('uploadJobResult', jobId=jobId)
+    }), 202
+
+@app.route('/jobs/<jobId>', methods=['GET'])
+def uploadJobStatus(jobId):
+    """
+    Returns a job's status, current stage and rows parsed so far as JSON
+    """
+    status = getJobQueue().getStatus(jobId)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
+@app.route('/jobs/<jobId>/result', methods=['GET'])
+def uploadJobResult(jobId):
+    """
+    Returns the results page of a finished job
+
+    Responds 202 with the job status while it is still running, 422
+    with the error if it failed, and 410 if the result store has since
+    dropped the settled ledger.
+    """
+    status = getJobQueue().getStatus(jobId)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if status['status'] == JOB_FAILED:
+        return jsonify({'error': f'Error processing file: {status["error"]}'}), 422
+    if status['status'] != JOB_DONE:
+        return jsonify(status), 202
+
+    # Rendering needs a request, so it happens when the result is fetched
+    result = getJobQueue().getResult(jobId)
+    settled = loadResult(result['result_id'])
+    if settled is None:
+        return jsonify({'error': 'Result expired, please upload the file again'}), 410
+    timer = StageTimer()
+    html = renderResults(result['result_id'], settled, timer)
+    return timedResponse('upload_job_result', timer, html)
+
+def iterOriginalRows(settled, start=0, stop=None):
+    """
+    Yields a settled ledger's original transactions as dicts, lazily
+    """
+    names = settled.names
+    toAmount = centsToAmount if settled.exact else (lambda amount: amount)
+    # Slicing the columns jumps straight to the window (the full export doesn't copy them)
+    columns = settled.edges if start == 0 and stop is None else \
+        [column[start:stop] for column in settled.edges]
+    for payerId, debtorId, amount in zip(*columns):
+        yield {'creditor': names[payerId], 'debtor': names[debtorId], 'amount': toAmount(amount)}
+
+def resultRows(settled, listName, offset, limit):
+    """
+    Returns one window of a settled ledger's rows as JSON-ready dicts
+
+    @param listName: str. 'original' (uploaded transactions), 'simplified'
+                     (required payments) or 'balances' (each person's total)
+    @return: tuple (total number of rows, list of row dicts)
+    @raise KeyError: for an unknown listName
+    """
+    if listName == 'original':
+        return len(settled.edges[2]), list(iterOriginalRows(settled, offset, offset + limit))
+    if listName == 'simplified':
+        rows = serializeNamedtupleList(settled.transactions[offset:offset + limit])
+        return len(settled.transactions), rows
+    if listName == 'balances':
+        return len(settled.peopleDetails), settled.peopleDetails[offset:offset + limit]
+    raise KeyError(listName)
+
+def networkLevelOfDetail(settled, maxNodes, maxEdges):
+    """
+    Reduces the original debt network to what a small drawing can show
+
+    People are ranked by the total amount flowing through them. The top
+    maxNodes - 1 keep their own node and everyone else is merged into one
+    "others" node, then only the maxEdges largest debts are kept.
+
+    @return: dict with 'nodes' ({'name', 'people'}), 'edges' ({'from',
+             'to', 'amount'} as node indexes, debtor to creditor) and totals
+    """
+    payerIds, debtorIds, sums, _ = settled.pairEdges
+    toAmount = centsToAmount if settled.exact else (lambda amount: amount)
+    volume = [0] * len(settled.names)
+    for payerId, debtorId, amount in zip(payerIds, debtorIds, sums):
+        volume[payerId] += abs(amount)
+        volume[debtorId] += abs(amount)
+
+    people = [personId for personId, flow in enumerate(volume) if flow]
+    hidden = 0
+    if len(people) > maxNodes:
+        hidden = len(people) - (maxNodes - 1)
+        people = heapq.nlargest(maxNodes - 1, people, key=volume.__getitem__)
+    nodeOf = {personId: node for node, personId in enumerate(people)}
+    othersNode = len(people)
+
+    totals = {}
+    for payerId, debtorId, amount in zip(payerIds, debtorIds, sums):
+        edge = (nodeOf.get(debtorId, othersNode), nodeOf.get(payerId, othersNode))
+        if edge[0] != edge[1]:
+            totals[edge] = totals.get(edge, 0) + amount
+    edges = heapq.nlargest(maxEdges, totals.items(), key=lambda item: abs(item[1]))
+
+    nodes = [{'name': settled.names[personId], 'people': 1} for personId in people]
+    if hidden:
+        nodes.append({'name': f'{hidden} others', 'people': hidden})
+    return {
+        'nodes': nodes,
+        'edges': [{'from': edge[0], 'to': edge[1], 'amount': toAmount(amount)}
+                  for edge, amount in edges],
+        'total_people': len(people) + hidden,
+        'total_edges': len(sums)
+    }
+
+@app.route('/results/<resultId>/rows/<listName>', methods=['GET'])
+def resultPage(resultId, listName):
+    """
+    Serves one window of a result's original transactions, required
+    payments or balances as JSON, for the virtualized lists in results.js
+
+    Query parameters: offset (default 0) and limit (default RESULT_PAGE_ROWS,
+    at most MAX_RESULT_PAGE_ROWS).
+    """
+    settled = loadResult(resultId)
+    if settled is None:
+        return jsonify({'error': 'Unknown or expired result'}), 404
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', RESULT_PAGE_ROWS, type=int), 0),
+                MAX_RESULT_PAGE_ROWS)
+    try:
+        total, rows = resultRows(settled, listName, offset, limit)
+    except KeyError:
+        return jsonify({'error': f'Unknown list: {listName}'}), 404
+    return jsonify({'total': total, 'offset': offset, 'rows': rows})
+
+@app.route('/results/<resultId>/network', methods=['GET'])
+def resultNetwork(resultId):
+    """
+    Serves the level-of-detail debt network drawn by results.js
+
+    Query parameters: max_nodes (default 40) and max_edges (default 120).
+    """
+    settled = loadResult(resultId)
+    if settled is None:
+        return jsonify({'error': 'Unknown or expired result'}), 404
+    maxNodes = min(max(request.args.get('max_nodes', 40, type=int), 2), 500)
+    maxEdges = min(max(request.args.get('max_edges', 120, type=int), 1), 5000)
+    return jsonify(networkLevelOfDetail(settled, maxNodes, maxEdges))
+
+@app.route('/results/<resultId>/original.csv', methods=['GET'])
+def resultCsv(resultId):
+    """
+    Streams a result's original transactions as a downloadable CSV file
+    """
+    settled = loadResult(resultId)
+    if settled is None:
+        return jsonify({'error': 'Unknown or expired result'}), 404
+    response = streamedResponse(iterCsvChunks(iterOriginalRows(settled)), 'text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=combined_transactions.csv'
+    return response
+
+def sessionResults(sessionId, ledgerSession):
+    """
+    Re-settles the changed groups of a session and returns its JSON payload
+    """
+    resettledGroups = ledgerSession.getDirtyGroupCount()
+    toAmount = centsToAmount if ledgerSession.isExact() else (lambda amount: amount)
+    transactions = [item._replace(amount=toAmount(item.amount))
+                    for item in ledgerSession.settle()]
+    return {
+        'session_id': sessionId,
+        'transactions': serializeNamedtupleList(transactions),
+        'original_transactions': ledgerSession.getNumTransactions(),
+        'simplified_transactions': len(transactions),
+        'resettled_groups': resettledGroups
+    }
+
+@app.route('/session', methods=['POST'])
+def createSession():
+    """
+    Creates an incremental ledger session
+
+    Accepts an optional JSON body with initial 'transactions'. Returns the
+    session id and its current settlements.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        exact = app.config['EXACT_AMOUNTS']
+        ledgerSession = LedgerSession(exact)
+        for transaction in data.get('transactions', []):
+            ledgerSession.addTransaction(*parseManualTransaction(transaction, exact))
+
+        # Settled before it is shared, so no lock is needed yet
+        sessionId = uuid.uuid4().hex
+        results = sessionResults(sessionId, ledgerSession)
+        with ledgerSessionsLock:
+            ledgerSessions[sessionId] = (ledgerSession, threading.Lock())
+        return jsonify(results), 201
+
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        # A malformed transaction (or body) is the client's error
+        return jsonify({'error': f'Error creating session: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Error creating session: {str(e)}'}), 500
+
+@app.route('/session/<sessionId>', methods=['GET', 'DELETE'])
+def ledgerSession(sessionId):
+    """
+    Returns the current settlements of a session (GET) or closes it (DELETE)
+    """
+    if request.method == 'DELETE':
+        with ledgerSessionsLock:
+            if ledgerSessions.pop(sessionId, None) is None:
+                return jsonify({'error': 'Unknown session'}), 404
+        return '', 204
+
+    entry = lookupSession(sessionId)
+    if entry is None:
+        return jsonify({'error': 'Unknown session'}), 404
+    ledgerSession, sessionLock = entry
+    with sessionLock:
+        return jsonify(sessionResults(sessionId, ledgerSession))
+
+@app.route('/session/<sessionId>/transactions', methods=['POST', 'DELETE'])
+def updateSession(sessionId):
+    """
+    Appends (POST) or removes (DELETE) transactions in a session
+
+    Receives JSON data containing a list of transactions in the same format
+    as /process_manual. Only the groups whose balances changed are
+    re-settled before the updated settlements are returned.
+
+    A batch is applied whole or not at all: every transaction is parsed,
+    and for DELETE checked against the session, before any is applied.
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Expected a JSON object with transactions'}), 400
         transactionsData = data.get('transactions', [])
 
-        if not transactionsData:
-            return jsonify({'error': 'No transactions to export'}), 400
+        entry = lookupSession(sessionId)
+        if entry is None:
+            return jsonify({'error': 'Unknown session'}), 404
+        ledgerSession, sessionLock = entry
 
-        # Create CSV in memory
-        output = io.StringIO()
-        writer = csv.writer(output)
-
-        # Write transaction data (same format as input)
-        for transaction in transactionsData:
-            # Handle both dictionary and named tuple formats for backward compatibility
-            if hasattr(transaction, '_asdict'):
-                # Named tuple - convert back to creditor,debtor,amount format for CSV
-                writer.writerow([
-                    getattr(transaction, 'creditor', ''),  # creditor is the creditor
-                    getattr(transaction, 'debtor', ''),
-                    getattr(transaction, 'amount', 0)
-                ])
+        rows = [parseManualTransaction(transaction, ledgerSession.isExact())
+                for transaction in transactionsData]
+        with sessionLock:
+            if request.method == 'DELETE':
+                ledgerSession.removeTransactions(rows)
             else:
-                # Dictionary (backward compatibility)
-                writer.writerow([
-                    transaction.get('creditor', ''),
-                    transaction.get('debtor', ''),
-                    transaction.get('amount', 0)
-                ])
+                for creditor, debtor, amount in rows:
+                    ledgerSession.addTransaction(creditor, debtor, amount)
 
-        # Create response with CSV data
-        csvContent = output.getvalue()
-        output.close()
+            return jsonify(sessionResults(sessionId, ledgerSession))
 
-        response = make_response(csvContent)
-        response.headers['Content-Type'] = 'text/csv'
-        response.headers['Content-Disposition'] = 'attachment; filename=transactions.csv'
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        # A malformed transaction, or one to remove that isn't in the session
+        return jsonify({'error': f'Error updating session: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Error updating session: {str(e)}'}), 500
 
-        return response
+def storedLedgerResults(store, ledgerName):
+    """
+    Settles a stored ledger from its materialized balances
 
-    except Exception as e:
-        return jsonify({'error': f'Error exporting CSV: {str(e)}'}), 500
+    @return: dict. JSON payload of the /ledgers routes
+    @raise KeyError: if the ledger doesn't exist
+    """
+    table = store.toBalanceTable(ledgerName)
+    debtorIds, creditorIds, amounts = settleBalanceColumns(table)
+    toAmount = centsToAmount if store.isExact() else (lambda amount: amount)
+    transactions = [Transaction(debtor=table.names[debtorId],
+                                creditor=table.names[creditorId],
+                                amount=toAmount(amount))
+                    for debtorId, creditorId, amount in zip(debtorIds, creditorIds, amounts)]
+    return {
+        'ledger': ledgerName,
+        'transactions': serializeNamedtupleList(transactions),
+        'balances': [{'name': name, 'total': toAmount(balance)}
+                     for name, balance in zip(table.names, table.balances)],
+        'original_transactions': table.numTransactions,
+        'simplified_transactions': len(transactions),
+        'people': len(table.names)
+    }
+
+@app.route('/ledgers', methods=['GET'])
+def listLedgers():
+    """
+    Returns the names of the stored ledgers
+    """
+    return jsonify({'ledgers': getLedgerStore().getLedgerNames()})
+
+@app.route('/ledgers/<ledgerName>', methods=['GET'])
+def storedLedger(ledgerName):
+    """
+    Returns the settlements of a stored ledger
+
+    Only the materialized balances and pair totals are read, however long
+    the ledger's history is.
+    """
+    try:
+        return jsonify(storedLedgerResults(getLedgerStore(), ledgerName))
+    except KeyError:
+        return jsonify({'error': 'Unknown ledger'}), 404
+
+@app.route('/ledgers/<ledgerName>/transactions', methods=['POST'])
+def addStoredTransactions(ledgerName):
+    """
+    Appends transactions to a stored ledger, creating it if needed
+
+    Accepts either an uploaded csv ('file') or JSON data containing a list
+    of transactions in the same format as /process_manual. Everything in
+    one request is stored atomically. Returns the updated settlements.
+    """
+    store = getLedgerStore()
+    parseErrors = []
+    try:
+        if 'file' in request.files:
+            added = store.importUpload(ledgerName, request.files['file'],
+                                       strict=app.config['STRICT_PARSING'],
+                                       errors=parseErrors, rates=currencyRates())
+        else:
+            data = request.get_json()
+            rates = currencyRates()
+            transactionsData = data.get('transactions', [])
+            rows = [parseManualTransaction(transaction, store.isExact())
+                    for transaction in transactionsData]
+            currencies = [manualCurrency(transaction, rates) for transaction in transactionsData]
+            creditors, debtors, amounts = zip(*rows) if rows else ((), (), ())
+            if any(currencies):
+                amounts = convertCurrencies(array('q' if store.isExact() else 'd', amounts),
+                                            currencies, rates)
+            added = store.addTransactions(ledgerName, creditors, debtors, amounts)
+    except (LedgerParseError, KeyError, ValueError, TypeError, AttributeError) as e:
+        return jsonify({'error': f'Error adding transactions: {str(e)}'}), 400
+
+    results = storedLedgerResults(store, ledgerName)
+    results['added_transactions'] = added
+    results['skipped_rows'] = len(parseErrors)
+    results['parse_errors'] = [str(error) for error in parseErrors[:MAX_REPORTED_PARSE_ERRORS]]
+    return jsonify(results)
+
+@app.route('/ledgers/<ledgerName>/verify', methods=['GET', 'POST'])
+def verifyStoredLedger(ledgerName):
+    """
+    Rebuilds a stored ledger from its raw transactions and compares the
+    result with its materialized balances and pair totals
+
+    Pass repair=1 (POST only) to recompute the materialized tables if they differ.
+    """
+    repair = request.method == 'POST' and request.args.get('repair', '0') == '1'
+    try:
+        problems = getLedgerStore().verifyLedger(ledgerName, repair)
+    except KeyError:
+        return jsonify({'error': 'Unknown ledger'}), 404
+    return jsonify({'ledger': ledgerName, 'consistent': not problems,
+                    'problems': problems, 'repaired': bool(problems) and repair})
+
+@app.route('/api/settle', methods=['POST'])
+def apiSettle():
+    """
+    Machine API: settles a CSV or NDJSON body and streams back the payments
+
+    The body is csv (payer,debtor,amount rows) unless the Content-Type is
+    application/x-ndjson, in which case every line is a /process_manual
+    style JSON object. Gzipped bodies (Content-Encoding: gzip) are read as
+    they are decompressed.
+
+    Query parameters:
+        format: 'columnar' (default) for one JSON object of parallel
+                arrays with interned names, or 'ndjson' for one JSON line
+                per payment followed by a summary line
+        echo: '1' to also send back the original transactions
+        gzip: '1' or '0' to force or skip compressing the response
+              (default: whenever the client accepts gzip)
+    """
+    outputFormat = request.args.get('format', 'columnar')
+    if outputFormat not in ('columnar', 'ndjson'):
+        return jsonify({'error': f'Unknown format: {outputFormat}'}), 400
+    echo = request.args.get('echo', '0') == '1'
+    compress = {'1': True, '0': False}.get(request.args.get('gzip'))
+
+    exact = app.config['EXACT_AMOUNTS']
+    strict = app.config['STRICT_PARSING']
+    timer = StageTimer()
+    stream = request.stream
+    if request.headers.get('Content-Encoding') == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+
+    parseErrors = []
+    try:
+        rates = currencyRates()
+        with timer.stage('parse'):
+            if request.mimetype == 'application/x-ndjson':
+                ledger = readLedgerFromNdjson(stream, exact, strict, parseErrors, rates)
+            else:
+                ledger, _ = readLedgerFromUpload(stream, keepOriginal=False,
+                                                 exact=exact, strict=strict,
+                                                 errors=parseErrors, rates=rates)
+    except (LedgerParseError, UnicodeDecodeError, ValueError, OSError, EOFError,
+            zlib.error) as e:
+        # Malformed rows, bytes that aren't UTF-8 and corrupt gzip data
+        return jsonify({'error': f'Error reading transactions: {str(e)}'}), 400
+    transactionCount = ledger.getNumTransactions()
+    timer.setRows('parse', transactionCount)
+
+    with timer.stage('group', rows=len(ledger)):
+        table = ledger.toBalanceTable()
+
+    with timer.stage('simplify', rows=len(ledger)):
+        settlement = settleBalanceColumns(table)
+
+    simplifiedTransactions = len(settlement[2])
+    summary = {
+        'original_transactions': transactionCount,
+        'simplified_transactions': simplifiedTransactions,
+        'reduction': round((transactionCount - simplifiedTransactions) / transactionCount * 100, 1)
+                     if transactionCount else 0,
+        'people': len(ledger),
+        'skipped_rows': len(parseErrors),
+        'parse_errors': [str(error) for error in parseErrors[:MAX_REPORTED_PARSE_ERRORS]]
+    }
+    metrics.record('api_settle', timer)
+
+    if outputFormat == 'ndjson':
+        response = streamedResponse(iterSettlementNdjson(ledger, settlement, summary, echo),
+                                    'application/x-ndjson', compress)
+    else:
+        response = streamedResponse(iterSettlementColumnar(ledger, settlement, summary, echo),
+                                    'application/json', compress)
+    response.headers['Server-Timing'] = timer.serverTimingHeader()
+    return response
+
+@app.route('/export_csv', methods=['POST'])
+def exportCsv():
+    """
+    Handles CSV export of combined transactions
+
+    Receives JSON data containing transactions (or NDJSON, one transaction
+    per line) and streams back a downloadable CSV file with the same format
+    as input CSV files: creditor,debtor,amount (no header)
+
+    The body is parsed incrementally while the CSV is being sent, so
+    neither the posted transactions nor the file are ever held in memory
+    at once. The response is gzipped on the fly when the client accepts it
+    (gzip=0/1 overrides that).
+
+    The first EXPORT_CHUNK_ROWS transactions are parsed before the
+    response starts, so a malformed body of up to that many transactions
+    is answered with a 400. Past that the status is already sent: an error
+    ends the CSV with an EXPORT_ERROR_MARKER line (see iterCsvChunks).
+    """
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            transactions = iterNdjson(request.stream)
+        else:
+            transactions = iterJsonArray(request.stream, 'transactions')
+
+        # Check the start of the body before committing to a response
+        head = list(itertools.islice(transactions, EXPORT_CHUNK_ROWS))
+        if not head:
+            return jsonify({'error': 'No transactions to export'}), 400
+        if not all(isinstance(transaction, dict) for transaction in head):
+            return jsonify({'error': 'Every transaction must be a JSON object'}), 400
+
+    except ValueError as e:
+        return jsonify({'error': f'Error exporting CSV: {str(e)}'}), 400
+
+    compress = {'1': True, '0': False}.get(request.args.get('gzip'))
+    chunks = stream_with_context(iterCsvChunks(itertools.chain(head, transactions)))
+    response = streamedResponse(chunks, 'text/csv', compress)
+    response.headers['Content-Disposition'] = 'attachment; filename=transactions.csv'
+    return response
 
 if __name__ == '__main__':
     """
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the splitUp settlement pipeline
+
+Generates seeded synthetic ledgers of different shapes, runs them through
+each stage of the pipeline separately and writes timings, peak memory and
+settlement edge counts as JSON so runs can be compared between commits.
+It also times a cold import of the settlement core in fresh interpreters,
+and can fail the run when that import gets slow or pulls in heavy modules.
+
+Usage: python benchmark.py --rows 100000 --output bench.json
+       python benchmark.py --shapes --max-import-ms 50
+"""
+
+import argparse
+import io
+import json
+import platform
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from splitUp import (Ledger, iterUploadLines, iterTransactionRows,
+                     iterTransactionBatches, splitUpGroups, simplifyDebts2,
+                     settleGroups)
+
+def manySmallGroups(rows, rng):
+    """
+    Lots of independent trips of 3-8 people each
+    """
+    transactions = []
+    group = 0
+    while len(transactions) < rows:
+        size = rng.randint(3, 8)
+        for _ in range(min(size * 2, rows - len(transactions))):
+            payer, debtor = rng.sample(range(size), 2)
+            transactions.append(("G{0}-{1}".format(group, payer),
+                                 "G{0}-{1}".format(group, debtor),
+                                 rng.randint(1, 20000) / 100))
+        group += 1
+    return transactions
+
+def oneGiantGroup(rows, rng):
+    """
+    A single group where anyone can owe anyone
+    """
+    people = max(2, rows // 10)
+    transactions = []
+    for _ in range(rows):
+        payer, debtor = rng.sample(range(people), 2)
+        transactions.append(("P{0}".format(payer), "P{0}".format(debtor),
+                             rng.randint(1, 20000) / 100))
+    return transactions
+
+def starHub(rows, rng):
+    """
+    A few hub payers covering everybody else (e.g. one person books everything)
+    """
+    hubs = max(1, rows // 1000)
+    people = max(2, rows // 5)
+    return [("Hub{0}".format(rng.randrange(hubs)),
+             "P{0}".format(rng.randrange(people)),
+             rng.randint(1, 20000) / 100) for _ in range(rows)]
+
+def longChain(rows, rng):
+    """
+    Each person pays for the next one, forming one long path
+    """
+    return [("P{0}".format(i), "P{0}".format(i + 1), rng.randint(1, 20000) / 100)
+            for i in range(rows)]
+
+def duplicatePairs(rows, rng):
+    """
+    The same few payer/debtor pairs repeated over and over (e.g. weekly rent)
+    """
+    pairs = [("P{0}".format(a), "P{0}".format(b))
+             for a, b in (rng.sample(range(20), 2) for _ in range(30))]
+    return [rng.choice(pairs) + (rng.randint(1, 20000) / 100,)
+            for _ in range(rows)]
+
+# Ledger shapes by name
+GENERATORS = {
+    'many_small_groups': manySmallGroups,
+    'one_giant_group': oneGiantGroup,
+    'star_hub': starHub,
+    'long_chain': longChain,
+    'duplicate_pairs': duplicatePairs
+}
+
+def toCsvBytes(transactions):
+    """
+    Encodes generated transactions the way an uploaded file would look
+    """
+    return "".join("{0},{1},{2}\n".format(payer, debtor, amount)
+                   for payer, debtor, amount in transactions).encode('utf-8')
+
+def countEdges(people):
+    """
+    Counts the payments in a list of simplified PersonNode objects
+    """
+    return sum(1 for person in people
+               for amount in person.getOwersAndCreditors().values() if amount < 0)
+
+def runStage(stages, name, function, trackMemory):
+    """
+    Runs one pipeline stage, recording its wall time and peak memory
+
+    @param stages: dict. Stage name -> measurements (modified in place)
+    @param trackMemory: bool. Measure peak allocations with tracemalloc
+    @return: whatever function returns
+    """
+    if trackMemory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    stages[name] = {'seconds': round(seconds, 6)}
+    if trackMemory:
+        stages[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+def benchmarkShape(shape, rows, seed, trackMemory=True):
+    """
+    Runs one synthetic ledger through every stage of the pipeline
+
+    @param shape: str. Key of GENERATORS
+    @param rows: int. Number of transactions to generate
+    @param seed: int. Seed for the generator
+    @param trackMemory: bool. Record peak memory per stage
+    @return: dict of measurements for this shape
+    """
+    data = toCsvBytes(GENERATORS[shape](rows, random.Random(seed)))
+    stages = {}
+
+    def ingest():
+        # The batched path uploads take (see readLedgerFromUpload)
+        ledger = Ledger()
+        for payers, debtors, amounts in iterTransactionBatches(
+                iterUploadLines(io.BytesIO(data))):
+            ledger.addTransactions(payers, debtors, amounts)
+        return ledger
+
+    def ingestPerRowBaseline():
+        # One addTransaction() call per row, kept to compare against
+        ledger = Ledger()
+        for payer, debtor, amount in iterTransactionRows(
+                iterUploadLines(io.BytesIO(data))):
+            ledger.addTransaction(payer, debtor, amount)
+        return ledger
+
+    def simplifyEachGroup():
+        simplified = []
+        for group in allGroups:
+            simplified.extend(simplifyDebts2(list(group)))
+        return simplified
+
+    runStage(stages, 'ingest_per_row_baseline', ingestPerRowBaseline, trackMemory)
+    ledger = runStage(stages, 'ingest', ingest, trackMemory)
+    pairs = runStage(stages, 'aggregate_pairs', ledger.getPairEdges, trackMemory)
+    people = runStage(stages, 'build_people', ledger.toPeople, trackMemory)
+    allGroups = runStage(stages, 'split_up_groups',
+                         lambda: splitUpGroups(people), trackMemory)
+    simplified = runStage(stages, 'simplify_debts2', simplifyEachGroup, trackMemory)
+    settled = runStage(stages, 'settle_groups',
+                       lambda: settleGroups(allGroups, maxWorkers=1), trackMemory)
+
+    return {
+        'shape': shape,
+        'rows': rows,
+        'seed': seed,
+        'input_bytes': len(data),
+        'people': len(ledger),
+        'unique_pairs': len(pairs[3]),
+        'groups': len(allGroups),
+        'settlement_edges': countEdges(simplified),
+        'settle_groups_edges': countEdges(settled),
+        'stages': stages
+    }
+
+def gitCommit():
+    """
+    Returns the current git commit hash, or None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# What a settlement worker imports; timed by measureImportTime()
+IMPORT_STATEMENT = "from splitUp import Ledger, settleBalanceTable"
+
+# Modules the settlement core must not load when it is imported
+HEAVY_MODULES = ('numpy', 'flask', 'werkzeug', 'argparse', 'json', 'glob',
+                 'hashlib', 'concurrent.futures', 'multiprocessing')
+
+# Run in a fresh interpreter: prints the import's seconds, then the heavy
+# modules it loaded (checked before anything else is imported)
+IMPORT_PROBE = """import sys, time
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(seconds)
+print(' '.join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+def measureImportTime(statement=IMPORT_STATEMENT, runs=5):
+    """
+    Times a cold import, each run in a new interpreter so nothing is cached
+
+    @param statement: str. Import statement to time
+    @param runs: int. Number of interpreters to start
+    @return: dict with the median 'seconds' and the 'heavy_modules' loaded
+    """
+    probe = IMPORT_PROBE.format(statement=statement, heavy=HEAVY_MODULES)
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', probe], text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, modules = output.split("\n")[:2]
+        timings.append(float(seconds))
+    return {'statement': statement, 'runs': runs,
+            'seconds': round(statistics.median(timings), 6),
+            'heavy_modules': modules.split()}
+
+def runBenchmarks(shapes, rows, seed, trackMemory=True, importRuns=0):
+    """
+    Benchmarks every requested shape and returns the full JSON report
+
+    @param importRuns: int. Cold imports to time (0 = skip, see measureImportTime)
+    """
+    return {
+        'meta': {
+            'commit': gitCommit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'track_memory': trackMemory
+        },
+        'import': measureImportTime(runs=importRuns) if importRuns else None,
+        'results': [benchmarkShape(shape, rows, seed, trackMemory)
+                    for shape in shapes]
+    }
+
+def main(argv=None):
+    """
+    Command-line entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='transactions per generated ledger')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shapes', nargs='*', choices=sorted(GENERATORS),
+                        default=list(GENERATORS),
+                        help='ledger shapes to run (none = import time only)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip tracemalloc (faster, timing-only)')
+    parser.add_argument('--output', default='-',
+                        help='JSON output file (default: stdout)')
+    parser.add_argument('--import-runs', type=int, default=5,
+                        help='fresh interpreters to time the import in (0 = skip)')
+    parser.add_argument('--max-import-ms', type=float,
+                        help='exit with status 1 if the median import is slower '
+                             'or loads any heavy module')
+    args = parser.parse_args(argv)
+
+    report = runBenchmarks(args.shapes, args.rows, args.seed, not args.no_memory,
+                           args.import_runs)
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as output:
+            output.write(text + "\n")
+        for result in report['results']:
+            print("{0}: {1}".format(result['shape'], ", ".join(
+                "{0} {1:.3f}s".format(name, stage['seconds'])
+                for name, stage in result['stages'].items())), file=sys.stderr)
+
+    imported = report['import']
+    if imported is not None:
+        print("import: {0:.1f}ms{1}".format(
+            imported['seconds'] * 1000,
+            "".join(", loaded " + name for name in imported['heavy_modules'])),
+            file=sys.stderr)
+        if args.max_import_ms is not None and \
+                (imported['seconds'] * 1000 > args.max_import_ms
+                 or imported['heavy_modules']):
+            print("import is over its {0}ms budget or loads heavy modules"
+                  .format(args.max_import_ms), file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
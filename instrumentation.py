@@ -0,0 +1,159 @@
+"""
+Per-stage timing and memory instrumentation for the web pipelines
+
+A StageTimer measures the stages of one request (decoding, parsing,
+grouping, simplification, result extraction, rendering). Finished timers
+are recorded in a MetricsRegistry, which keeps a histogram per stage and
+backs the Server-Timing header and the /metrics endpoint in app.py.
+"""
+
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Upper bounds (in milliseconds) of the histogram buckets; the last is +Inf
+HISTOGRAM_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                        10000, 30000)
+
+class StageTimer():
+    """
+    Records wall time, row counts and allocations for the stages of one request.
+
+    Allocation sizes are only measured when tracemalloc is tracing (see
+    MetricsRegistry.setTrackAllocations), since tracing slows everything down.
+    A stage's allocated_bytes is the peak of traced memory during the stage
+    above what was traced when it started, so memory freed before the stage
+    ends still counts and the figure is never negative. tracemalloc has one
+    peak per process, so stages of concurrent requests see each other's
+    allocations.
+    """
+    def __init__(self):
+        self.__stages = {}
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Context manager timing one named stage
+
+        @param name: str. Stage name, e.g. 'parse'
+        @param rows: int or None. Number of rows handled, if known up front
+        """
+        tracking = tracemalloc.is_tracing()
+        if tracking:
+            tracemalloc.reset_peak()
+            allocatedBefore = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.__stages.setdefault(name, {'seconds': 0.0})
+            record['seconds'] += time.perf_counter() - start
+            if rows is not None:
+                record['rows'] = rows
+            if tracking:
+                record['allocated_bytes'] = \
+                    tracemalloc.get_traced_memory()[1] - allocatedBefore
+
+    def setRows(self, name, rows):
+        """
+        Sets the row count of a stage once it is known
+        """
+        self.__stages.setdefault(name, {'seconds': 0.0})['rows'] = rows
+
+    def getStages(self):
+        """
+        Returns dict of stage name -> {'seconds', 'rows', 'allocated_bytes'}
+        """
+        return self.__stages
+
+    def serverTimingHeader(self):
+        """
+        Formats the stages as a Server-Timing header value
+        """
+        return ", ".join("{0};dur={1:.2f}".format(name, record['seconds'] * 1000)
+                         for name, record in self.__stages.items())
+
+class Histogram():
+    """
+    Cumulative histogram of durations over HISTOGRAM_BUCKETS_MS.
+    """
+    def __init__(self):
+        self.__counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        self.__count = 0
+        self.__sum = 0.0
+
+    def observe(self, milliseconds):
+        """
+        Adds one duration to the histogram
+        """
+        for i, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if milliseconds <= bound:
+                break
+        else:
+            i = len(HISTOGRAM_BUCKETS_MS)
+        self.__counts[i] += 1
+        self.__count += 1
+        self.__sum += milliseconds
+
+    def snapshot(self):
+        """
+        Returns the histogram as a dict with cumulative bucket counts
+        """
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS_MS + ('+Inf',), self.__counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.__count, 'sum_ms': round(self.__sum, 3),
+                'buckets_ms': buckets}
+
+class MetricsRegistry():
+    """
+    Thread-safe collection of per-route, per-stage histograms and totals.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__routes = {}
+
+    def setTrackAllocations(self, enabled):
+        """
+        Starts or stops tracemalloc so stages also record allocation sizes
+
+        Call it once at startup rather than per request: stopping tracemalloc
+        discards every trace, including those of requests still running.
+        """
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def record(self, route, timer):
+        """
+        Adds every stage of a finished StageTimer to the route's metrics
+
+        @param route: str. Name of the pipeline, e.g. 'upload'
+        @param timer: StageTimer
+        """
+        with self.__lock:
+            stages = self.__routes.setdefault(route, {})
+            for name, record in timer.getStages().items():
+                metrics = stages.get(name)
+                if metrics is None:
+                    metrics = {'duration': Histogram(), 'rows': 0,
+                               'allocated_bytes': 0}
+                    stages[name] = metrics
+                metrics['duration'].observe(record['seconds'] * 1000)
+                metrics['rows'] += record.get('rows', 0)
+                metrics['allocated_bytes'] += record.get('allocated_bytes', 0)
+
+    def snapshot(self):
+        """
+        Returns all metrics as a JSON-serializable dict
+        """
+        with self.__lock:
+            return {route: {name: {'duration': metrics['duration'].snapshot(),
+                                   'rows_total': metrics['rows'],
+                                   'allocated_bytes_total': metrics['allocated_bytes']}
+                            for name, metrics in stages.items()}
+                    for route, stages in self.__routes.items()}
@@ -0,0 +1,129 @@
+"""
+Background job queue for settling large uploads outside the request
+
+A JobQueue runs submitted functions on a small thread pool, so the number
+of heavy jobs running at once is capped no matter how many are uploaded.
+Each job reports its progress (current stage and rows handled) through a
+callback, which the /jobs routes in app.py serve to polling browsers.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Job states, in the order a job goes through them
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+class JobQueueFull(RuntimeError):
+    """
+    Raised by JobQueue.submit() when too many jobs are already waiting.
+    """
+
+class JobQueue():
+    """
+    Thread-safe queue of background jobs with progress tracking.
+
+    At most maxWorkers jobs run at once and at most maxPending more wait
+    for a worker. Finished jobs are kept (oldest dropped first) until
+    keepFinished newer ones have finished, so their results can be fetched.
+    """
+    def __init__(self, maxWorkers=2, maxPending=16, keepFinished=100):
+        self.__lock = threading.Lock()
+        self.__pool = ThreadPoolExecutor(max_workers=maxWorkers,
+                                         thread_name_prefix='settle-job')
+        self.__maxPending = maxPending
+        self.__keepFinished = keepFinished
+        self.__jobs = {}
+        self.__finished = OrderedDict()
+
+    def submit(self, function, *args):
+        """
+        Queues function(progress, *args) to run in the background
+
+        @param function: callable. Called with a progress(stage, rows)
+                         callback followed by args; its return value is
+                         the job's result
+        @return: str. Id of the new job
+        @raise JobQueueFull: if maxPending jobs are already waiting
+        """
+        with self.__lock:
+            pending = sum(1 for job in self.__jobs.values()
+                          if job['status'] == JOB_QUEUED)
+            if pending >= self.__maxPending:
+                raise JobQueueFull("{0} jobs are already waiting".format(pending))
+
+            jobId = uuid.uuid4().hex
+            self.__jobs[jobId] = {'status': JOB_QUEUED, 'stage': None,
+                                  'rows': 0, 'error': None, 'result': None,
+                                  'submitted': time.time(), 'finished': None}
+        self.__pool.submit(self.__run, jobId, function, args)
+        return jobId
+
+    def __run(self, jobId, function, args):
+        """
+        Runs one job on a worker thread and records how it ended
+        """
+        self.__update(jobId, status=JOB_RUNNING)
+        try:
+            result = function(lambda stage, rows=None: self.progress(jobId, stage, rows),
+                              *args)
+        except Exception as e:
+            self.__finish(jobId, status=JOB_FAILED, error=str(e))
+        else:
+            self.__finish(jobId, status=JOB_DONE, result=result)
+
+    def __update(self, jobId, **fields):
+        """
+        Sets fields of a job's state
+        """
+        with self.__lock:
+            self.__jobs[jobId].update(fields)
+
+    def __finish(self, jobId, **fields):
+        """
+        Sets fields of a finished job's state and forgets the oldest ones
+        """
+        with self.__lock:
+            self.__jobs[jobId].update(fields, finished=time.time())
+            self.__finished[jobId] = True
+            while len(self.__finished) > self.__keepFinished:
+                oldId, _ = self.__finished.popitem(last=False)
+                del self.__jobs[oldId]
+
+    def progress(self, jobId, stage, rows=None):
+        """
+        Records that a job reached a stage, optionally with its row count
+        """
+        with self.__lock:
+            job = self.__jobs[jobId]
+            job['stage'] = stage
+            if rows is not None:
+                job['rows'] = rows
+
+    def getStatus(self, jobId):
+        """
+        Returns a JSON-serializable copy of a job's state, or None if unknown
+        """
+        with self.__lock:
+            job = self.__jobs.get(jobId)
+            if job is None:
+                return None
+            return {'job_id': jobId, 'status': job['status'],
+                    'stage': job['stage'], 'rows': job['rows'],
+                    'error': job['error'], 'submitted': job['submitted'],
+                    'finished': job['finished']}
+
+    def getResult(self, jobId):
+        """
+        Returns the return value of a finished job, or None if not done
+        """
+        with self.__lock:
+            job = self.__jobs.get(jobId)
+            if job is None or job['status'] != JOB_DONE:
+                return None
+            return job['result']
@@ -0,0 +1,458 @@
+"""
+Persistent SQLite store of named ledgers
+
+A LedgerStore keeps any number of named ledgers (e.g. one per long-running
+group of friends) in a SQLite database, so a group's settlement doesn't
+have to be rebuilt from its whole history on every request. Every raw
+transaction is kept, but each person's net balance and the total of every
+(payer, debtor) pair are materialized and updated in the same database
+transaction that inserts the rows. Settling a ledger only reads those, so
+it costs time proportional to its people and pairs, not its transactions.
+Rebuilding from the raw rows is an optional verification step (see
+LedgerStore.verifyLedger).
+"""
+
+import math
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+
+from splitUp import (BalanceTable, DisjointSet, Ledger, PersonNode,
+                     iterTransactionBatches, iterUploadLines, settleBalanceTable,
+                     PARSE_BATCH_ROWS)
+
+# Materialized float balances may drift from a full rebuild by rounding
+# alone (the sums are added up in a different order); verifyLedger only
+# reports differences bigger than this
+VERIFY_TOLERANCE = 1e-6
+
+# Amounts have no declared type, so SQLite stores ints (exact minor units)
+# and floats exactly as given instead of coercing them
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ledgers (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    num_transactions INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS people (
+    id INTEGER PRIMARY KEY,
+    ledger_id INTEGER NOT NULL REFERENCES ledgers (id),
+    name TEXT NOT NULL,
+    balance NOT NULL DEFAULT 0,
+    UNIQUE (ledger_id, name)
+);
+-- A ledger's balances are read in id order without a sort
+CREATE INDEX IF NOT EXISTS people_ledger ON people (ledger_id);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    ledger_id INTEGER NOT NULL REFERENCES ledgers (id),
+    payer_id INTEGER NOT NULL REFERENCES people (id),
+    debtor_id INTEGER NOT NULL REFERENCES people (id),
+    amount NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_ledger ON transactions (ledger_id);
+CREATE INDEX IF NOT EXISTS transactions_payer ON transactions (payer_id);
+CREATE INDEX IF NOT EXISTS transactions_debtor ON transactions (debtor_id);
+CREATE TABLE IF NOT EXISTS pairs (
+    payer_id INTEGER NOT NULL REFERENCES people (id),
+    debtor_id INTEGER NOT NULL REFERENCES people (id),
+    ledger_id INTEGER NOT NULL REFERENCES ledgers (id),
+    amount NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (payer_id, debtor_id)
+);
+CREATE INDEX IF NOT EXISTS pairs_ledger ON pairs (ledger_id);
+"""
+
+class LedgerStore():
+    """
+    Thread-safe SQLite store of named ledgers with materialized balances.
+
+    People are interned per ledger, like Ledger.internName() does in
+    memory. The whole database is either in exact mode (amounts are int
+    minor units, see parseCents) or not; this is fixed when it is created.
+    """
+    def __init__(self, path=':memory:', exact=False):
+        """
+        Opens (creating if needed) the database at path
+
+        @param path: str. SQLite database file, or ':memory:'
+        @param exact: bool. Store amounts as int minor units
+        @raise ValueError: if an existing database uses the other mode
+        """
+        # Re-entrant so verifyLedger can read a consistent snapshot
+        self.__lock = threading.RLock()
+        # Transactions are begun and committed explicitly (see __writing)
+        self.__connection = sqlite3.connect(path, check_same_thread=False,
+                                            isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode = WAL")
+        self.__connection.execute("PRAGMA synchronous = NORMAL")
+        self.__connection.execute("PRAGMA foreign_keys = ON")
+        self.__connection.executescript(SCHEMA)
+        self.__connection.execute(
+            "INSERT OR IGNORE INTO settings (key, value) VALUES ('exact', ?)",
+            (int(exact),))
+        stored = self.__connection.execute(
+            "SELECT value FROM settings WHERE key = 'exact'").fetchone()[0]
+        if bool(stored) != exact:
+            raise ValueError("{0} was created with exact={1}".format(path, bool(stored)))
+        self.__exact = exact
+        # ledger name -> id, and ledger id -> {person name: id}
+        self.__ledgerIds = {}
+        self.__personIds = {}
+
+    def close(self):
+        """
+        Closes the database connection
+        """
+        with self.__lock:
+            self.__connection.close()
+
+    def isExact(self):
+        """
+        Returns True if amounts are stored as integer minor units
+        """
+        return self.__exact
+
+    @contextmanager
+    def __writing(self):
+        """
+        Runs a block in one database transaction, rolled back on error
+        """
+        with self.__lock:
+            self.__connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.__connection
+            except BaseException:
+                self.__connection.execute("ROLLBACK")
+                # Ids handed out in the rolled back transaction are gone
+                self.__ledgerIds.clear()
+                self.__personIds.clear()
+                raise
+            else:
+                self.__connection.execute("COMMIT")
+
+    def __getLedgerId(self, name, create=False):
+        """
+        Returns the id of a ledger, optionally creating it
+
+        @raise KeyError: if the ledger doesn't exist and create is False
+        """
+        ledgerId = self.__ledgerIds.get(name)
+        if ledgerId is None:
+            if create:
+                self.__connection.execute(
+                    "INSERT OR IGNORE INTO ledgers (name) VALUES (?)", (name,))
+            row = self.__connection.execute(
+                "SELECT id FROM ledgers WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                raise KeyError("Unknown ledger: {0}".format(name))
+            ledgerId = self.__ledgerIds[name] = row[0]
+        return ledgerId
+
+    def __internName(self, ledgerId, name):
+        """
+        Returns the id of a person in a ledger, adding them if needed
+        """
+        ids = self.__personIds.setdefault(ledgerId, {})
+        personId = ids.get(name)
+        if personId is None:
+            self.__connection.execute(
+                "INSERT OR IGNORE INTO people (ledger_id, name) VALUES (?, ?)",
+                (ledgerId, name))
+            personId = ids[name] = self.__connection.execute(
+                "SELECT id FROM people WHERE ledger_id = ? AND name = ?",
+                (ledgerId, name)).fetchone()[0]
+        return personId
+
+    def __insert(self, ledgerId, payers, debtors, amounts):
+        """
+        Inserts a batch of transactions and updates the materialized tables
+
+        Pair totals and balance changes are summed in memory first, so each
+        pair and person in the batch costs one statement however many rows
+        mention them.
+        """
+        internName = self.__internName
+        payerIds = [internName(ledgerId, name) for name in payers]
+        debtorIds = [internName(ledgerId, name) for name in debtors]
+
+        pairs = {}
+        deltas = {}
+        for payerId, debtorId, amount in zip(payerIds, debtorIds, amounts):
+            pair = pairs.get((payerId, debtorId))
+            if pair is None:
+                pairs[(payerId, debtorId)] = [amount, 1]
+            else:
+                pair[0] += amount
+                pair[1] += 1
+            deltas[payerId] = deltas.get(payerId, 0) + amount
+            deltas[debtorId] = deltas.get(debtorId, 0) - amount
+
+        connection = self.__connection
+        connection.executemany(
+            "INSERT INTO transactions (ledger_id, payer_id, debtor_id, amount) "
+            "VALUES (?, ?, ?, ?)",
+            ((ledgerId, payerId, debtorId, amount)
+             for payerId, debtorId, amount in zip(payerIds, debtorIds, amounts)))
+        connection.executemany(
+            "INSERT INTO pairs (payer_id, debtor_id, ledger_id, amount, count) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (payer_id, debtor_id) DO UPDATE "
+            "SET amount = amount + excluded.amount, count = count + excluded.count",
+            ((payerId, debtorId, ledgerId, total, count)
+             for (payerId, debtorId), (total, count) in pairs.items()))
+        connection.executemany(
+            "UPDATE people SET balance = balance + ? WHERE id = ?",
+            ((delta, personId) for personId, delta in deltas.items()))
+        connection.execute(
+            "UPDATE ledgers SET num_transactions = num_transactions + ? WHERE id = ?",
+            (len(payerIds), ledgerId))
+        return len(payerIds)
+
+    def addTransaction(self, ledgerName, payer, debtor, amount):
+        """
+        Records that payer paid amount on behalf of debtor in a ledger
+
+        The ledger is created by its first transaction.
+
+        @param ledgerName: str. Name of the ledger
+        @param payer: str. Name of the person who paid (the creditor)
+        @param debtor: str. Name of the person who owes the money
+        @param amount: float, or int minor units in exact mode
+        """
+        self.addTransactions(ledgerName, [payer], [debtor], [amount])
+
+    def addTransactions(self, ledgerName, payers, debtors, amounts):
+        """
+        Records a batch of transactions given as parallel columns, atomically
+
+        @param ledgerName: str. Name of the ledger (created if needed)
+        @param payers: list of str. Names of the people who paid
+        @param debtors: list of str. Names of the people who owe the money
+        @param amounts: sequence of amounts, as for addTransaction()
+        @return: int. Number of transactions added
+        """
+        with self.__writing():
+            return self.__insert(self.__getLedgerId(ledgerName, create=True),
+                                 payers, debtors, amounts)
+
+    def importUpload(self, ledgerName, file_stream, strict=True, errors=None,
+                     rates=None):
+        """
+        Streams a payer,debtor,amount csv into a ledger in one transaction
+
+        @param file_stream: binary file-like object (e.g. an uploaded file)
+        @param strict: bool. See iterTransactionBatches(); in strict mode a
+                       malformed row rolls back the whole import
+        @param errors: list or None. Collects LedgerParseErrors in lenient mode
+        @param rates: RateTable or None. Convert a currency column to the
+                      base currency before storing (see convertCurrencies)
+        @return: int. Number of transactions added
+        @raise LedgerParseError: on a malformed row in strict mode
+        """
+        with self.__writing():
+            ledgerId = self.__getLedgerId(ledgerName, create=True)
+            added = 0
+            for payers, debtors, amounts in iterTransactionBatches(
+                    iterUploadLines(file_stream), self.__exact, strict, errors,
+                    rates=rates):
+                added += self.__insert(ledgerId, payers, debtors, amounts)
+            return added
+
+    def getLedgerNames(self):
+        """
+        Returns the names of all ledgers in the store
+        """
+        with self.__lock:
+            return [name for name, in self.__connection.execute(
+                "SELECT name FROM ledgers ORDER BY id")]
+
+    def getNumTransactions(self, ledgerName):
+        """
+        Returns the number of transactions recorded in a ledger
+
+        @raise KeyError: if the ledger doesn't exist
+        """
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT num_transactions FROM ledgers WHERE id = ?",
+                (self.__getLedgerId(ledgerName),)).fetchone()[0]
+
+    def getBalance(self, ledgerName, name):
+        """
+        Returns the materialized net balance of a person (0 if unknown)
+        """
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT balance FROM people WHERE ledger_id = ? AND name = ?",
+                (self.__getLedgerId(ledgerName), name)).fetchone()
+        return 0 if row is None else row[0]
+
+    def __readPeople(self, ledgerId):
+        """
+        Returns (names, balances, row id -> index) of a ledger's people
+        """
+        names = []
+        balances = array('q' if self.__exact else 'd')
+        index = {}
+        for personId, name, balance in self.__connection.execute(
+                "SELECT id, name, balance FROM people WHERE ledger_id = ? ORDER BY id",
+                (ledgerId,)):
+            index[personId] = len(names)
+            names.append(name)
+            balances.append(balance)
+        return names, balances, index
+
+    def toBalanceTable(self, ledgerName):
+        """
+        Reads a ledger's materialized balances and components
+
+        Components come from the pair table, so no raw transaction is read.
+
+        @return: BalanceTable, ready for settleBalanceColumns()
+        @raise KeyError: if the ledger doesn't exist
+        """
+        with self.__lock:
+            ledgerId = self.__getLedgerId(ledgerName)
+            names, balances, index = self.__readPeople(ledgerId)
+            components = DisjointSet(len(names))
+            for payerId, debtorId in self.__connection.execute(
+                    "SELECT payer_id, debtor_id FROM pairs WHERE ledger_id = ?",
+                    (ledgerId,)):
+                components.union(index[payerId], index[debtorId])
+            numTransactions = self.__connection.execute(
+                "SELECT num_transactions FROM ledgers WHERE id = ?",
+                (ledgerId,)).fetchone()[0]
+        return BalanceTable(names, balances, components.componentIds(),
+                            numTransactions)
+
+    def toPeople(self, ledgerName):
+        """
+        Builds PersonNode objects from a ledger's materialized pair totals
+
+        @return: list[PersonNode]. Same contract as Ledger.toPeople(), so
+                 the result can go through splitUpGroups()/simplifyDebts2()
+        """
+        with self.__lock:
+            ledgerId = self.__getLedgerId(ledgerName)
+            names, _, index = self.__readPeople(ledgerId)
+            people = [PersonNode(name) for name in names]
+            for payerId, debtorId, amount in self.__connection.execute(
+                    "SELECT payer_id, debtor_id, amount FROM pairs "
+                    "WHERE ledger_id = ? ORDER BY rowid", (ledgerId,)):
+                people[index[payerId]].addDebt(people[index[debtorId]], amount)
+        return people
+
+    def settle(self, ledgerName, maxWorkers=None):
+        """
+        Simplifies a ledger from its materialized balances
+
+        @return: list of PersonNode objects representing simplified transactions
+        """
+        return settleBalanceTable(self.toBalanceTable(ledgerName), maxWorkers)
+
+    def toLedger(self, ledgerName):
+        """
+        Rebuilds an in-memory Ledger from a ledger's raw transactions
+
+        @return: Ledger holding every transaction in insertion order
+        """
+        moneyType = 'q' if self.__exact else 'd'
+        ledger = Ledger(self.__exact)
+        with self.__lock:
+            cursor = self.__connection.execute(
+                "SELECT payer.name, debtor.name, transactions.amount "
+                "FROM transactions "
+                "JOIN people AS payer ON payer.id = transactions.payer_id "
+                "JOIN people AS debtor ON debtor.id = transactions.debtor_id "
+                "WHERE transactions.ledger_id = ? ORDER BY transactions.id",
+                (self.__getLedgerId(ledgerName),))
+            while True:
+                rows = cursor.fetchmany(PARSE_BATCH_ROWS)
+                if not rows:
+                    break
+                payers, debtors, amounts = zip(*rows)
+                ledger.addTransactions(list(payers), list(debtors),
+                                       array(moneyType, amounts))
+        return ledger
+
+    def verifyLedger(self, ledgerName, repair=False):
+        """
+        Checks the materialized tables against a rebuild from the raw rows
+
+        @param repair: bool. If anything differs, recompute the balances,
+                       pair totals and transaction count from the raw rows
+        @return: list of str. Every difference found (empty if consistent)
+        """
+        with self.__lock:
+            ledger = self.toLedger(ledgerName)
+            table = self.toBalanceTable(ledgerName)
+            storedPairs = {(payer, debtor): (amount, count)
+                           for payer, debtor, amount, count in self.__connection.execute(
+                "SELECT payer.name, debtor.name, pairs.amount, pairs.count FROM pairs "
+                "JOIN people AS payer ON payer.id = pairs.payer_id "
+                "JOIN people AS debtor ON debtor.id = pairs.debtor_id "
+                "WHERE pairs.ledger_id = ?", (self.__getLedgerId(ledgerName),))}
+
+            problems = []
+            if table.numTransactions != ledger.getNumTransactions():
+                problems.append("{0} transactions recorded, {1} stored".format(
+                    table.numTransactions, ledger.getNumTransactions()))
+
+            rebuiltBalances = dict(zip(ledger.getNames(), ledger.getBalances()))
+            for name, balance in zip(table.names, table.balances):
+                rebuilt = rebuiltBalances.get(name, 0)
+                if not self.__same(balance, rebuilt):
+                    problems.append("balance of {0} is {1}, rebuilt {2}".format(
+                        name, balance, rebuilt))
+
+            names = ledger.getNames()
+            rebuiltPairs = {(names[payerId], names[debtorId]): (amount, count)
+                            for payerId, debtorId, amount, count
+                            in zip(*ledger.getPairEdges())}
+            for pair in storedPairs.keys() | rebuiltPairs.keys():
+                stored = storedPairs.get(pair, (0, 0))
+                rebuilt = rebuiltPairs.get(pair, (0, 0))
+                if stored[1] != rebuilt[1] or not self.__same(stored[0], rebuilt[0]):
+                    problems.append("{0} paid {1} for {2} in {3} rows, rebuilt {4} in {5}"
+                                    .format(pair[0], stored[0], pair[1], stored[1],
+                                            rebuilt[0], rebuilt[1]))
+
+            if problems and repair:
+                self.__rebuild(ledgerName)
+            return problems
+
+    def __same(self, stored, rebuilt):
+        """
+        Compares a materialized amount to a rebuilt one
+        """
+        if self.__exact:
+            return stored == rebuilt
+        return math.isclose(stored, rebuilt, abs_tol=VERIFY_TOLERANCE)
+
+    def __rebuild(self, ledgerName):
+        """
+        Recomputes a ledger's materialized tables from its raw transactions
+        """
+        with self.__writing() as connection:
+            ledgerId = self.__getLedgerId(ledgerName)
+            connection.execute(
+                "UPDATE people SET balance = "
+                "(SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE payer_id = people.id) - "
+                "(SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE debtor_id = people.id) "
+                "WHERE ledger_id = ?", (ledgerId,))
+            connection.execute("DELETE FROM pairs WHERE ledger_id = ?", (ledgerId,))
+            connection.execute(
+                "INSERT INTO pairs (payer_id, debtor_id, ledger_id, amount, count) "
+                "SELECT payer_id, debtor_id, ledger_id, SUM(amount), COUNT(*) "
+                "FROM transactions WHERE ledger_id = ? "
+                "GROUP BY payer_id, debtor_id ORDER BY MIN(id)", (ledgerId,))
+            connection.execute(
+                "UPDATE ledgers SET num_transactions = "
+                "(SELECT COUNT(*) FROM transactions WHERE ledger_id = ledgers.id) "
+                "WHERE id = ?", (ledgerId,))
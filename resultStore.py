@@ -0,0 +1,134 @@
+"""
+Disk-backed store of settled results for the paged /results endpoints
+
+The result cache in app.py is an LRU keyed by ledger digest: a result
+bigger than its budget is never cached, and other uploads can push a
+result out while someone is still paging through it. A ResultStore gives
+the results page storage of its own. Every result is spilled to a file
+in a directory once, and read back whenever the cache no longer has it,
+so a results page keeps working for as long as its file is kept.
+
+Results already in the directory are picked up when a store is opened,
+and ones written by another process are found on lookup, so a store
+directory can be shared between worker processes and outlives restarts.
+"""
+
+import atexit
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+
+# Default disk budget of a ResultStore
+RESULT_STORE_BYTES = 1024 * 1024 * 1024
+
+# Result ids are ledger digests (see splitUp.transactionDigest); nothing
+# else is ever turned into a file name
+RESULT_ID_PATTERN = re.compile(r'[0-9a-z-]+')
+
+class ResultStore():
+    """
+    Thread-safe store of pickled results in one directory, with a disk budget.
+
+    Once the files go over maxBytes the least recently read or written ones
+    are deleted, so a result only goes away after maxBytes of newer results
+    have been stored.
+    """
+    def __init__(self, directory=None, maxBytes=RESULT_STORE_BYTES):
+        """
+        @param directory: str or None. Where to keep the files (None = a new
+                          temporary directory, removed when the process exits)
+        @param maxBytes: int. Disk budget of all files together
+        """
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='splitup-results-')
+            atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+        self.__maxBytes = maxBytes
+        self.__lock = threading.Lock()
+        # result id -> file size, least recently used first
+        self.__sizes = {}
+
+        # Index the results already stored, oldest first
+        stored = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                resultId, extension = os.path.splitext(entry.name)
+                if extension == '.pickle' and RESULT_ID_PATTERN.fullmatch(resultId):
+                    stat = entry.stat()
+                    stored.append((stat.st_mtime, resultId, stat.st_size))
+        for _, resultId, size in sorted(stored):
+            self.__sizes[resultId] = size
+
+    def __path(self, resultId):
+        """
+        Returns the file holding a result, or None for an invalid id
+        """
+        if not RESULT_ID_PATTERN.fullmatch(resultId):
+            return None
+        return os.path.join(self.__directory, resultId + '.pickle')
+
+    def put(self, resultId, result):
+        """
+        Stores a result, unless one is already stored under resultId
+
+        @param resultId: str. Ledger digest the result belongs to
+        @param result: picklable value, e.g. a SettledLedger
+        @raise ValueError: if resultId is not a digest
+        """
+        path = self.__path(resultId)
+        if path is None:
+            raise ValueError("invalid result id {0!r}".format(resultId))
+        with self.__lock:
+            if resultId in self.__sizes:
+                self.__sizes[resultId] = self.__sizes.pop(resultId)
+                return
+
+        # Written to a temporary name first, so readers never see half a file
+        handle, partPath = tempfile.mkstemp(dir=self.__directory, suffix='.part')
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.replace(partPath, path)
+
+        with self.__lock:
+            self.__sizes.pop(resultId, None)
+            self.__sizes[resultId] = size
+            total = sum(self.__sizes.values())
+            while total > self.__maxBytes and len(self.__sizes) > 1:
+                oldId = next(iter(self.__sizes))
+                total -= self.__sizes.pop(oldId)
+                try:
+                    os.remove(self.__path(oldId))
+                except FileNotFoundError:
+                    pass  # Already evicted by another process
+
+    def get(self, resultId):
+        """
+        Returns the result stored under resultId, or None if there is none
+        """
+        path = self.__path(resultId)
+        if path is None:
+            return None
+        with self.__lock:
+            # Opened under the lock: an open file stays readable even if
+            # it is evicted while it is being unpickled
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                # Never stored, or evicted by another process sharing the directory
+                self.__sizes.pop(resultId, None)
+                return None
+            size = self.__sizes.pop(resultId, None)
+            self.__sizes[resultId] = os.fstat(f.fileno()).st_size if size is None else size
+        with f:
+            return pickle.load(f)
+
+    def __len__(self):
+        """
+        Returns the number of stored results
+        """
+        return len(self.__sizes)
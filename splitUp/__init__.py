@@ -0,0 +1,112 @@
+"""
+splitUp: settles group debts with as few payments as possible
+
+The package is split so that importing it costs next to nothing: every
+name below is loaded from its submodule the first time it is used, so a
+worker that only needs Ledger and settleBalanceTable never imports the
+command line, the JSON readers or the exporters, and NumPy is only
+imported once a group is big enough for the vectorized engine.
+
+    ledger       people, balances and the Ledger itself
+    currency     exchange rate tables and conversion
+    parsing      csv uploads, streaming and memory-mapped parsing
+    cache        ledger digests and the settlement result cache
+    settlement   greedy, optimal and parallel settlement
+    vectorized   the optional NumPy engine
+    session      incrementally updated ledgers
+    snapshot     binary, memory-mapped ledger snapshots
+    exporters    csv, NDJSON, columnar JSON and gzip writers
+    jsonio       JSON and NDJSON transaction readers
+    distributed  settlement sharded over worker nodes
+    cli          the batch command line (python -m splitUp)
+"""
+
+import importlib
+
+# Public names of each submodule
+SUBMODULE_EXPORTS = {
+    'ledger': (
+        'Transaction', 'BalanceTable', 'MINOR_UNITS', 'MAX_MINOR_UNITS',
+        'SETTLEMENT_EPSILON', 'LedgerParseError', 'parseCents',
+        'parseFloatAmount', 'centsToAmount', 'columnType', 'isExact',
+        'plainNumber', 'checkZeroSum',
+        'PersonNode', 'DisjointSet', 'Ledger', 'aggregatePairs',
+        'splitUpGroups', 'groupsFromComponents',
+        'prettyPrintAllPeople', 'printTransactions'),
+    'currency': (
+        'RateTable', 'rateTableCache', 'rateTableLock',
+        'parseRateTable', 'loadRateTable', 'convertCurrencies'),
+    'parsing': (
+        'IngestResult', 'MAPPED_RANGE_BYTES', 'PARSE_BATCH_ROWS',
+        'UPLOAD_CHUNK_SIZE', 'readData', 'iterUploadLines',
+        'iterTransactionBatches', 'iterTransactionRows',
+        'readBalancesFromUpload', 'readLedgerFromUpload',
+        'ingestUpload', 'iterMappedLines', 'splitLineRanges',
+        'countLines', 'BalanceAccumulator', 'readMappedRange',
+        'readBalancesMapped', 'readDataFromUpload'),
+    'cache': (
+        'RESULT_CACHE_BYTES', 'TransactionDigest', 'transactionDigest',
+        'digestUpload', 'estimateSize', 'SettlementCache'),
+    'settlement': (
+        'VECTORIZE_MIN_PEOPLE', 'OPTIMAL_MAX_PEOPLE',
+        'OPTIMAL_TIME_BUDGET', 'OPTIMAL_VECTORIZE_PEOPLE',
+        'OPTIMAL_PYTHON_STEPS_PER_SECOND', 'OPTIMAL_NUMPY_STEPS_PER_SECOND',
+        'PARALLEL_BATCH_PEOPLE', 'PARALLEL_MIN_PEOPLE',
+        'simplifyBalances', 'zeroSumPartition', 'estimatePartitionSeconds',
+        'simplifyBalancesOptimal', 'settleBalances',
+        'settleBalanceBatch', 'groupBalances', 'peopleFromSettlement',
+        'settleGroups', 'settlePayloads', 'settleBalanceColumns',
+        'settleBalanceTable', 'simplifyDebts2'),
+    'snapshot': (
+        'SNAPSHOT_MAGIC', 'SNAPSHOT_VERSION', 'SNAPSHOT_SUFFIX',
+        'SnapshotError', 'NameTable', 'writeSnapshot', 'isSnapshot',
+        'LedgerSnapshot', 'readSnapshot'),
+    'vectorized': (
+        'np', 'loadNumpy', 'simplifyDebtsVectorized'),
+    'session': (
+        'LedgerSession',),
+    'distributed': (
+        'DISTRIBUTED_SHARD_PEOPLE', 'WORKER_TIMEOUT', 'WORKER_MAX_ATTEMPTS',
+        'WORKER_HEARTBEAT_SECONDS', 'DEFAULT_WORKER_PORT', 'ProtocolError',
+        'DistributedError', 'packShards', 'assignShards', 'encodeShard', 'decodeShard',
+        'encodeResults', 'decodeResults', 'ShardScheduler',
+        'settleDistributed', 'WorkerServer', 'serveWorker',
+        'startLocalWorkers', 'stopLocalWorkers', 'parseNodes'),
+    'exporters': (
+        'MAX_REPORTED_PARSE_ERRORS', 'EXPORT_CHUNK_ROWS',
+        'EXPORT_ERROR_MARKER', 'writeSettlement', 'iterCsvChunks', 'gzipChunks',
+        'iterSettlementNdjson', 'iterSettlementColumnar'),
+    'jsonio': (
+        'parseManualTransaction', 'manualCurrency',
+        'readLedgerFromNdjson', 'NUMBER_END', 'JsonStreamReader',
+        'iterJsonArray', 'iterNdjson'),
+    'cli': (
+        'SETTLEMENT_SUFFIX', 'OUTPUT_FORMATS', 'SETTLEMENT_ENDINGS',
+        'expandInputs', 'outputStem', 'settlementPath', 'snapshotOutputPath',
+        'settleLedgerFile', 'formatThroughput', 'main'),
+}
+
+# Public name -> submodule defining it
+exportModules = {name: module for module, names in SUBMODULE_EXPORTS.items()
+                 for name in names}
+
+__all__ = sorted(exportModules)
+
+def __getattr__(name):
+    """
+    Imports the submodule defining name on first access (PEP 562)
+
+    The value is then stored on the package, so later lookups are plain
+    attribute reads that never come back here.
+    """
+    module = exportModules.get(name)
+    if module is None:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+    submodule = importlib.import_module('.' + module, __name__)
+    # np is only bound once loadNumpy() has tried to import NumPy
+    value = submodule.loadNumpy() if name == 'np' else getattr(submodule, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(exportModules))
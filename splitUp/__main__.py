@@ -0,0 +1,9 @@
+"""
+Runs the batch command line: python -m splitUp ledgers/*.csv
+"""
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
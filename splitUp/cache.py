@@ -0,0 +1,194 @@
+"""
+Order-independent digests of ledgers and the settlement result cache
+"""
+
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+from .parsing import UPLOAD_CHUNK_SIZE, iterTransactionRows, iterUploadLines
+
+# Default memory budget of a SettlementCache
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
+
+class TransactionDigest():
+    """
+    Running, order-independent digest of a multiset of transactions.
+
+    Each normalized (payer, debtor, amount) row is hashed on its own and the
+    row hashes are added up, so the digest can be computed batch by batch
+    while streaming and re-ordered copies of the same ledger get the same
+    key. Pass one to readLedgerFromUpload() to digest an upload in the same
+    pass that parses it.
+
+    The rows a lenient parse skipped can be added as well (see
+    updateErrors), so uploads that settle the same but report different
+    malformed rows get different keys.
+    """
+    def __init__(self, exact=False):
+        self.__exact = exact
+        self.__total = 0
+        self.__count = 0
+        self.__errors = None
+
+    def update(self, rows):
+        """
+        Adds transactions to the digest
+
+        @param rows: iterable of (payer, debtor, amount) tuples
+        """
+        total = self.__total
+        count = self.__count
+        for payer, debtor, amount in rows:
+            row = "{0}\x1f{1}\x1f{2!r}".format(payer, debtor, amount)
+            rowHash = hashlib.blake2b(row.encode('utf-8'), digest_size=16).digest()
+            total += int.from_bytes(rowHash, 'little')
+            count += 1
+        self.__total = total
+        self.__count = count
+
+    def updateErrors(self, errors):
+        """
+        Adds the errors of skipped rows to the digest, in the order given
+
+        @param errors: iterable of LedgerParseError
+        """
+        for error in errors:
+            if self.__errors is None:
+                self.__errors = hashlib.blake2b(digest_size=8)
+            self.__errors.update(str(error).encode('utf-8') + b'\n')
+
+    def hexdigest(self):
+        """
+        Returns the digest of every transaction (and error) added so far
+
+        @return: str. Digest usable as a SettlementCache key
+        """
+        digest = "{0}{1}-{2:032x}".format('x' if self.__exact else 'f', self.__count,
+                                          self.__total % (1 << 128))
+        if self.__errors is not None:
+            digest += '-' + self.__errors.hexdigest()
+        return digest
+
+def transactionDigest(rows, exact=False):
+    """
+    Hashes a multiset of transactions, independent of row order
+
+    @param rows: iterable of (payer, debtor, amount) tuples
+    @param exact: bool. Whether amounts are integer minor units
+    @return: str. Digest usable as a SettlementCache key (see TransactionDigest)
+    """
+    digest = TransactionDigest(exact)
+    digest.update(rows)
+    return digest.hexdigest()
+
+def digestUpload(file_stream, exact=False, chunkSize=UPLOAD_CHUNK_SIZE,
+                 strict=True, rates=None):
+    """
+    Computes the transactionDigest() of an uploaded file by streaming it
+
+    @param file_stream: file-like object from Flask file upload
+    @param exact: bool. Parse amounts as int minor units (see parseCents)
+    @param chunkSize: int. Number of bytes read from the stream at a time
+    @param strict: bool. Raise LedgerParseError on malformed rows instead
+                   of leaving them out of the digest
+    @param rates: RateTable or None. Digest the converted amounts, so a
+                  changed rate table gives a different key
+    @return: str. Digest usable as a SettlementCache key
+    """
+    return transactionDigest(
+        iterTransactionRows(iterUploadLines(file_stream, chunkSize), exact,
+                            strict, rates=rates),
+        exact)
+
+def estimateSize(value):
+    """
+    Roughly estimates the memory used by a value and everything it contains
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimateSize(k) + estimateSize(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(estimateSize(item) for item in value)
+    return size
+
+class SettlementCache():
+    """
+    Thread-safe LRU cache of settlement results with a memory budget.
+
+    Keys are transactionDigest() values, so identical ledgers (uploaded or
+    entered manually, in any row order) skip parsing into PersonNodes,
+    grouping and simplifying. The least recently used results are evicted
+    once the estimated size of all entries goes over the budget.
+    """
+    def __init__(self, maxBytes=RESULT_CACHE_BYTES):
+        self.__maxBytes = maxBytes
+        self.__entries = OrderedDict()
+        self.__currentBytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns the number of cached results
+        """
+        return len(self.__entries)
+
+    def get(self, key):
+        """
+        Returns the cached result for key, or None on a miss
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """
+        Caches value under key, evicting least recently used results
+
+        @param size: int or None. Size of value in bytes (None = estimate it)
+        @return: bool. False if value alone is bigger than the whole budget
+        """
+        if size is None:
+            size = estimateSize(value)
+        if size > self.__maxBytes:
+            return False
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__currentBytes -= self.__entries.pop(key)[1]
+            while self.__currentBytes + size > self.__maxBytes:
+                _, (_, evictedSize) = self.__entries.popitem(last=False)
+                self.__currentBytes -= evictedSize
+            self.__entries[key] = (value, size)
+            self.__currentBytes += size
+        return True
+
+    def clear(self):
+        """
+        Drops every cached result (the hit/miss counters are kept)
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.__currentBytes = 0
+
+    def getStats(self):
+        """
+        Returns hit/miss counters and memory use as a dict
+        """
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'entries': len(self.__entries),
+                'bytes': self.__currentBytes,
+                'max_bytes': self.__maxBytes
+            }
@@ -0,0 +1,267 @@
+"""
+Headless batch command line: python -m splitUp ledgers/*.csv
+
+Inputs are ledger csvs or binary snapshots of them (see splitUp.snapshot),
+which load without being parsed again.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .currency import loadRateTable
+from .distributed import parseNodes
+from .exporters import writeSettlement
+from .ledger import LedgerParseError
+from .parsing import readBalancesMapped, readLedgerFromUpload
+from .settlement import settleBalanceColumns
+from .snapshot import SNAPSHOT_SUFFIX, isSnapshot, readSnapshot, writeSnapshot
+
+# Suffix of the files the command-line batch run writes its settlements to,
+# before the extension of the output format. Glob patterns skip files
+# ending in one of them, so re-runs don't settle settlements.
+SETTLEMENT_SUFFIX = '.settlement'
+OUTPUT_FORMATS = ('csv', 'ndjson')
+SETTLEMENT_ENDINGS = tuple(SETTLEMENT_SUFFIX + '.' + outputFormat
+                           for outputFormat in OUTPUT_FORMATS)
+
+def expandInputs(patterns):
+    """
+    Expands command-line inputs into a list of csv or snapshot paths
+
+    @param patterns: list of str. File paths, glob patterns ('**' recurses)
+                     or '-' for stdin
+    @return: tuple (paths, missing). Paths in argument order without
+             duplicates, and the patterns that matched nothing
+    """
+    paths = {}
+    missing = []
+    for pattern in patterns:
+        if pattern == '-' or not glob.has_magic(pattern):
+            matches = [pattern] if pattern == '-' or os.path.isfile(pattern) else []
+        else:
+            matches = [path for path in sorted(glob.glob(pattern, recursive=True))
+                       if os.path.isfile(path) and
+                       not path.endswith(SETTLEMENT_ENDINGS)]
+        if not matches:
+            missing.append(pattern)
+        paths.update(dict.fromkeys(matches))
+    return list(paths), missing
+
+def outputStem(inputPath, outputDir):
+    """
+    Returns the path, without extension, of the files written for one input
+
+    @param outputDir: str or None. Directory for all outputs (None = next
+                      to each input)
+    """
+    stem = 'stdin' if inputPath == '-' else \
+        os.path.splitext(os.path.basename(inputPath))[0]
+    directory = outputDir if outputDir is not None else os.path.dirname(inputPath)
+    return os.path.join(directory, stem)
+
+def settlementPath(inputPath, outputDir, outputFormat):
+    """
+    Returns where the settlement of one input file is written
+    """
+    return outputStem(inputPath, outputDir) + SETTLEMENT_SUFFIX + '.' + outputFormat
+
+def snapshotOutputPath(inputPath, outputDir):
+    """
+    Returns where the snapshot of one input file is written (--snapshot)
+    """
+    return outputStem(inputPath, outputDir) + SNAPSHOT_SUFFIX
+
+def settleLedgerFile(inputPath, outputPath, outputFormat='csv', exact=False,
+                     strict=True, rates=None, snapshotPath=None, nodes=None,
+                     maxWorkers=1):
+    """
+    Settles one ledger csv and writes its payments (one batch run job)
+
+    A snapshot input is settled straight from its mapped columns; exact,
+    strict and rates only apply to csvs.
+
+    @param inputPath: str. csv file or snapshot, or '-' to read a csv from stdin
+    @param outputPath: str. Settlement file, or '-' to write stdout
+    @param outputFormat: str. 'csv' or 'ndjson' (see writeSettlement)
+    @param exact: bool. Settle in int minor units (see parseCents)
+    @param strict: bool. Fail on the first malformed row instead of
+                   skipping it (see iterTransactionBatches)
+    @param rates: RateTable or None. Convert a currency column to the base
+                  currency (see iterTransactionBatches)
+    @param snapshotPath: str or None. Also save the parsed csv as a snapshot
+                         here (balances only, unless it was read from stdin)
+    @param nodes: list of (host, port) or None. Settle the groups on these
+                  worker nodes (see splitUp.distributed)
+    @param maxWorkers: int or None. Processes parsing the file and settling
+                       its groups (1 when this already runs in a pool)
+    @return: dict of throughput statistics for the file
+    @raise LedgerParseError: on a malformed row in strict mode
+    """
+    start = time.perf_counter()
+    parseErrors = []
+    snapshot = None
+    if inputPath == '-':
+        ledger, _ = readLedgerFromUpload(sys.stdin.buffer, keepOriginal=False,
+                                         exact=exact, strict=strict,
+                                         errors=parseErrors, rates=rates)
+        table = ledger.toBalanceTable()
+        edges = ledger.getEdges()
+        inputBytes = None
+    elif isSnapshot(inputPath):
+        snapshot = readSnapshot(inputPath)
+        table = snapshot.toBalanceTable()
+        inputBytes = os.path.getsize(inputPath)
+    else:
+        table = readBalancesMapped(inputPath, maxWorkers, exact, strict,
+                                   parseErrors, rates=rates)
+        # The mapped reader keeps no rows, so only balances are saved
+        edges = None
+        inputBytes = os.path.getsize(inputPath)
+
+    try:
+        if snapshotPath is not None and snapshot is None:
+            writeSnapshot(snapshotPath, table, edges)
+        settlement = settleBalanceColumns(table, maxWorkers, nodes)
+
+        if outputPath == '-':
+            writeSettlement(sys.stdout, table, settlement, outputFormat, parseErrors)
+            sys.stdout.flush()
+        else:
+            with open(outputPath, 'w', newline='', encoding='utf-8') as output:
+                writeSettlement(output, table, settlement, outputFormat, parseErrors)
+
+        return {'input': inputPath, 'output': outputPath,
+                'rows': table.numTransactions, 'bytes': inputBytes,
+                'people': len(table.names), 'payments': len(settlement[2]),
+                'skipped_rows': len(parseErrors),
+                'seconds': time.perf_counter() - start}
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+
+def formatThroughput(stats):
+    """
+    Formats one file's statistics as a line of the batch run report
+    """
+    seconds = max(stats['seconds'], 1e-9)
+    line = "{0}: {1} rows, {2} people -> {3} payments in {4:.3f}s ({5:,.0f} rows/s".format(
+        stats['input'], stats['rows'], stats['people'], stats['payments'],
+        stats['seconds'], stats['rows'] / seconds)
+    if stats['bytes'] is not None:
+        line += ", {0:.1f} MB/s".format(stats['bytes'] / seconds / 1e6)
+    line += ")"
+    if stats['skipped_rows']:
+        line += ", skipped {0} malformed rows".format(stats['skipped_rows'])
+    return line
+
+def main(argv=None):
+    """
+    Command-line entry point: settles many ledger csvs in one batch run
+
+    Every input file is settled independently on a process pool and its
+    payments are written to <name>.settlement.csv (or .ndjson). With
+    --snapshot each csv is also saved as <name>.snapshot, which later runs
+    can take as input to skip parsing. A line of
+    throughput statistics is printed to stderr for each file as it
+    finishes, then a total. Nothing is interactive, so it can run from cron.
+
+    Usage: python -m splitUp 'ledgers/**/*.csv' --output-dir settled/
+           python -m splitUp - --format ndjson < ledger.csv
+           python -m splitUp big.csv --snapshot && python -m splitUp big.snapshot
+           python -m splitUp big.csv --nodes 10.0.0.5:7070,10.0.0.6:7070
+
+    @param argv: list of str or None. Arguments (None = sys.argv[1:])
+    @return: int. Exit status: 0 if every file was settled, 1 otherwise
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m splitUp',
+        description="Settle ledger csvs (payer,debtor,amount rows) in a batch")
+    parser.add_argument('inputs', nargs='+',
+                        help="csv or snapshot files or glob patterns; '-' reads stdin")
+    parser.add_argument('--output-dir', '-o',
+                        help="directory for the settlement files (default: "
+                             "next to each input; stdout for '-')")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv',
+                        dest='outputFormat')
+    parser.add_argument('--workers', '-j', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--exact', action='store_true',
+                        help='settle in integer cents')
+    parser.add_argument('--rates',
+                        help='currency,rate csv; ledger rows may then have a '
+                             'fourth currency column')
+    parser.add_argument('--lenient', action='store_true',
+                        help='skip malformed rows instead of failing the file')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='also save each csv as a binary <name>.snapshot '
+                             'that later runs can load without parsing')
+    parser.add_argument('--nodes', type=parseNodes, metavar='HOST:PORT,...',
+                        help='settle groups on these worker nodes (start them '
+                             'with python -m splitUp.distributed)')
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help='only report failures and the total')
+    args = parser.parse_args(argv)
+
+    try:
+        rates = None if args.rates is None else loadRateTable(args.rates)
+    except (LedgerParseError, OSError) as e:
+        print("{0}: {1}".format(args.rates, e), file=sys.stderr)
+        return 1
+
+    paths, missing = expandInputs(args.inputs)
+    for pattern in missing:
+        print("{0}: no such file".format(pattern), file=sys.stderr)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = [(path, '-' if path == '-' and args.output_dir is None else
+             settlementPath(path, args.output_dir, args.outputFormat),
+             args.outputFormat, args.exact, not args.lenient, rates,
+             snapshotOutputPath(path, args.output_dir) if args.snapshot else None,
+             args.nodes)
+            for path in paths]
+    # stdin can't be handed to another process, so it's settled here
+    localJobs = [job for job in jobs if job[0] == '-']
+    fileJobs = [job for job in jobs if job[0] != '-']
+
+    start = time.perf_counter()
+    results = []
+    failures = len(missing)
+
+    def report(path, finish):
+        nonlocal failures
+        try:
+            stats = finish()
+        except Exception as e:
+            # One bad ledger mustn't stop the rest of the batch
+            failures += 1
+            print("{0}: {1}".format(path, e), file=sys.stderr)
+            return
+        results.append(stats)
+        if not args.quiet:
+            print(formatThroughput(stats), file=sys.stderr)
+
+    for job in localJobs:
+        report(job[0], lambda: settleLedgerFile(*job, maxWorkers=args.workers))
+    if len(fileJobs) == 1 or args.workers == 1:
+        # One file: parallelize within it (parsing ranges, settling groups)
+        for job in fileJobs:
+            report(job[0], lambda: settleLedgerFile(*job, maxWorkers=args.workers))
+    elif fileJobs:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(settleLedgerFile, *job): job[0] for job in fileJobs}
+            for future in as_completed(futures):
+                report(futures[future], future.result)
+
+    seconds = time.perf_counter() - start
+    rows = sum(stats['rows'] for stats in results)
+    print("Settled {0} ledgers ({1} failed): {2} rows -> {3} payments in {4:.3f}s "
+          "({5:,.0f} rows/s)".format(len(results), failures, rows,
+                                     sum(stats['payments'] for stats in results),
+                                     seconds, rows / max(seconds, 1e-9)),
+          file=sys.stderr)
+    return 1 if failures else 0
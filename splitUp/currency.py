@@ -0,0 +1,136 @@
+"""
+Exchange rate tables and batched conversion of amounts to a base currency
+"""
+
+import csv
+import os
+import threading
+from array import array
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from .ledger import LedgerParseError
+from .vectorized import loadNumpy
+
+# Exchange rates read from a currency,rate file (see loadRateTable). rates
+# maps a currency code to the value of one unit of it in the base currency,
+# and ratios holds the same rates as exact (numerator, denominator) pairs for
+# exact mode. Rows without a currency ('') are already in the base currency.
+RateTable = namedtuple('RateTable', ['rates', 'ratios'])
+
+# Parsed rate tables by absolute path, with the (mtime, size) of the file
+# they were read from (see loadRateTable)
+rateTableCache = {}
+
+rateTableLock = threading.Lock()
+
+def parseRateTable(lines):
+    """
+    Parses currency,rate rows into a RateTable
+
+    Each rate is the value of one unit of the currency in the base
+    currency (e.g. "EUR,1.08" with USD as the base). Blank lines and lines
+    starting with '#' are skipped, and currency codes are case-insensitive.
+
+    @param lines: iterable of str. Lines of a rate table csv
+    @return: RateTable
+    @raise LedgerParseError: on a malformed row
+    """
+    rates = {'': 1.0}
+    ratios = {'': (1, 1)}
+    reader = csv.reader(lines, skipinitialspace=True)
+    for row in reader:
+        if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+            continue
+        if len(row) != 2:
+            raise LedgerParseError(reader.line_num,
+                "expected currency,rate but got {0} fields".format(len(row)))
+        try:
+            rate = Decimal(row[1].strip())
+        except InvalidOperation:
+            rate = None
+        if rate is None or not rate.is_finite() or rate <= 0:
+            raise LedgerParseError(reader.line_num,
+                                   "invalid exchange rate {0!r}".format(row[1]))
+        code = row[0].strip().upper()
+        rates[code] = float(rate)
+        ratios[code] = rate.as_integer_ratio()
+    return RateTable(rates, ratios)
+
+def loadRateTable(path):
+    """
+    Reads a rate table file, reusing the parsed table until the file changes
+
+    The file's modification time and size are checked on every call, so an
+    updated rate table is picked up without restarting anything.
+
+    @param path: str. Path to a currency,rate csv (see parseRateTable)
+    @return: RateTable
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with rateTableLock:
+        cached = rateTableCache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+    with open(path, newline='', encoding='utf-8') as ratefile:
+        rateTable = parseRateTable(ratefile)
+    with rateTableLock:
+        rateTableCache[path] = (stamp, rateTable)
+    return rateTable
+
+def convertCurrencies(amounts, currencies, rates):
+    """
+    Converts one batch of amounts to the base currency of a rate table
+
+    Each currency in the batch is looked up in the table once, never per
+    row. A batch in one currency is scaled with a single map() call. A mixed
+    batch is factorized into its distinct codes and their rates, then the
+    amount column is multiplied by the gathered rates in one pass: in place
+    by NumPy (a code index per row into a rate vector) when it is available
+    for floats, otherwise by one array comprehension. Exact amounts are
+    rounded to the nearest minor unit (halves round up).
+
+    @param amounts: array('d'), or array('q') of minor units
+    @param currencies: list of str. Currency code of every amount ('' = base)
+    @param rates: RateTable holding every code in currencies
+    @return: array of converted amounts (may be amounts itself)
+    """
+    exact = amounts.typecode == 'q'
+    codes = set(currencies)
+    if not codes:
+        return amounts
+
+    if len(codes) == 1:
+        code = codes.pop()
+        if exact:
+            numerator, denominator = rates.ratios[code]
+            if numerator == denominator:
+                return amounts
+            return array('q', [(2 * cents * numerator + denominator) // (2 * denominator)
+                               for cents in amounts])
+        rate = rates.rates[code]
+        return amounts if rate == 1.0 else array('d', map(rate.__mul__, amounts))
+
+    # Factorize the batch once: the distinct codes, in a fixed order, and
+    # the rate of each; rows then only pick from that short table
+    codes = list(codes)
+    if exact:
+        ratios = {code: rates.ratios[code] for code in codes}
+        return array('q', [(2 * cents * ratios[code][0] + ratios[code][1])
+                           // (2 * ratios[code][1])
+                           for cents, code in zip(amounts, currencies)])
+    np = loadNumpy()
+    if np is None:
+        scales = {code: rates.rates[code] for code in codes}
+        return array('d', [amount * scales[code]
+                           for amount, code in zip(amounts, currencies)])
+    # A code index per row and a rate vector, gathered and multiplied in C
+    codeIndex = {code: i for i, code in enumerate(codes)}
+    rows = np.fromiter(map(codeIndex.__getitem__, currencies), np.intp, len(currencies))
+    scales = np.array([rates.rates[code] for code in codes])
+    # A view of the array's own buffer, so this converts it in place
+    np.frombuffer(amounts, dtype=np.float64)[:] *= scales[rows]
+    return amounts
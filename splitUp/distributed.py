@@ -0,0 +1,638 @@
+"""
+Distributed settlement: a coordinator shards groups across worker nodes
+
+Groups never share people, so they can be settled on different machines.
+The coordinator bin-packs groups into shards of about shardPeople people,
+hands the shards out to workers (largest first, to the least loaded
+worker) and collects each shard's payments as soon as it is settled.
+Idle workers take queued shards from busy ones. While a worker settles a
+shard it sends a heartbeat frame every WORKER_HEARTBEAT_SECONDS, so a
+big shard may take as long as it needs; only a worker that cannot be
+reached, stays silent for WORKER_TIMEOUT or drops its connection is
+retired, and its shards go to the others. Shards left over when every
+worker has failed are settled in-process.
+
+Coordinator and workers talk over TCP in frames of raw int64/float64
+columns (no pickle, so a worker never runs code sent to it):
+
+    frame header    FRAME_HEADER: magic, frame type, shard id, payload bytes
+    shard payload   group count, a typecode per group, group sizes, balances
+    result payload  group count, a typecode per group, payment counts, then
+                    debtor ids, creditor ids and amounts of every group
+    heartbeat       no payload; the worker is still settling the shard
+
+Start a worker with:  python -m splitUp.distributed --port 7070
+and settle on it with: python -m splitUp ledger.csv --nodes host:7070,...
+"""
+
+import argparse
+import heapq
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import warnings
+from array import array
+from collections import deque
+
+from .ledger import columnType
+from .settlement import settleBalanceBatch
+from .snapshot import NATIVE_LITTLE_ENDIAN
+
+# Groups are packed into shards of about this many people, so each round
+# trip to a worker carries enough work to pay for the network
+DISTRIBUTED_SHARD_PEOPLE = 65536
+
+# Seconds a worker may take to connect, or stay silent while it has a
+# shard, before it is given up on and its shards are reassigned
+WORKER_TIMEOUT = 60
+
+# Seconds between the heartbeats a worker sends while settling a shard
+WORKER_HEARTBEAT_SECONDS = 5
+
+# Workers a shard may fail on before the whole settlement is given up on
+WORKER_MAX_ATTEMPTS = 3
+
+DEFAULT_WORKER_PORT = 7070
+
+# magic, frame type, shard id, payload bytes
+FRAME_MAGIC = b'SPLW'
+FRAME_HEADER = struct.Struct('<4sBIQ')
+FRAME_SHARD = 1
+FRAME_RESULT = 2
+FRAME_ERROR = 3
+FRAME_HEARTBEAT = 4
+
+# Largest payload a worker accepts, so a bad header can't exhaust memory
+MAX_FRAME_BYTES = 1 << 30
+
+class ProtocolError(ConnectionError):
+    """
+    A peer sent something that is not a valid frame.
+    """
+
+class DistributedError(RuntimeError):
+    """
+    Raised when a distributed settlement cannot be completed.
+    """
+
+def packShards(sizes, shardPeople=DISTRIBUTED_SHARD_PEOPLE):
+    """
+    Bin-packs groups into shards of at most shardPeople people
+
+    Worst fit decreasing: groups are placed biggest first into the shard
+    with the most room left (a heap), opening a new shard when none has
+    room. Groups bigger than shardPeople get a shard of their own.
+
+    @param sizes: list of int. Number of people in each group
+    @param shardPeople: int. Capacity of a shard
+    @return: list of lists of group indices, one per shard
+    """
+    shards = []
+    room = []  # heap of (-people left, shard index)
+    for groupId in sorted(range(len(sizes)), key=sizes.__getitem__, reverse=True):
+        size = sizes[groupId]
+        if room and -room[0][0] >= size:
+            left, shardId = heapq.heappop(room)
+            shards[shardId].append(groupId)
+            heapq.heappush(room, (left + size, shardId))
+        else:
+            shards.append([groupId])
+            if size < shardPeople:
+                heapq.heappush(room, (size - shardPeople, len(shards) - 1))
+    return shards
+
+def assignShards(shardSizes, numWorkers):
+    """
+    Spreads shards over workers, biggest first to the least loaded one
+
+    @param shardSizes: list of int. Number of people in each shard
+    @param numWorkers: int
+    @return: list of lists of shard ids, one per worker
+    """
+    queues = [[] for _ in range(numWorkers)]
+    loads = [(0, workerId) for workerId in range(numWorkers)]
+    for shardId in sorted(range(len(shardSizes)), key=shardSizes.__getitem__,
+                          reverse=True):
+        load, workerId = heapq.heappop(loads)
+        queues[workerId].append(shardId)
+        heapq.heappush(loads, (load + shardSizes[shardId], workerId))
+    return queues
+
+def littleEndianBytes(column, typecode):
+    """
+    Returns a column (array, NumPy array or sequence) as little-endian bytes
+    """
+    if not isinstance(column, array) or column.typecode != typecode:
+        column = array(typecode, column.tolist() if hasattr(column, 'tolist') else column)
+    if NATIVE_LITTLE_ENDIAN:
+        return column.tobytes()
+    swapped = array(typecode, column)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+def readColumn(payload, start, typecode, count):
+    """
+    Reads count little-endian values of typecode from payload at start
+
+    @return: tuple (array, offset just past it)
+    @raise ProtocolError: if the payload is too short
+    """
+    end = start + 8 * count
+    if count < 0 or end > len(payload):
+        raise ProtocolError("payload is shorter than its header says")
+    column = array(typecode)
+    column.frombytes(payload[start:end])
+    if not NATIVE_LITTLE_ENDIAN:
+        column.byteswap()
+    return column, end
+
+def readTypecodes(payload):
+    """
+    Reads the group count and per-group typecodes that start every payload
+
+    @return: tuple (typecodes, offset just past them)
+    @raise ProtocolError: on a short payload or an unknown typecode
+    """
+    if len(payload) < 4:
+        raise ProtocolError("payload is shorter than its header says")
+    count, = struct.unpack_from('<I', payload)
+    typecodes = bytes(payload[4:4 + count]).decode('ascii', 'replace')
+    if len(typecodes) != count or typecodes.strip('qd'):
+        raise ProtocolError("payload has bad column types")
+    return typecodes, 4 + count
+
+def encodeShard(batch):
+    """
+    Encodes the balance vectors of a shard's groups as a shard payload
+    """
+    typecodes = ''.join(columnType(balances) for balances in batch)
+    parts = [struct.pack('<I', len(batch)), typecodes.encode('ascii'),
+             littleEndianBytes([len(balances) for balances in batch], 'q')]
+    parts.extend(littleEndianBytes(balances, typecode)
+                 for balances, typecode in zip(batch, typecodes))
+    return b''.join(parts)
+
+def decodeShard(payload):
+    """
+    Decodes a shard payload back into a list of balance vectors
+
+    @raise ProtocolError: if the payload is malformed
+    """
+    typecodes, start = readTypecodes(payload)
+    sizes, start = readColumn(payload, start, 'q', len(typecodes))
+    batch = []
+    for typecode, size in zip(typecodes, sizes):
+        balances, start = readColumn(payload, start, typecode, size)
+        batch.append(balances)
+    if start != len(payload):
+        raise ProtocolError("payload is longer than its header says")
+    return batch
+
+def encodeResults(batch, settlements):
+    """
+    Encodes the settlement columns of a shard's groups as a result payload
+
+    @param batch: list of balance vectors that were settled (for the types)
+    @param settlements: list of (debtorIds, creditorIds, amounts) columns
+    """
+    typecodes = ''.join(columnType(balances) for balances in batch)
+    parts = [struct.pack('<I', len(batch)), typecodes.encode('ascii'),
+             littleEndianBytes([len(settlement[2]) for settlement in settlements], 'q')]
+    for (owers, payers, paid), typecode in zip(settlements, typecodes):
+        parts.extend((littleEndianBytes(owers, 'q'), littleEndianBytes(payers, 'q'),
+                      littleEndianBytes(paid, typecode)))
+    return b''.join(parts)
+
+def decodeResults(payload):
+    """
+    Decodes a result payload into a list of settlement columns
+
+    @raise ProtocolError: if the payload is malformed
+    """
+    typecodes, start = readTypecodes(payload)
+    counts, start = readColumn(payload, start, 'q', len(typecodes))
+    settlements = []
+    for typecode, count in zip(typecodes, counts):
+        owers, start = readColumn(payload, start, 'q', count)
+        payers, start = readColumn(payload, start, 'q', count)
+        paid, start = readColumn(payload, start, typecode, count)
+        settlements.append((owers, payers, paid))
+    if start != len(payload):
+        raise ProtocolError("payload is longer than its header says")
+    return settlements
+
+def sendFrame(sock, frameType, shardId, payload):
+    """
+    Writes one frame to a socket
+    """
+    sock.sendall(FRAME_HEADER.pack(FRAME_MAGIC, frameType, shardId, len(payload)))
+    sock.sendall(payload)
+
+def recvExactly(sock, size):
+    """
+    Reads exactly size bytes from a socket
+
+    @return: bytearray, or None if the peer closed before sending any
+    @raise ProtocolError: if the peer closed part way through
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            if received == 0:
+                return None
+            raise ProtocolError("connection closed in the middle of a frame")
+        received += count
+    return data
+
+def recvFrame(sock):
+    """
+    Reads one frame from a socket
+
+    @return: tuple (frameType, shardId, payload), or None if the peer
+             closed the connection between frames
+    @raise ProtocolError: on a malformed or oversized frame
+    """
+    header = recvExactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    magic, frameType, shardId, size = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise ProtocolError("peer is not a splitUp coordinator or worker")
+    if size > MAX_FRAME_BYTES:
+        raise ProtocolError("frame of {0} bytes is too big".format(size))
+    payload = recvExactly(sock, size) if size else bytearray()
+    if payload is None:
+        raise ProtocolError("connection closed in the middle of a frame")
+    return frameType, shardId, payload
+
+class ShardScheduler():
+    """
+    Thread-safe hand-out of shards to worker threads, with failover.
+
+    Every worker starts with its own queue (see assignShards). A worker
+    whose queue runs dry takes the last shard of the fullest queue. When a
+    worker fails, its shard goes back to the front of its queue for the
+    others to take, unless the shard has already failed maxAttempts times.
+    """
+    def __init__(self, shardSizes, numWorkers, maxAttempts=WORKER_MAX_ATTEMPTS):
+        self.__condition = threading.Condition()
+        self.__shardSizes = shardSizes
+        self.__queues = [deque(queue) for queue in assignShards(shardSizes, numWorkers)]
+        self.__alive = [True] * numWorkers
+        self.__attempts = [0] * len(shardSizes)
+        self.__maxAttempts = maxAttempts
+        self.__running = 0
+        self.__results = {}
+        self.__error = None
+
+    def nextShard(self, workerId):
+        """
+        Blocks until there is a shard for workerId to settle
+
+        @return: int shard id, or None once nothing is left to do
+        """
+        with self.__condition:
+            while self.__error is None:
+                queue = self.__queues[workerId]
+                if not queue:
+                    # Take the last shard of the queue with the most people
+                    queue = max(self.__queues, key=lambda other: sum(
+                        self.__shardSizes[shardId] for shardId in other))
+                if queue:
+                    self.__running += 1
+                    return queue.pop() if queue is not self.__queues[workerId] \
+                        else queue.popleft()
+                if self.__running == 0:
+                    break
+                # A running shard may still fail and need settling again
+                self.__condition.wait()
+            return None
+
+    def finish(self, shardId, settlements):
+        """
+        Records a settled shard
+        """
+        with self.__condition:
+            self.__running -= 1
+            self.__results[shardId] = settlements
+            self.__condition.notify_all()
+
+    def fail(self, workerId, shardId=None):
+        """
+        Retires a worker that failed, requeueing the shard it was settling
+
+        @param shardId: int or None. The shard it was settling, if any
+        """
+        with self.__condition:
+            self.__alive[workerId] = False
+            if shardId is not None:
+                self.__running -= 1
+                self.__attempts[shardId] += 1
+                if self.__attempts[shardId] >= self.__maxAttempts:
+                    self.__error = DistributedError(
+                        "shard {0} failed on {1} workers".format(shardId, self.__attempts[shardId]))
+                self.__queues[workerId].appendleft(shardId)
+            self.__condition.notify_all()
+
+    def abort(self, error):
+        """
+        Stops handing out shards because of an error that retrying won't fix
+        """
+        with self.__condition:
+            if self.__error is None:
+                self.__error = error
+            self.__condition.notify_all()
+
+    def getError(self):
+        """
+        Returns the error that stopped the settlement, or None
+        """
+        with self.__condition:
+            return self.__error
+
+    def getResults(self):
+        """
+        Returns dict of shard id -> settlement columns of its groups
+        """
+        with self.__condition:
+            return self.__results
+
+    def getPending(self):
+        """
+        Returns the ids of shards no worker settled
+        """
+        with self.__condition:
+            return [shardId for queue in self.__queues for shardId in queue]
+
+    def getFailedWorkers(self):
+        """
+        Returns the ids of the workers that were retired
+        """
+        with self.__condition:
+            return [workerId for workerId, alive in enumerate(self.__alive) if not alive]
+
+def recvReply(sock):
+    """
+    Reads the next frame from a worker that is not a heartbeat
+
+    The socket timeout applies to each frame, so a worker busy with a big
+    shard keeps the connection alive by sending heartbeats.
+
+    @return: tuple (frameType, shardId, payload), or None if the worker
+             closed the connection
+    """
+    while True:
+        frame = recvFrame(sock)
+        if frame is None or frame[0] != FRAME_HEARTBEAT:
+            return frame
+
+def driveWorker(scheduler, workerId, address, batches, timeout):
+    """
+    Feeds shards to one worker node until none are left (one thread each)
+
+    @param address: tuple (host, port) of the worker
+    @param batches: list of lists of balance vectors, indexed by shard id
+    @param timeout: float. Seconds the worker may stay silent
+    """
+    try:
+        sock = socket.create_connection(address, timeout)
+    except OSError:
+        scheduler.fail(workerId)
+        return
+
+    with sock:
+        while True:
+            shardId = scheduler.nextShard(workerId)
+            if shardId is None:
+                return
+            try:
+                sendFrame(sock, FRAME_SHARD, shardId, encodeShard(batches[shardId]))
+                frame = recvReply(sock)
+                if frame is None:
+                    raise ProtocolError("worker closed the connection")
+                frameType, replyId, payload = frame
+                if frameType == FRAME_ERROR:
+                    # The worker is fine, the shard is bad; retrying won't help
+                    scheduler.abort(DistributedError("worker {0}:{1}: {2}".format(
+                        address[0], address[1], payload.decode('utf-8', 'replace'))))
+                    return
+                if frameType != FRAME_RESULT or replyId != shardId:
+                    raise ProtocolError("unexpected reply to shard {0}".format(shardId))
+                settlements = decodeResults(payload)
+                if len(settlements) != len(batches[shardId]):
+                    raise ProtocolError("reply to shard {0} has the wrong number of groups"
+                                        .format(shardId))
+            except OSError:
+                scheduler.fail(workerId, shardId)
+                return
+            scheduler.finish(shardId, settlements)
+
+def settleDistributed(payloads, nodes, shardPeople=DISTRIBUTED_SHARD_PEOPLE,
+                      timeout=WORKER_TIMEOUT, maxAttempts=WORKER_MAX_ATTEMPTS,
+                      localFallback=True):
+    """
+    Settles (names, balances) payloads on remote worker nodes
+
+    Same contract as settlePayloads(), so the results are identical to
+    settling in-process; only the balances travel, never the names.
+
+    @param payloads: list of (names, balances) tuples, one per group
+    @param nodes: list of (host, port) worker addresses (see parseNodes)
+    @param shardPeople: int. People per shard (see packShards)
+    @param timeout: float. Seconds before a silent worker is retired (busy
+                    workers send heartbeats, see WORKER_HEARTBEAT_SECONDS)
+    @param maxAttempts: int. Workers a shard may fail on before giving up
+    @param localFallback: bool. Settle shards in-process if every worker
+                          failed, instead of raising DistributedError
+    @return: list of settlement columns, in the same order as payloads
+    @raise ValueError: if nodes is empty
+    @raise DistributedError: if a worker rejects a shard, a shard fails on
+                             maxAttempts workers, or (without localFallback)
+                             no worker is left
+    """
+    if not nodes:
+        raise ValueError("no worker nodes to settle on")
+    balances = [groupBalances for _, groupBalances in payloads]
+    shards = packShards([len(groupBalances) for groupBalances in balances], shardPeople)
+    batches = [[balances[groupId] for groupId in shard] for shard in shards]
+    scheduler = ShardScheduler([sum(map(len, batch)) for batch in batches],
+                               len(nodes), maxAttempts)
+
+    threads = [threading.Thread(target=driveWorker, name='settle-node-{0}'.format(workerId),
+                                args=(scheduler, workerId, address, batches, timeout),
+                                daemon=True)
+               for workerId, address in enumerate(nodes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    error = scheduler.getError()
+    if error is not None:
+        raise error
+    results = scheduler.getResults()
+    pending = scheduler.getPending()
+    if pending:
+        message = "every worker failed with {0} shards left".format(len(pending))
+        if not localFallback:
+            raise DistributedError(message)
+        warnings.warn(message + "; settling them in-process", RuntimeWarning)
+        for shardId in pending:
+            results[shardId] = settleBalanceBatch(batches[shardId])
+
+    settlements = [None] * len(payloads)
+    for shardId, shard in enumerate(shards):
+        for groupId, settlement in zip(shard, results[shardId]):
+            settlements[groupId] = settlement
+    return settlements
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one coordinator connection: settles shards until it hangs up.
+
+    A shard is settled on a separate thread while this one sends the
+    coordinator a heartbeat every heartbeatSeconds.
+    """
+    heartbeatSeconds = WORKER_HEARTBEAT_SECONDS
+
+    def handle(self):
+        try:
+            while self.settleNext():
+                pass
+        except OSError:
+            # The coordinator went away; it reassigns whatever was running
+            pass
+
+    def settleNext(self):
+        """
+        Reads, settles and answers one shard
+
+        @return: bool. False once the connection should be closed
+        """
+        sock = self.request
+        try:
+            frame = recvFrame(sock)
+            if frame is None:
+                return False
+            frameType, shardId, payload = frame
+            if frameType != FRAME_SHARD:
+                raise ProtocolError("expected a shard, got frame type {0}"
+                                    .format(frameType))
+            batch = decodeShard(payload)
+        except ProtocolError as e:
+            sendFrame(sock, FRAME_ERROR, 0, str(e).encode('utf-8'))
+            return False
+
+        outcome = {}
+        def settle():
+            try:
+                outcome['reply'] = encodeResults(batch, settleBalanceBatch(batch))
+            except Exception as e:
+                outcome['error'] = e
+        thread = threading.Thread(target=settle, name='settle-shard-{0}'.format(shardId),
+                                  daemon=True)
+        thread.start()
+        thread.join(self.heartbeatSeconds)
+        while thread.is_alive():
+            sendFrame(sock, FRAME_HEARTBEAT, shardId, b'')
+            thread.join(self.heartbeatSeconds)
+
+        error = outcome.get('error')
+        if isinstance(error, ValueError):
+            # e.g. balances that don't sum to zero (see checkZeroSum)
+            sendFrame(sock, FRAME_ERROR, shardId, str(error).encode('utf-8'))
+            return True
+        if error is not None:
+            raise error
+        sendFrame(sock, FRAME_RESULT, shardId, outcome['reply'])
+        return True
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    """
+    A worker node: settles shards sent by any number of coordinators.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+def serveWorker(host='127.0.0.1', port=DEFAULT_WORKER_PORT, ready=None):
+    """
+    Runs a worker node until it is killed
+
+    @param port: int. Port to listen on (0 = any free port)
+    @param ready: multiprocessing queue or None. (process id, bound port)
+                  is put on it once the worker accepts connections
+    """
+    with WorkerServer((host, port), WorkerHandler) as server:
+        if ready is not None:
+            ready.put((os.getpid(), server.server_address[1]))
+        server.serve_forever()
+
+def startLocalWorkers(count, host='127.0.0.1'):
+    """
+    Starts worker nodes as local processes, e.g. to try a cluster on one box
+
+    @param count: int. Number of worker processes
+    @return: list of (process, (host, port)). Stop them with stopLocalWorkers()
+    """
+    ready = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=serveWorker, args=(host, 0, ready),
+                                         daemon=True)
+                 for _ in range(count)]
+    for process in processes:
+        process.start()
+    # Ports arrive in whatever order the workers bind
+    ports = dict(ready.get(timeout=WORKER_TIMEOUT) for _ in processes)
+    return [(process, (host, ports[process.pid])) for process in processes]
+
+def stopLocalWorkers(workers):
+    """
+    Terminates worker processes started by startLocalWorkers()
+    """
+    for process, _ in workers:
+        process.terminate()
+    for process, _ in workers:
+        process.join()
+
+def parseNodes(text):
+    """
+    Parses a comma-separated list of worker addresses
+
+    @param text: str. e.g. "10.0.0.5:7070,10.0.0.6" (port defaults to
+                 DEFAULT_WORKER_PORT)
+    @return: list of (host, port)
+    @raise ValueError: on a malformed address
+    """
+    nodes = []
+    for address in filter(None, (part.strip() for part in text.split(','))):
+        host, _, port = address.rpartition(':') if ':' in address else (address, '', '')
+        nodes.append((host, int(port) if port else DEFAULT_WORKER_PORT))
+    if not nodes:
+        raise ValueError("no worker addresses in {0!r}".format(text))
+    return nodes
+
+def main(argv=None):
+    """
+    Worker node entry point: python -m splitUp.distributed --port 7070
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m splitUp.distributed',
+        description="Run a worker node that settles shards for coordinators")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on (0.0.0.0 = every interface)")
+    parser.add_argument('--port', type=int, default=DEFAULT_WORKER_PORT)
+    args = parser.parse_args(argv)
+    try:
+        serveWorker(args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Writers for settlements and transactions: csv, NDJSON, columnar JSON, gzip
+
+Every writer produces its output incrementally, so settlements of any
+size can be streamed to a file or an HTTP response.
+"""
+
+import csv
+import io
+import itertools
+import json
+import zlib
+
+from .ledger import centsToAmount, columnType, plainNumber
+
+# Malformed rows listed in a settlement summary (all of them are counted)
+MAX_REPORTED_PARSE_ERRORS = 10
+
+# Rows written per chunk of a streamed CSV export
+EXPORT_CHUNK_ROWS = 1024
+
+# First field of the last line of a CSV export that failed part way
+EXPORT_ERROR_MARKER = '#error'
+
+def writeSettlement(output, table, settlement, outputFormat, parseErrors=()):
+    """
+    Writes the payments settling a BalanceTable to a text file
+
+    csv output is one payer,payee,amount row per payment, in the same
+    format as the input, so appending it to the ledger settles it. ndjson
+    output has one {'type': 'settlement'} line per payment followed by a
+    {'type': 'summary'} line, as /api/settle?format=ndjson does.
+
+    @param output: text file object
+    @param table: BalanceTable that was settled
+    @param settlement: tuple of columns (see settleBalanceColumns)
+    @param outputFormat: str. 'csv' or 'ndjson'
+    @param parseErrors: list of LedgerParseError for rows that were skipped
+    """
+    names = table.names
+    toAmount = centsToAmount if columnType(table.balances) == 'q' else plainNumber
+    rows = ((names[debtorId], names[creditorId], toAmount(amount))
+            for debtorId, creditorId, amount in zip(*settlement))
+    if outputFormat == 'csv':
+        csv.writer(output, lineterminator='\n').writerows(rows)
+        return
+
+    for debtor, creditor, amount in rows:
+        output.write(json.dumps({'type': 'settlement', 'debtor': debtor,
+                                 'creditor': creditor, 'amount': amount}) + "\n")
+    output.write(json.dumps({'type': 'summary',
+                             'original_transactions': table.numTransactions,
+                             'simplified_transactions': len(settlement[2]),
+                             'people': len(names),
+                             'skipped_rows': len(parseErrors),
+                             'parse_errors': [str(error) for error in parseErrors[:MAX_REPORTED_PARSE_ERRORS]]})
+                 + "\n")
+
+def iterCsvChunks(transactions, chunkRows=EXPORT_CHUNK_ROWS):
+    """
+    Encodes transaction dicts as creditor,debtor,amount csv, chunk by chunk
+
+    If reading the transactions raises ValueError (e.g. the request body
+    they are parsed from is malformed) or one of them is not a dict once
+    output has started, the rows read so far are still sent, followed by
+    one EXPORT_ERROR_MARKER,message line, so a cut-short export can be told
+    apart from a complete one.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    rows = []
+    try:
+        for transaction in transactions:
+            if not isinstance(transaction, dict):
+                raise ValueError("transaction {0!r} is not an object".format(transaction))
+            rows.append((transaction.get('creditor', ''),
+                         transaction.get('debtor', ''),
+                         transaction.get('amount', 0)))
+            if len(rows) == chunkRows:
+                writer.writerows(rows)
+                rows = []
+                yield output.getvalue().encode('utf-8')
+                output.seek(0)
+                output.truncate()
+    except ValueError as e:
+        rows.append((EXPORT_ERROR_MARKER, str(e)))
+    if rows:
+        writer.writerows(rows)
+        yield output.getvalue().encode('utf-8')
+
+def gzipChunks(chunks):
+    """
+    Compresses a stream of byte chunks into one gzip stream on the fly
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def iterSettlementNdjson(ledger, settlement, summary, echo):
+    """
+    Yields the /api/settle NDJSON output, one encoded line at a time
+    """
+    names = ledger.getNames()
+    toAmount = centsToAmount if ledger.isExact() else (lambda amount: amount)
+    if echo:
+        for payerId, debtorId, amount in zip(*ledger.getEdges()):
+            yield (json.dumps({'type': 'transaction', 'creditor': names[payerId],
+                               'debtor': names[debtorId],
+                               'amount': toAmount(amount)}) + "\n").encode('utf-8')
+    for debtorId, creditorId, amount in zip(*settlement):
+        yield (json.dumps({'type': 'settlement', 'debtor': names[debtorId],
+                           'creditor': names[creditorId],
+                           'amount': toAmount(amount)}) + "\n").encode('utf-8')
+    yield (json.dumps(dict(summary, type='summary')) + "\n").encode('utf-8')
+
+def iterSettlementColumnar(ledger, settlement, summary, echo):
+    """
+    Yields the /api/settle columnar JSON output a column at a time
+
+    Names are sent once; every other column refers to them by index.
+    """
+    toAmount = centsToAmount if ledger.isExact() else (lambda amount: amount)
+    debtorIds, creditorIds, amounts = settlement
+    yield b'{"names":' + json.dumps(ledger.getNames()).encode('utf-8')
+    yield b',"balances":' + json.dumps(list(map(toAmount, ledger.getBalances()))).encode('utf-8')
+    yield b',"settlements":{"debtor":' + json.dumps(debtorIds.tolist()).encode('utf-8')
+    yield b',"creditor":' + json.dumps(creditorIds.tolist()).encode('utf-8')
+    yield b',"amount":' + json.dumps(list(map(toAmount, amounts))).encode('utf-8') + b'}'
+    if echo:
+        payerIds, owerIds, paid = ledger.getEdges()
+        yield b',"transactions":{"creditor":' + json.dumps(payerIds.tolist()).encode('utf-8')
+        yield b',"debtor":' + json.dumps(owerIds.tolist()).encode('utf-8')
+        yield b',"amount":' + json.dumps(list(map(toAmount, paid))).encode('utf-8') + b'}'
+    yield b',"summary":' + json.dumps(summary).encode('utf-8') + b'}'
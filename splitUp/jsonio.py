@@ -0,0 +1,199 @@
+"""
+Reading transactions posted as JSON: single objects, NDJSON and
+incrementally parsed JSON arrays
+"""
+
+import codecs
+import json
+import re
+from array import array
+
+from .currency import convertCurrencies
+from .ledger import Ledger, LedgerParseError, parseCents, parseFloatAmount
+from .parsing import PARSE_BATCH_ROWS, UPLOAD_CHUNK_SIZE, iterUploadLines
+
+def parseManualTransaction(transaction, exact=False):
+    """
+    Reads one transaction posted as JSON by the browser
+
+    @param transaction: dict with 'creditor', 'debtor' and 'amount' keys
+    @param exact: bool. Return the amount as integer minor units
+    @return: tuple (creditor, debtor, amount)
+    """
+    creditor = transaction['creditor'].strip()
+    debtor = transaction['debtor'].strip()
+    if exact:
+        amount = parseCents(str(transaction['amount']))
+    else:
+        amount = parseFloatAmount(transaction['amount'])
+    return creditor, debtor, amount
+
+def manualCurrency(transaction, rates):
+    """
+    Reads the optional currency of one transaction posted as JSON
+
+    @param transaction: dict, optionally with a 'currency' key
+    @param rates: RateTable or None (see currencyRates)
+    @return: str. Upper-case currency code ('' = the base currency)
+    @raise ValueError: if the currency has no exchange rate
+    """
+    currency = str(transaction.get('currency') or '').strip().upper()
+    if currency and (rates is None or currency not in rates.rates):
+        raise ValueError("no exchange rate for currency {0!r}".format(currency))
+    return currency
+
+def readLedgerFromNdjson(stream, exact=False, strict=True, errors=None, rates=None):
+    """
+    Streams NDJSON transactions into a Ledger
+
+    Every non-blank line is one JSON object in the /process_manual format
+    ({"creditor": ..., "debtor": ..., "amount": ...}, optionally with a
+    "currency"). Lines are decoded, converted to the base currency and
+    added in batches, so the body is never held in memory at once.
+
+    @param stream: binary file-like object, e.g. the request body
+    @param exact: bool. Keep amounts as int minor units (see parseCents)
+    @param strict: bool. Raise LedgerParseError on malformed lines instead
+                   of skipping them
+    @param errors: list or None. Collects skipped lines' errors if not strict
+    @param rates: RateTable or None. Exchange rates for lines with a currency
+    @return: Ledger
+    """
+    ledger = Ledger(exact)
+    moneyType = 'q' if exact else 'd'
+    payers, debtors, amounts, currencies = [], [], array(moneyType), []
+
+    def addBatch():
+        converted = convertCurrencies(amounts, currencies, rates) if any(currencies) \
+            else amounts
+        ledger.addTransactions(payers, debtors, converted)
+
+    for lineNumber, line in enumerate(iterUploadLines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            transaction = json.loads(line)
+            creditor, debtor, amount = parseManualTransaction(transaction, exact)
+            currency = manualCurrency(transaction, rates)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            error = LedgerParseError(lineNumber, str(e))
+            if strict:
+                raise error
+            if errors is not None:
+                errors.append(error)
+            continue
+
+        payers.append(creditor)
+        debtors.append(debtor)
+        amounts.append(amount)
+        currencies.append(currency)
+        if len(amounts) >= PARSE_BATCH_ROWS:
+            addBatch()
+            payers, debtors, amounts, currencies = [], [], array(moneyType), []
+    addBatch()
+    return ledger
+
+# Characters that can follow a JSON number
+NUMBER_END = re.compile(r'[,\]}\s]')
+
+class JsonStreamReader():
+    """
+    Pulls JSON values out of a binary stream a piece at a time.
+
+    Only the part of the body that has not been consumed yet is buffered,
+    so arrays of any length can be walked item by item.
+    """
+    def __init__(self, stream, chunkSize=UPLOAD_CHUNK_SIZE):
+        self.__stream = stream
+        self.__chunkSize = chunkSize
+        self.__decoder = codecs.getincrementaldecoder('utf-8')()
+        self.__json = json.JSONDecoder()
+        self.__buffer = ''
+        self.__pos = 0
+        self.__eof = False
+
+    def __fill(self):
+        """
+        Reads one more chunk into the buffer; returns False at end of stream
+        """
+        if self.__eof:
+            return False
+        chunk = self.__stream.read(self.__chunkSize)
+        self.__eof = not chunk
+        self.__buffer = self.__buffer[self.__pos:] + \
+            self.__decoder.decode(chunk, final=self.__eof)
+        self.__pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character ('' at the end)
+        """
+        while True:
+            while self.__pos < len(self.__buffer) and self.__buffer[self.__pos].isspace():
+                self.__pos += 1
+            if self.__pos < len(self.__buffer) or not self.__fill():
+                return self.__buffer[self.__pos:self.__pos + 1]
+
+    def expect(self, char):
+        """
+        Consumes the next non-whitespace character, which must be char
+
+        @raise ValueError: if the body has something else there
+        """
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected {0!r} but found {1!r}".format(char, found))
+        self.__pos += 1
+
+    def value(self):
+        """
+        Decodes and returns the next complete JSON value
+        """
+        if self.peek() in '-0123456789':
+            # A number only ends at a delimiter, which may be in a later chunk
+            while not NUMBER_END.search(self.__buffer, self.__pos) and self.__fill():
+                pass
+        while True:
+            try:
+                value, self.__pos = self.__json.raw_decode(self.__buffer, self.__pos)
+                return value
+            except json.JSONDecodeError:
+                if not self.__fill():
+                    raise
+
+def iterJsonArray(stream, key):
+    """
+    Yields the items of body[key] from a JSON object body, incrementally
+
+    Other keys of the object are decoded and skipped.
+
+    @param stream: binary file-like object, e.g. the request body
+    @param key: str. Key of the array inside the top-level object
+    @raise ValueError: if the body is not a JSON object
+    """
+    reader = JsonStreamReader(stream)
+    reader.expect('{')
+    while reader.peek() != '}':
+        name = reader.value()
+        reader.expect(':')
+        if name != key:
+            reader.value()
+        else:
+            reader.expect('[')
+            while reader.peek() != ']':
+                yield reader.value()
+                if reader.peek() == ',':
+                    reader.expect(',')
+            reader.expect(']')
+        if reader.peek() == ',':
+            reader.expect(',')
+    reader.expect('}')
+
+def iterNdjson(stream):
+    """
+    Yields the JSON value on every non-blank line of a binary stream
+    """
+    for line in iterUploadLines(stream):
+        if line.strip():
+            yield json.loads(line)
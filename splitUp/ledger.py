@@ -0,0 +1,625 @@
+"""
+People, balances and ledgers: the data model every other module builds on
+
+Amounts are floats, or int minor units (see parseCents) in exact mode.
+"""
+
+import math
+from array import array
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+# Named Tuple definition for transaction data
+Transaction = namedtuple('Transaction', ['debtor', 'creditor', 'amount'])
+
+# Per-person net balances and connected components read without keeping
+# any per-row objects (see readBalancesMapped)
+BalanceTable = namedtuple('BalanceTable',
+                          ['names', 'balances', 'componentIds', 'numTransactions'])
+
+# Minor units (cents) per unit of currency in exact integer mode
+MINOR_UNITS = 100
+
+# Exact amounts are stored in array('q') columns, so they must fit in 64 bits
+MAX_MINOR_UNITS = (1 << 63) - 1
+
+# Remainders smaller than this are floating point dust, not money still owed
+SETTLEMENT_EPSILON = 1e-9
+
+class LedgerParseError(ValueError):
+    """
+    A malformed row in a transaction csv, with its 1-based line number.
+    """
+    def __init__(self, lineNumber, message):
+        super().__init__("line {0}: {1}".format(lineNumber, message))
+        self.lineNumber = lineNumber
+        self.message = message
+
+    def __reduce__(self):
+        # Rebuild from both arguments when sent back from a worker process
+        return (LedgerParseError, (self.lineNumber, self.message))
+
+def parseCents(text):
+    """
+    Parses an amount string into an exact integer number of minor units
+
+    @param text: str. Amount such as "25.50"
+    @return: int. Amount in minor units (e.g. 2550)
+    @raise ValueError: if text is not a finite number, has sub-cent precision
+                       or does not fit in 64 bits of minor units
+    """
+    try:
+        cents = Decimal(text.strip()) * MINOR_UNITS
+    except InvalidOperation:
+        raise ValueError("could not convert string to amount: {0!r}".format(text))
+    if not cents.is_finite():
+        raise ValueError("amount {0!r} is not a finite number".format(text))
+    if not -MAX_MINOR_UNITS <= cents <= MAX_MINOR_UNITS:
+        raise ValueError("amount {0!r} is out of range".format(text))
+    if cents != cents.to_integral_value():
+        raise ValueError("amount {0!r} is more precise than {1} minor units"
+                         .format(text, MINOR_UNITS))
+    return int(cents)
+
+def parseFloatAmount(text):
+    """
+    Parses an amount into a float, rejecting inf and nan
+
+    @param text: str or number. Amount such as "25.50"
+    @return: float
+    @raise ValueError: if text is not a finite number
+    """
+    amount = float(text)
+    if not math.isfinite(amount):
+        raise ValueError("amount {0!r} is not a finite number".format(text))
+    return amount
+
+def centsToAmount(cents):
+    """
+    Converts an integer number of minor units back to a float for display
+    """
+    return cents / MINOR_UNITS
+
+def columnType(column):
+    """
+    Returns the array typecode of a column of ids or amounts
+
+    @param column: array, or a memoryview cast to a typecode (such as the
+                   memory-mapped columns of a snapshot, see splitUp.snapshot)
+    @return: str. 'q' for int64, 'd' for float64
+    """
+    return column.format if isinstance(column, memoryview) else column.typecode
+
+def isExact(values):
+    """
+    Returns True if every value is an integer amount of minor units
+    """
+    return all(isinstance(value, int) for value in values)
+
+def plainNumber(value):
+    """
+    Converts a NumPy scalar to the equivalent plain Python number
+    """
+    return value.item() if hasattr(value, 'item') else value
+
+def checkZeroSum(balances):
+    """
+    Makes sure exact (integer) balances sum to exactly zero
+
+    @raise ValueError: if the balances don't cancel out
+    """
+    total = sum(balances)
+    if total != 0:
+        raise ValueError("Balances are off by {0} minor units".format(total))
+
+class PersonNode():
+    """
+    Represents a person and their transactions.
+
+    The net balance is kept up to date on every change so getTotalMoney()
+    is constant time. Set PersonNode.checkBalances = True (e.g. in tests)
+    to verify the cached balance against the full sum on every read.
+    """
+    checkBalances = False
+
+    def __init__(self, name):
+        self.__name = name
+        self.__owedAndCredited = {}
+        self.__totalMoney = 0
+
+    def __str__(self):
+        """
+        What prints when you run print(PersonNode)
+        Returns string representation showing name, total money, and transaction details
+        """
+        return self.__name + self.getTotalMoney() + str(self.__owedAndCredited)
+
+    def __repr__(self):
+        """
+        The representation of the obj (e.g. print(list[PersonNode]))
+        Returns just the person's name for clean list display
+        """
+        return self.__name
+
+    def getName(self):
+        """
+        Returns the person's name
+        """
+        return self.__name
+
+    def getOwersAndCreditors(self):
+        """
+        Returns dictionary of all people this person has transactions with
+        Positive values = money owed TO this person
+        Negative values = money this person owes TO others
+        """
+        return self.__owedAndCredited
+
+    def getTotalMoney(self):
+        """
+        Returns the cached net balance for this person
+        Positive = person should receive money overall
+        Negative = person owes money overall
+        Zero = person is balanced
+        """
+        if PersonNode.checkBalances:
+            expected = sum(self.__owedAndCredited.values())
+            if not math.isclose(self.__totalMoney, expected, abs_tol=1e-6):
+                raise AssertionError(
+                    "Cached balance {0} for {1} does not match {2}".format(
+                        self.__totalMoney, self.__name, expected))
+        return self.__totalMoney
+
+    def clearDebts(self):
+        """
+        Clears all debts/credits for this person
+        Also removes this person from other people's transaction records
+        """
+        for p in self.__owedAndCredited:
+            p.removeTransaction(self)
+
+        self.__owedAndCredited = {}
+        self.__totalMoney = 0
+
+    def removeTransaction(self, person):
+        """
+        Removes a specific person from this person's transaction records
+        Used when clearing debts or simplifying transactions
+        """
+        self.__totalMoney -= self.__owedAndCredited.pop(person)
+
+    def addDebt(self, debtor, amount, newTransaction=True):
+        """
+        Add a debt that debtor owes to this person
+
+        @param debtor: PersonNode
+        @param amount: float. The amount debtor owes to self.name
+        """
+        if debtor in self.__owedAndCredited:
+            self.__owedAndCredited[debtor] += amount
+        else:
+            self.__owedAndCredited[debtor] = amount
+        self.__totalMoney += amount
+
+        if newTransaction:
+            debtor.addCredit(self, amount, False)
+
+    def addCredit(self, creditor, amount, newTransaction=True):
+        """
+        Add a credit that creditor gave to this person
+        Records that this person owes money to the creditor
+
+        @param creditor: PersonNode who gave money to this person
+        @param amount: float. The amount this person owes to creditor
+        @param newTransaction: bool. If True, also updates creditor's records
+        """
+        if creditor in self.__owedAndCredited:
+            self.__owedAndCredited[creditor] -= amount
+        else:
+            self.__owedAndCredited[creditor] = amount * -1
+        self.__totalMoney -= amount
+
+        if newTransaction:
+            creditor.addDebt(self, amount, False)
+
+class DisjointSet():
+    """
+    Union-find over the integer ids 0..n-1.
+
+    Uses union by size and path compression, both done iteratively, so
+    arbitrarily long chains of payers never hit the recursion limit.
+    """
+    def __init__(self, size=0):
+        self.__parent = array('q', range(size))
+        self.__size = array('q', [1]) * size
+
+    def __len__(self):
+        """
+        Returns the number of ids in the set
+        """
+        return len(self.__parent)
+
+    def add(self):
+        """
+        Adds a new singleton id and returns it
+        """
+        newId = len(self.__parent)
+        self.__parent.append(newId)
+        self.__size.append(1)
+        return newId
+
+    def find(self, item):
+        """
+        Returns the root id of the component containing item
+        """
+        parent = self.__parent
+        root = item
+        while parent[root] != root:
+            root = parent[root]
+
+        # Point everything on the path straight at the root
+        while parent[item] != root:
+            parent[item], item = root, parent[item]
+
+        return root
+
+    def union(self, a, b):
+        """
+        Merges the components containing a and b
+
+        @return: int. Root id of the merged component
+        """
+        rootA = self.find(a)
+        rootB = self.find(b)
+        if rootA == rootB:
+            return rootA
+
+        if self.__size[rootA] < self.__size[rootB]:
+            rootA, rootB = rootB, rootA
+        self.__parent[rootB] = rootA
+        self.__size[rootA] += self.__size[rootB]
+        return rootA
+
+    def componentIds(self):
+        """
+        Numbers the components 0, 1, 2, ... in order of their lowest id
+
+        @return: array('q'). Component number of every id
+        """
+        numbering = {}
+        componentIds = array('q')
+        for item in range(len(self.__parent)):
+            root = self.find(item)
+            componentId = numbering.get(root)
+            if componentId is None:
+                componentId = len(numbering)
+                numbering[root] = componentId
+            componentIds.append(componentId)
+
+        return componentIds
+
+class Ledger():
+    """
+    Compact array-backed store of people, balances and transactions.
+
+    Names are interned to integer ids in order of first appearance. Net
+    balances live in one contiguous array('d') indexed by id, and every
+    transaction is appended to three parallel columns (payer id, debtor id,
+    amount) instead of being written into per-person dictionaries.
+    PersonNode graphs for the rest of the pipeline are built from it on demand,
+    from the transactions pre-aggregated into unique (payer, debtor) pairs.
+    Connected components are tracked in a DisjointSet as transactions arrive.
+
+    In exact mode amounts and balances are int64 minor units (see parseCents)
+    instead of floats, so balances always sum to exactly zero.
+    """
+    def __init__(self, exact=False):
+        moneyType = 'q' if exact else 'd'
+        self.__exact = exact
+        self.__components = DisjointSet()
+        self.__ids = {}
+        self.__names = []
+        self.__balances = array(moneyType)
+        self.__payers = array('q')
+        self.__debtors = array('q')
+        self.__amounts = array(moneyType)
+        self.__pairEdges = None
+
+    def __len__(self):
+        """
+        Returns the number of people in the ledger
+        """
+        return len(self.__names)
+
+    def isExact(self):
+        """
+        Returns True if amounts are stored as integer minor units
+        """
+        return self.__exact
+
+    def internName(self, name):
+        """
+        Returns the integer id for name, assigning a new one if needed
+
+        @param name: str. Person's name
+        @return: int. Id of the person
+        """
+        personId = self.__ids.get(name)
+        if personId is None:
+            personId = len(self.__names)
+            self.__ids[name] = personId
+            self.__names.append(name)
+            self.__balances.append(0)
+            self.__components.add()
+        return personId
+
+    def getId(self, name):
+        """
+        Returns the integer id of an already interned name
+        """
+        return self.__ids[name]
+
+    def getName(self, personId):
+        """
+        Returns the name belonging to an integer id
+        """
+        return self.__names[personId]
+
+    def getNames(self):
+        """
+        Returns the list of interned names, indexed by id
+        """
+        return self.__names
+
+    def getBalances(self):
+        """
+        Returns the array('d') of net balances, indexed by id
+        Positive = person should receive money overall
+        Negative = person owes money overall
+        """
+        return self.__balances
+
+    def getBalance(self, name):
+        """
+        Returns the net balance of a person by name
+        """
+        return self.__balances[self.__ids[name]]
+
+    def getEdges(self):
+        """
+        Returns the transaction columns (payer ids, debtor ids, amounts)
+        """
+        return self.__payers, self.__debtors, self.__amounts
+
+    def getPairEdges(self):
+        """
+        Returns the transactions summed per directed (payer, debtor) pair
+
+        Computed on first use and cached until more transactions are added.
+
+        @return: tuple of columns (payer ids, debtor ids, summed amounts,
+                 transaction counts). See aggregatePairs()
+        """
+        if self.__pairEdges is None:
+            self.__pairEdges = aggregatePairs(self.__payers, self.__debtors,
+                                              self.__amounts, len(self.__names))
+        return self.__pairEdges
+
+    def getNumTransactions(self):
+        """
+        Returns the number of transactions added to the ledger
+        """
+        return len(self.__amounts)
+
+    def addTransaction(self, payer, debtor, amount):
+        """
+        Records that payer paid amount on behalf of debtor
+
+        @param payer: str. Name of the person who paid (the creditor)
+        @param debtor: str. Name of the person who owes the money
+        @param amount: float, or int minor units in exact mode. The amount
+                       debtor owes to payer
+        """
+        payerId = self.internName(payer)
+        debtorId = self.internName(debtor)
+        self.__payers.append(payerId)
+        self.__debtors.append(debtorId)
+        self.__amounts.append(amount)
+        self.__pairEdges = None
+        self.__balances[payerId] += amount
+        self.__balances[debtorId] -= amount
+        self.__components.union(payerId, debtorId)
+
+    def addTransactions(self, payers, debtors, amounts):
+        """
+        Records a batch of transactions given as parallel columns
+
+        @param payers: list of str. Names of the people who paid
+        @param debtors: list of str. Names of the people who owe the money
+        @param amounts: sequence of amounts, as for addTransaction()
+        """
+        self.addTransactionIds(array('q', map(self.internName, payers)),
+                               array('q', map(self.internName, debtors)), amounts)
+
+    def addTransactionIds(self, payerIds, debtorIds, amounts):
+        """
+        Records a batch of transactions between already interned people
+
+        @param payerIds: array('q'). Ids of the people who paid
+        @param debtorIds: array('q'). Ids of the people who owe the money
+        @param amounts: sequence of amounts, as for addTransaction()
+        """
+        balances = self.__balances
+        union = self.__components.union
+        for payerId, debtorId, amount in zip(payerIds, debtorIds, amounts):
+            balances[payerId] += amount
+            balances[debtorId] -= amount
+            union(payerId, debtorId)
+        self.__payers.extend(payerIds)
+        self.__debtors.extend(debtorIds)
+        self.__amounts.extend(amounts)
+        self.__pairEdges = None
+
+    def toPeople(self):
+        """
+        Builds PersonNode objects for everyone in the ledger
+
+        Repeated (payer, debtor) pairs are summed first, so each pair costs
+        one addDebt() call no matter how many rows it appeared in.
+
+        @return: list[PersonNode]. Indexed by id, with every pair's total
+                 recorded as a debt between the two people
+        """
+        people = [PersonNode(name) for name in self.__names]
+        payerIds, debtorIds, sums, _ = self.getPairEdges()
+        for payerId, debtorId, amount in zip(payerIds, debtorIds, sums):
+            people[payerId].addDebt(people[debtorId], amount)
+        return people
+
+    def groups(self):
+        """
+        Splits the ledger into groups of people connected by transactions
+
+        @return: list[set{PersonNode}]. Same contract as splitUpGroups()
+        """
+        return groupsFromComponents(self.toPeople(),
+                                    self.__components.componentIds())
+
+    def getComponentIds(self):
+        """
+        Returns the component number of every person id
+        """
+        return self.__components.componentIds()
+
+    def toBalanceTable(self):
+        """
+        Returns the ledger's balances and components as a BalanceTable
+        """
+        return BalanceTable(self.__names, self.__balances,
+                            self.__components.componentIds(),
+                            self.getNumTransactions())
+
+def aggregatePairs(payerIds, debtorIds, amounts, numPeople):
+    """
+    Reduces transaction columns to unique directed pairs in one hash pass
+
+    @param payerIds, debtorIds: array('q'). Person ids of each transaction
+    @param amounts: array of amounts, 'd' or 'q' (exact minor units)
+    @param numPeople: int. Upper bound on the person ids
+    @return: tuple of columns (payer ids, debtor ids, summed amounts,
+             transaction counts), one entry per pair in order of first
+             appearance
+    """
+    slots = {}
+    pairPayers = array('q')
+    pairDebtors = array('q')
+    sums = array(columnType(amounts))
+    counts = array('q')
+    for payerId, debtorId, amount in zip(payerIds, debtorIds, amounts):
+        key = payerId * numPeople + debtorId
+        slot = slots.get(key)
+        if slot is None:
+            slots[key] = len(counts)
+            pairPayers.append(payerId)
+            pairDebtors.append(debtorId)
+            sums.append(amount)
+            counts.append(1)
+        else:
+            sums[slot] += amount
+            counts[slot] += 1
+    return pairPayers, pairDebtors, sums, counts
+
+def splitUpGroups(people):
+    """
+    Groups people who have transactions with each other into separate sets
+
+    Uses a DisjointSet (union-find) to find all connected people (people who
+    have direct or indirect transactions with each other) in near-linear time
+    and without recursion. This allows processing separate groups of people
+    independently.
+
+    @param people: list of PersonNode objects
+    @return: list of sets, each set contains people who are connected by transactions
+    """
+    people = list(people)
+    index = {person: i for i, person in enumerate(people)}
+    disjointSet = DisjointSet(len(people))
+
+    # people may grow while iterating when a counterparty wasn't passed in
+    for i, person in enumerate(people):
+        for other in person.getOwersAndCreditors():
+            j = index.get(other)
+            if j is None:
+                j = disjointSet.add()
+                index[other] = j
+                people.append(other)
+            disjointSet.union(i, j)
+
+    return groupsFromComponents(people, disjointSet.componentIds())
+
+def groupsFromComponents(people, componentIds):
+    """
+    Turns per-person component ids into the list of sets of people
+
+    @param people: list of PersonNode objects
+    @param componentIds: sequence of int. Component id of each person,
+                         numbered from 0 in order of first appearance
+    @return: list of sets, one per component
+    """
+    allGroups = []
+    for person, componentId in zip(people, componentIds):
+        if componentId == len(allGroups):
+            allGroups.append(set())
+        allGroups[componentId].add(person)
+
+    return allGroups
+
+def prettyPrintAllPeople(people):
+    """
+    Prints detailed information about each person's transactions (console output)
+
+    Displays each person's name, total money balance, and detailed breakdown
+    of who they owe money to or who owes them money. Used for debugging
+    and console-based output.
+
+    @param people: list of PersonNode objects
+    """
+    if people == []:
+        print("\nNo transactions necessary. " +
+              "Everyone paid an equal amount for each other.\n")
+
+    for person in people:
+        print(person.getName())
+        print("Total Money: {0}".format(person.getTotalMoney()))
+        oweStr = ""
+        for peep in person.getOwersAndCreditors().items():
+            p = peep[0].getName()
+            owe = peep[1]
+            oweStr = oweStr + " " + p + " " + str(owe)
+        print("owers:" + oweStr + "\n")
+
+def printTransactions(people):
+    """
+    Prints the final simplified transactions that need to be made (console output)
+
+    Goes through all people and prints only the transactions where someone
+    owes money (negative balances). Also counts and displays the total
+    number of transactions needed.
+
+    @param people: list of PersonNode objects with simplified transactions
+    """
+    numTransactions = 0
+    if people == []:
+        print("\nNo transactions necessary. " +
+              "Everyone paid an equal amount for each other.\n")
+
+    for p in people:
+        for peep in p.getOwersAndCreditors().items():
+            if peep[1] < 0:
+                numTransactions += 1
+
+                print("{0} must pay {1} to {2}".format(p.getName(),
+                                                       peep[1] * -1,
+                                                       peep[0].getName()))
+
+    print("New transactions in the group: {0}".format(numTransactions))
@@ -0,0 +1,553 @@
+"""
+Reading transaction csvs into ledgers and balance tables
+
+Everything streams: uploads are decoded chunk by chunk, rows are parsed
+in batches of columns, and big files are memory-mapped and parsed in
+parallel byte ranges.
+"""
+
+import codecs
+import csv
+import math
+import mmap
+import os
+from array import array
+from collections import namedtuple
+
+from .currency import convertCurrencies
+from .ledger import (BalanceTable, DisjointSet, Ledger, LedgerParseError,
+                     Transaction, centsToAmount, parseCents, parseFloatAmount)
+
+# Result of a streaming upload ingest: the connected groups, the total number
+# of rows read and the (optionally capped/paged) original transactions
+IngestResult = namedtuple('IngestResult',
+                          ['groups', 'numTransactions', 'originalTransactions'])
+
+# Target size of the byte ranges readBalancesMapped parses in parallel
+MAPPED_RANGE_BYTES = 64 * 1024 * 1024
+
+# Rows parsed per batch before their amounts are converted in bulk
+PARSE_BATCH_ROWS = 4096
+
+# Bytes read from an uploaded file per chunk while streaming
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+def readData(file, exact=False, strict=True, errors=None):
+    """
+    Reads transaction data from a CSV file and creates PersonNode objects
+
+    @param file: str. Path to csv file
+    @param exact: bool. Keep amounts as int minor units (see parseCents)
+    @param strict: bool. Raise LedgerParseError on malformed rows instead
+                   of skipping them (see iterTransactionBatches)
+    @param errors: list or None. Collects skipped rows' errors if not strict
+    @return: list[set{personNode}]. A list of sets of personNodes from the csv.
+                                    These are split up based on who has
+                                    transactions with who.
+
+    CSV format expected: payer,debtor,amount (one transaction per line)
+    Collects the transactions in a Ledger, which creates PersonNode objects
+    for each person and tracks their debts/credits
+    Groups people who have transactions with each other into separate sets
+    """
+    ledger = Ledger(exact)
+    with open(file, newline='') as csvfile:
+        for columns in iterTransactionBatches(csvfile, exact, strict, errors):
+            ledger.addTransactions(*columns)
+
+    allGroups = ledger.groups()
+    print("Original Transaction Number: {0} ".format(
+        ledger.getNumTransactions()))
+    print("Unique Payer/Debtor Pairs: {0} ".format(
+        len(ledger.getPairEdges()[3])))
+    return allGroups
+
+def iterUploadLines(file_stream, chunkSize=UPLOAD_CHUNK_SIZE, encoding='utf-8'):
+    """
+    Yields decoded lines from an uploaded file stream, reading it in chunks
+
+    Only one chunk plus one partial line is held in memory at a time, so
+    arbitrarily large uploads can be read without decoding the whole file.
+
+    @param file_stream: binary file-like object from Flask file upload
+    @param chunkSize: int. Number of bytes read from the stream at a time
+    @param encoding: str. Text encoding of the upload
+    """
+    # Request bodies can't be rewound; uploaded files may have been read
+    if file_stream.seekable():
+        file_stream.seek(0)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    while True:
+        chunk = file_stream.read(chunkSize)
+        if not chunk:
+            break
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def iterTransactionBatches(lines, exact=False, strict=True, errors=None,
+                           batchSize=PARSE_BATCH_ROWS, rates=None):
+    """
+    Parses payer,debtor,amount rows into batches of columns
+
+    Each row is split once by a comma-delimited csv.reader (so quoted names
+    may contain spaces or commas), names go straight into columns and the
+    amount column of each batch is converted in one bulk map() call. Only a
+    batch containing a bad amount falls back to row by row conversion to
+    find the offending line. Blank lines are skipped.
+
+    With a rate table, rows may have a fourth currency column and each
+    batch's amounts are converted to the base currency before they are
+    yielded (see convertCurrencies). Rows without one are in the base
+    currency.
+
+    @param lines: iterable of str. Lines of a transaction csv
+    @param exact: bool. Parse amounts as int minor units instead of floats
+    @param strict: bool. Raise on the first malformed row; if False the row
+                   is skipped and its error appended to errors instead
+    @param errors: list or None. Collects LedgerParseErrors in lenient mode
+    @param batchSize: int. Rows per batch
+    @param rates: RateTable or None. Accept and convert a currency column
+    @return: generator of (payers, debtors, amounts) columns, with amounts
+             as an array('d'), or array('q') of minor units when exact
+    @raise LedgerParseError: on a malformed row in strict mode
+    """
+    parseAmount = parseCents if exact else float
+    parseRowAmount = parseCents if exact else parseFloatAmount
+    moneyType = 'q' if exact else 'd'
+    maxFields = 3 if rates is None else 4
+    # Errors of the current batch, reported in line order once it's converted
+    batchErrors = []
+
+    def convert(payers, debtors, texts, currencies, lineNumbers):
+        # Amounts too big for the column (or for it once converted) raise
+        # OverflowError rather than ValueError, and are bad rows all the same
+        try:
+            amounts = array(moneyType, map(parseAmount, texts))
+            if rates is not None:
+                if not rates.rates.keys() >= set(currencies):
+                    raise ValueError("unknown currency")
+                amounts = convertCurrencies(amounts, currencies, rates)
+            # float() accepts "inf" and "nan", which a finite sum rules out
+            if not exact and not math.isfinite(sum(amounts)):
+                raise ValueError("amount is not a finite number")
+        except (ValueError, ArithmeticError):
+            # Find the bad amounts (or currencies) one by one
+            rows = zip(payers, debtors, texts, currencies, lineNumbers)
+            payers, debtors, amounts = [], [], array(moneyType)
+            for payer, debtor, text, currency, lineNumber in rows:
+                try:
+                    amount = array(moneyType, [parseRowAmount(text)])
+                    if rates is not None:
+                        if currency not in rates.rates:
+                            raise ValueError("no exchange rate for currency {0!r}"
+                                             .format(currency))
+                        amount = convertCurrencies(amount, [currency], rates)
+                        if not exact and not math.isfinite(amount[0]):
+                            raise ValueError("amount {0!r} is too large once converted"
+                                             .format(text))
+                except (ValueError, ArithmeticError) as e:
+                    batchErrors.append(LedgerParseError(lineNumber, str(e)))
+                    continue
+                payers.append(payer)
+                debtors.append(debtor)
+                amounts.extend(amount)
+
+        batchErrors.sort(key=lambda error: error.lineNumber)
+        if batchErrors and strict:
+            raise batchErrors[0]
+        if errors is not None:
+            errors.extend(batchErrors)
+        del batchErrors[:]
+        return payers, debtors, amounts
+
+    reader = csv.reader(lines, skipinitialspace=True)
+    payers, debtors, texts, currencies, lineNumbers = [], [], [], [], []
+    for row in reader:
+        if not row or (len(row) == 1 and not row[0].strip()):
+            continue
+        if not 3 <= len(row) <= maxFields:
+            batchErrors.append(LedgerParseError(reader.line_num,
+                "expected payer,debtor,amount{0} but got {1} fields".format(
+                    '' if rates is None else '[,currency]', len(row))))
+        elif not row[0].strip() or not row[1].strip():
+            batchErrors.append(LedgerParseError(reader.line_num,
+                                                "missing payer or debtor name"))
+        else:
+            payers.append(row[0].strip())
+            debtors.append(row[1].strip())
+            texts.append(row[2])
+            currencies.append(row[3].strip().upper() if len(row) == 4 else '')
+            lineNumbers.append(reader.line_num)
+
+        # A bad row in strict mode fails the batch as soon as it's converted
+        if len(texts) >= batchSize or (strict and batchErrors):
+            yield convert(payers, debtors, texts, currencies, lineNumbers)
+            payers, debtors, texts, currencies, lineNumbers = [], [], [], [], []
+
+    if texts or batchErrors:
+        yield convert(payers, debtors, texts, currencies, lineNumbers)
+
+def iterTransactionRows(lines, exact=False, strict=True, errors=None,
+                        rates=None):
+    """
+    Parses payer,debtor,amount rows out of an iterable of text lines
+
+    Row by row view of iterTransactionBatches(), same parameters.
+
+    @return: generator of (payer, debtor, amount) tuples
+    """
+    for payers, debtors, amounts in iterTransactionBatches(
+            lines, exact, strict, errors, rates=rates):
+        yield from zip(payers, debtors, amounts)
+
+def readBalancesFromUpload(file_stream, chunkSize=UPLOAD_CHUNK_SIZE,
+                           exact=False):
+    """
+    Folds an uploaded file straight into per-person net balances
+
+    Nothing but the running balances is kept, so memory is bounded by the
+    number of people rather than the number of rows in the upload.
+
+    @param file_stream: file-like object from Flask file upload
+    @param chunkSize: int. Number of bytes read from the stream at a time
+    @param exact: bool. Keep amounts as int minor units (see parseCents)
+    @return: tuple (balances, numTransactions) where balances is a dict of
+             name -> net balance (positive = should receive money)
+    """
+    balances = {}
+    numTransactions = 0
+    for payers, debtors, amounts in iterTransactionBatches(
+            iterUploadLines(file_stream, chunkSize), exact):
+        for payer, debtor, amount in zip(payers, debtors, amounts):
+            balances[payer] = balances.get(payer, 0) + amount
+            balances[debtor] = balances.get(debtor, 0) - amount
+        numTransactions += len(amounts)
+
+    return balances, numTransactions
+
+def readLedgerFromUpload(file_stream, keepOriginal=True, originalLimit=None,
+                         originalOffset=0, chunkSize=UPLOAD_CHUNK_SIZE,
+                         exact=False, strict=True, errors=None, progress=None,
+                         rates=None, digest=None):
+    """
+    Streams an uploaded file into a Ledger
+
+    The upload is decoded chunk by chunk and every row is appended to the
+    Ledger as soon as it is parsed. Keeping the original rows for
+    display is optional and can be limited to a window of the file.
+
+    @param file_stream: file-like object from Flask file upload
+    @param keepOriginal: bool. Whether to keep original transactions at all
+    @param originalLimit: int or None. Maximum number of original
+                          transactions kept (None = no cap)
+    @param originalOffset: int. Number of rows skipped before original
+                           transactions start being kept (for paging)
+    @param chunkSize: int. Number of bytes read from the stream at a time
+    @param exact: bool. Keep amounts as int minor units (see parseCents).
+                  Original transactions are still converted for display.
+    @param strict: bool. Raise LedgerParseError on malformed rows instead
+                   of skipping them (see iterTransactionBatches)
+    @param errors: list or None. Collects skipped rows' errors if not strict
+    @param progress: callable or None. Called with the number of rows read
+                     so far after every parsed batch
+    @param rates: RateTable or None. Convert a currency column to the base
+                  currency (see iterTransactionBatches)
+    @param digest: TransactionDigest or None. Fed every parsed row, so the
+                   upload's cache key comes out of the same pass
+    @return: tuple (ledger, original_transactions)
+    """
+    ledger = Ledger(exact)
+    original_transactions = []
+    if not keepOriginal:
+        keepEnd = originalOffset
+    elif originalLimit is None:
+        keepEnd = None
+    else:
+        keepEnd = originalOffset + originalLimit
+
+    for payers, debtors, amounts in iterTransactionBatches(
+            iterUploadLines(file_stream, chunkSize), exact, strict, errors,
+            rates=rates):
+        # Store the part of the batch inside the window for display
+        batchStart = ledger.getNumTransactions()
+        first = max(originalOffset - batchStart, 0)
+        last = len(amounts) if keepEnd is None else \
+            min(keepEnd - batchStart, len(amounts))
+        for i in range(first, last):
+            original_transactions.append(Transaction(
+                debtor=debtors[i],
+                creditor=payers[i],
+                amount=centsToAmount(amounts[i]) if exact else amounts[i]
+            ))
+
+        ledger.addTransactions(payers, debtors, amounts)
+        if digest is not None:
+            digest.update(zip(payers, debtors, amounts))
+        if progress is not None:
+            progress(ledger.getNumTransactions())
+
+    return ledger, original_transactions
+
+def ingestUpload(file_stream, keepOriginal=True, originalLimit=None,
+                 originalOffset=0, chunkSize=UPLOAD_CHUNK_SIZE, exact=False,
+                 strict=True, errors=None):
+    """
+    Streams an uploaded file into PersonNode groups
+
+    Same parameters as readLedgerFromUpload(), which does the streaming.
+
+    @return: IngestResult (groups, numTransactions, originalTransactions)
+    """
+    ledger, original_transactions = readLedgerFromUpload(
+        file_stream, keepOriginal, originalLimit, originalOffset, chunkSize,
+        exact, strict, errors)
+    return IngestResult(ledger.groups(), ledger.getNumTransactions(),
+                        original_transactions)
+
+def iterMappedLines(mapped, start, end):
+    """
+    Yields the decoded lines of mapped[start:end] one at a time
+
+    Lines are located with find() on the memory map itself, so only one
+    line is ever copied out of the file at a time.
+    """
+    pos = start
+    while pos < end:
+        newline = mapped.find(b'\n', pos, end)
+        if newline == -1:
+            newline = end
+        yield mapped[pos:newline].decode('utf-8')
+        pos = newline + 1
+
+def splitLineRanges(mapped, numRanges):
+    """
+    Splits a memory map into about numRanges byte ranges on line boundaries
+
+    @return: list of (start, end) byte offsets covering the whole map
+    """
+    size = len(mapped)
+    ranges = []
+    start = 0
+    for i in range(1, numRanges + 1):
+        if start >= size:
+            break
+        end = size if i == numRanges else \
+            mapped.find(b'\n', max(start, size * i // numRanges))
+        end = size if end == -1 else end + 1
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+def countLines(mapped, end, chunkSize=1024 * 1024):
+    """
+    Counts the newlines in mapped[:end], a chunk at a time
+    """
+    count = 0
+    for pos in range(0, end, chunkSize):
+        count += mapped[pos:min(pos + chunkSize, end)].count(b'\n')
+    return count
+
+class BalanceAccumulator():
+    """
+    Running per-person balances and connected groups, without the rows.
+
+    What readMappedRange() keeps of its byte range and readBalancesMapped()
+    of the whole file: one name, balance and union-find entry per person,
+    so memory does not grow with the number of transactions.
+    """
+    def __init__(self, exact=False):
+        self.__ids = {}
+        self.__names = []
+        self.__balances = array('q' if exact else 'd')
+        self.__components = DisjointSet()
+        self.__numTransactions = 0
+
+    def __len__(self):
+        """
+        Returns the number of people seen so far
+        """
+        return len(self.__names)
+
+    def internName(self, name):
+        """
+        Returns the integer id for name, assigning a new one if needed
+        """
+        personId = self.__ids.get(name)
+        if personId is None:
+            personId = len(self.__names)
+            self.__ids[name] = personId
+            self.__names.append(name)
+            self.__balances.append(0)
+            self.__components.add()
+        return personId
+
+    def addTransactions(self, payers, debtors, amounts):
+        """
+        Adds a batch of transactions given as parallel columns
+
+        @param payers: list of str. Names of the people who paid
+        @param debtors: list of str. Names of the people who owe the money
+        @param amounts: sequence of amounts (int minor units in exact mode)
+        """
+        internName = self.internName
+        balances = self.__balances
+        union = self.__components.union
+        for payer, debtor, amount in zip(payers, debtors, amounts):
+            payerId = internName(payer)
+            debtorId = internName(debtor)
+            balances[payerId] += amount
+            balances[debtorId] -= amount
+            union(payerId, debtorId)
+        self.__numTransactions += len(amounts)
+
+    def addPartial(self, names, balances, roots, numTransactions):
+        """
+        Merges a partial table returned by readMappedRange()
+        """
+        globalIds = array('q', map(self.internName, names))
+        for personId, balance in enumerate(balances):
+            self.__balances[globalIds[personId]] += balance
+            self.__components.union(globalIds[personId], globalIds[roots[personId]])
+        self.__numTransactions += numTransactions
+
+    def getRoots(self):
+        """
+        Returns, for every id, the lowest id in the same connected group
+        """
+        firstOfComponent = {}
+        return array('q', (firstOfComponent.setdefault(componentId, personId)
+                           for personId, componentId
+                           in enumerate(self.__components.componentIds())))
+
+    def toPartial(self):
+        """
+        Returns the accumulated balances in readMappedRange()'s format
+
+        @return: tuple (names, balances, roots, numTransactions)
+        """
+        return (self.__names, self.__balances, self.getRoots(),
+                self.__numTransactions)
+
+    def toBalanceTable(self):
+        """
+        Returns the accumulated balances and groups as a BalanceTable
+        """
+        return BalanceTable(self.__names, self.__balances,
+                            self.__components.componentIds(),
+                            self.__numTransactions)
+
+def readMappedRange(path, start, end, exact=False, strict=True, rates=None):
+    """
+    Parses one byte range of a memory-mapped csv into a partial balance table
+
+    Runs inside a worker process. Rows are folded into a BalanceAccumulator
+    as they are parsed, so the result holds one entry per person seen in
+    the range, and nothing per row is kept along the way either.
+
+    @return: tuple (names, balances, roots, numTransactions, errors) where
+             roots[i] is the local id of the person names[i] is connected to
+             and errors are LedgerParseErrors numbered from the range start
+    """
+    accumulator = BalanceAccumulator(exact)
+    errors = []
+    with open(path, 'rb') as csvfile, \
+            mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        try:
+            for columns in iterTransactionBatches(
+                    iterMappedLines(mapped, start, end), exact, strict, errors,
+                    rates=rates):
+                accumulator.addTransactions(*columns)
+        except LedgerParseError as e:
+            errors.append(e)
+
+    return accumulator.toPartial() + (errors,)
+
+def readBalancesMapped(path, maxWorkers=None, exact=False, strict=True,
+                       errors=None, rangeBytes=MAPPED_RANGE_BYTES, rates=None):
+    """
+    Reads a (multi-gigabyte) csv into per-person balances via a memory map
+
+    The file is mapped rather than read, split into byte ranges on line
+    boundaries, and the ranges are parsed in parallel into partial balance
+    tables. Merging them only touches one entry per person per range, so
+    peak memory scales with the number of people, not the number of rows.
+
+    @param path: str. Path to csv file
+    @param maxWorkers: int or None. Worker processes (None = one per core,
+                       1 = parse in-process)
+    @param exact: bool. Keep amounts as int minor units (see parseCents)
+    @param strict: bool. Raise LedgerParseError on malformed rows instead
+                   of skipping them (see iterTransactionBatches)
+    @param errors: list or None. Collects skipped rows' errors if not strict
+    @param rangeBytes: int. Target size of each byte range
+    @param rates: RateTable or None. Convert a currency column to the base
+                  currency (see iterTransactionBatches)
+    @return: BalanceTable
+    """
+    with open(path, 'rb') as csvfile:
+        if os.fstat(csvfile.fileno()).st_size == 0:
+            return BalanceTable([], array('q' if exact else 'd'), array('q'), 0)
+        with mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            ranges = splitLineRanges(mapped, -(-len(mapped) // rangeBytes))
+
+            jobs = [(path, start, end, exact, strict, rates) for start, end in ranges]
+            if maxWorkers == 1 or len(ranges) == 1:
+                partials = [readMappedRange(*job) for job in jobs]
+            else:
+                # Imported here: starting a pool is rare, importing it is not cheap
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=maxWorkers) as pool:
+                    partials = list(pool.map(readMappedRange, *zip(*jobs)))
+
+            # Renumber errors from each range start to whole-file line numbers
+            rangeErrors = []
+            for (start, _), partial in zip(ranges, partials):
+                if partial[4]:
+                    linesBefore = countLines(mapped, start)
+                    rangeErrors.extend(
+                        LedgerParseError(error.lineNumber + linesBefore,
+                                         error.message)
+                        for error in partial[4])
+            if rangeErrors and strict:
+                raise rangeErrors[0]
+            if errors is not None:
+                errors.extend(rangeErrors)
+
+    merged = BalanceAccumulator(exact)
+    for names, balances, roots, numTransactions, _ in partials:
+        merged.addPartial(names, balances, roots, numTransactions)
+    return merged.toBalanceTable()
+
+def readDataFromUpload(file_stream, keepOriginal=True, originalLimit=None,
+                       originalOffset=0, exact=False, strict=True, errors=None):
+    """
+    Reads transaction data from an uploaded file stream for web interface
+
+    @param file_stream: file-like object from Flask file upload
+    @param keepOriginal: bool. Whether to keep original transactions at all
+    @param originalLimit: int or None. Maximum number of original
+                          transactions returned (None = no cap)
+    @param originalOffset: int. Row index the returned original
+                           transactions start at
+    @param exact: bool. Keep amounts as int minor units (see parseCents)
+    @param strict: bool. Raise LedgerParseError on malformed rows instead
+                   of skipping them (see iterTransactionBatches)
+    @param errors: list or None. Collects skipped rows' errors if not strict
+    @return: tuple (allGroups, original_transactions_list)
+
+    Similar to readData() but works with uploaded files instead of file paths
+    Also returns the original transactions list for display in web interface
+    The upload is streamed through ingestUpload() rather than decoded at once.
+    Use ingestUpload() directly to get the row count when the list is capped.
+    """
+    result = ingestUpload(file_stream, keepOriginal, originalLimit,
+                          originalOffset, exact=exact, strict=strict,
+                          errors=errors)
+    return result.groups, result.originalTransactions
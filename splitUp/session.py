@@ -0,0 +1,231 @@
+"""
+Incrementally updated ledger sessions
+"""
+
+import itertools
+from array import array
+from collections import Counter
+
+from .ledger import SETTLEMENT_EPSILON, Transaction, plainNumber
+from .settlement import settleBalances
+
+class LedgerSession():
+    """
+    Stateful ledger that is updated and re-settled incrementally.
+
+    Transactions can be appended or removed one at a time. Balances and the
+    connected group of the people involved are updated in place, and only
+    groups whose balances changed are re-settled on the next call to
+    settle(), so the cost of an edit is proportional to the affected group
+    rather than the whole ledger.
+    """
+    def __init__(self, exact=False):
+        self.__exact = exact
+        self.__numTransactions = 0
+        # (payer, debtor) -> Counter of the amounts of its transactions
+        self.__pairs = {}
+        self.__balances = {}
+        # name -> {counterparty: number of directed pairs between them}
+        self.__neighbours = {}
+        # name -> group id, and group id -> {name: None} (ordered members)
+        self.__groupOf = {}
+        self.__members = {}
+        self.__settlements = {}
+        self.__dirty = set()
+        self.__nextGroupId = 0
+
+    def isExact(self):
+        """
+        Returns True if amounts are integer minor units
+        """
+        return self.__exact
+
+    def getNumTransactions(self):
+        """
+        Returns the number of transactions currently in the session
+        """
+        return self.__numTransactions
+
+    def getBalance(self, name):
+        """
+        Returns the net balance of a person (0 if they aren't in the session)
+        """
+        return self.__balances.get(name, 0)
+
+    def getNumGroups(self):
+        """
+        Returns the number of connected groups
+        """
+        return len(self.__members)
+
+    def getDirtyGroupCount(self):
+        """
+        Returns how many groups will be re-settled on the next settle()
+        """
+        return len(self.__dirty)
+
+    def __newGroup(self, names):
+        groupId = self.__nextGroupId
+        self.__nextGroupId += 1
+        self.__members[groupId] = dict.fromkeys(names)
+        for name in names:
+            self.__groupOf[name] = groupId
+        self.__dirty.add(groupId)
+        return groupId
+
+    def __dropGroup(self, groupId):
+        self.__members.pop(groupId)
+        self.__settlements.pop(groupId, None)
+        self.__dirty.discard(groupId)
+
+    def __adjustBalance(self, name, amount):
+        balance = self.__balances.get(name, 0) + amount
+        if not self.__exact and abs(balance) <= SETTLEMENT_EPSILON:
+            # don't let rounding dust turn into a payment
+            balance = 0
+        self.__balances[name] = balance
+
+    def __link(self, a, b):
+        links = self.__neighbours.setdefault(a, {})
+        links[b] = links.get(b, 0) + 1
+        links = self.__neighbours.setdefault(b, {})
+        links[a] = links.get(a, 0) + 1
+
+        for name in (a, b):
+            if name not in self.__groupOf:
+                self.__newGroup([name])
+
+        groupA = self.__groupOf[a]
+        groupB = self.__groupOf[b]
+        if groupA != groupB:
+            # Relabel the smaller group into the larger one
+            if len(self.__members[groupA]) < len(self.__members[groupB]):
+                groupA, groupB = groupB, groupA
+            for name in self.__members[groupB]:
+                self.__groupOf[name] = groupA
+            self.__members[groupA].update(self.__members[groupB])
+            self.__dropGroup(groupB)
+        self.__dirty.add(groupA)
+
+    def __unlink(self, a, b):
+        for x, y in ((a, b), (b, a)):
+            links = self.__neighbours[x]
+            links[y] -= 1
+            if links[y] == 0:
+                del links[y]
+
+        groupId = self.__groupOf[a]
+        self.__dirty.add(groupId)
+        if b in self.__neighbours[a]:
+            return
+
+        # The last edge between a and b is gone, so the group may have split.
+        # Walk it again (iteratively) starting from each side.
+        remaining = dict(self.__members[groupId])
+        self.__dropGroup(groupId)
+        for start in (a, b):
+            if start not in remaining:
+                continue
+            if not self.__neighbours[start]:
+                # Nobody left to owe or be owed by
+                del remaining[start]
+                del self.__groupOf[start]
+                del self.__neighbours[start]
+                self.__balances.pop(start)
+                continue
+            found = {start: None}
+            stack = [start]
+            while stack:
+                for other in self.__neighbours[stack.pop()]:
+                    if other not in found:
+                        found[other] = None
+                        stack.append(other)
+            for name in found:
+                del remaining[name]
+            self.__newGroup(found)
+
+    def addTransaction(self, payer, debtor, amount):
+        """
+        Records that payer paid amount on behalf of debtor
+
+        @param payer: str. Name of the person who paid (the creditor)
+        @param debtor: str. Name of the person who owes the money
+        @param amount: float, or int minor units in exact mode
+        """
+        pair = self.__pairs.get((payer, debtor))
+        if pair is None:
+            self.__pairs[(payer, debtor)] = Counter((amount,))
+            self.__link(payer, debtor)
+        else:
+            pair[amount] += 1
+            self.__dirty.add(self.__groupOf[payer])
+
+        self.__adjustBalance(payer, amount)
+        self.__adjustBalance(debtor, -amount)
+        self.__numTransactions += 1
+
+    def removeTransaction(self, payer, debtor, amount):
+        """
+        Removes one transaction previously added with addTransaction()
+
+        @raise KeyError: if payer never paid amount for debtor in this session
+        """
+        pair = self.__pairs.get((payer, debtor))
+        if pair is None or not pair[amount]:
+            raise KeyError("No transaction of {0} from {1} for {2}".format(amount, payer, debtor))
+
+        pair[amount] -= 1
+        if not pair[amount]:
+            del pair[amount]
+        self.__adjustBalance(payer, -amount)
+        self.__adjustBalance(debtor, amount)
+        self.__numTransactions -= 1
+
+        if not pair:
+            del self.__pairs[(payer, debtor)]
+            self.__unlink(payer, debtor)
+        else:
+            self.__dirty.add(self.__groupOf[payer])
+
+    def removeTransactions(self, transactions):
+        """
+        Removes a batch of transactions, all of them or none
+
+        The whole batch is checked before anything is removed, so a
+        transaction that isn't in the session leaves the session unchanged.
+
+        @param transactions: list of (payer, debtor, amount) tuples
+        @raise KeyError: if the batch removes a transaction (same payer,
+                         debtor and amount) more often than it was added
+        """
+        remaining = {}
+        for payer, debtor, amount in transactions:
+            key = (payer, debtor, amount)
+            if key not in remaining:
+                remaining[key] = self.__pairs.get((payer, debtor), Counter())[amount]
+            if remaining[key] == 0:
+                raise KeyError("No transaction of {0} from {1} for {2}".format(amount, payer, debtor))
+            remaining[key] -= 1
+
+        for transaction in transactions:
+            self.removeTransaction(*transaction)
+
+    def settle(self):
+        """
+        Re-settles the groups that changed and returns all payments
+
+        @return: list of Transaction named tuples, grouped by connected group
+        """
+        for groupId in self.__dirty:
+            names = list(self.__members[groupId])
+            balances = array('q' if self.__exact else 'd',
+                             (self.__balances[name] for name in names))
+            debtorIds, creditorIds, amounts = settleBalances(balances)
+            self.__settlements[groupId] = [
+                Transaction(debtor=names[d], creditor=names[c],
+                            amount=plainNumber(amount))
+                for d, c, amount in zip(debtorIds, creditorIds, amounts)]
+        self.__dirty.clear()
+
+        return list(itertools.chain.from_iterable(
+            self.__settlements[groupId] for groupId in sorted(self.__members)))
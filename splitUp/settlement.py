@@ -0,0 +1,491 @@
+"""
+Debt simplification engines and the batched, parallel settlement driver
+"""
+
+import itertools
+import time
+from array import array
+
+from .ledger import (PersonNode, SETTLEMENT_EPSILON, checkZeroSum, columnType,
+                     isExact, plainNumber)
+from .vectorized import loadNumpy, simplifyDebtsVectorized
+
+# Groups with at least this many people use the NumPy engine when available
+VECTORIZE_MIN_PEOPLE = 1000
+
+# Groups with at most this many non-zero balances are settled with the
+# minimum number of payments (see simplifyBalancesOptimal)
+OPTIMAL_MAX_PEOPLE = 20
+
+# Seconds the optimal solver may spend on one group before it gives up and
+# the group is settled greedily instead
+OPTIMAL_TIME_BUDGET = 0.1
+
+# The optimal solver only loads NumPy for groups of at least this many
+# people; below it the pure-Python loop finishes before NumPy would pay off
+OPTIMAL_VECTORIZE_PEOPLE = 10
+
+# Rough speed of zeroSumPartition() in (mask, person) steps per second, in
+# pure Python and with NumPy. A search of n people takes about 2**n * n
+# steps; one that would not fit OPTIMAL_TIME_BUDGET is not started at all
+OPTIMAL_PYTHON_STEPS_PER_SECOND = 7e6
+OPTIMAL_NUMPY_STEPS_PER_SECOND = 1.5e8
+
+# Small groups are batched together until a batch holds this many people,
+# so each trip to a worker process carries enough work to pay for the IPC
+PARALLEL_BATCH_PEOPLE = 2048
+
+# Below this many people in total, settling in-process beats starting a pool
+PARALLEL_MIN_PEOPLE = 50000
+
+def simplifyBalances(balances):
+    """
+    Settles a vector of net balances with the same greedy matching as simplifyDebts2
+
+    Works directly on balances instead of PersonNode objects and returns
+    the settlement as columns rather than a new PersonNode graph.
+
+    Integer balances (minor units) are settled exactly: they must sum to
+    zero and no rounding tolerance is applied.
+
+    @param balances: sequence of float or int. Net balance of each person id
+    @return: tuple of columns (debtorIds, creditorIds, amounts), one entry
+             per payment debtor must make to creditor
+    """
+    exact = isExact(balances)
+    if exact:
+        checkZeroSum(balances)
+
+    creditors = sorted((i for i, b in enumerate(balances) if b > 0),
+                       key=lambda i: -balances[i])
+    debtors = sorted((i for i, b in enumerate(balances) if b < 0),
+                     key=lambda i: balances[i])
+
+    debtorIds = array('q')
+    creditorIds = array('q')
+    amounts = array('q' if exact else 'd')
+    if not creditors or not debtors:
+        return debtorIds, creditorIds, amounts
+
+    i = 0
+    cMoney = balances[creditors[i]]
+    for d in debtors:
+        dMoney = balances[d]
+        while dMoney != 0:
+            temp = cMoney + dMoney
+            debtorIds.append(d)
+            creditorIds.append(creditors[i])
+            if temp > SETTLEMENT_EPSILON:
+                amounts.append(-dMoney)
+                cMoney = temp
+                break
+
+            amounts.append(cMoney)
+            dMoney = temp if temp < -SETTLEMENT_EPSILON else 0
+            i += 1
+            if i == len(creditors):
+                # whatever is left over is floating point error
+                return debtorIds, creditorIds, amounts
+            cMoney = balances[creditors[i]]
+
+    return debtorIds, creditorIds, amounts
+
+def zeroSumPartition(units, deadline=None):
+    """
+    Splits integer balances into as many zero-sum subsets as possible
+
+    Bitmask dynamic programming: best[mask] is the most zero-sum blocks the
+    people in mask can be split into, which is the best over dropping any
+    one person, plus one if mask itself sums to zero. Masks are filled in
+    order of size; with NumPy every size is one vectorized layer.
+
+    @param units: list of int. Non-zero balances summing to zero
+    @param deadline: float or None. time.perf_counter() value to give up at
+    @return: list of lists of indices into units, one per block, or None
+             if the deadline passed first
+    """
+    n = len(units)
+    full = (1 << n) - 1
+    np = loadNumpy() if n >= OPTIMAL_VECTORIZE_PEOPLE else None
+    if np is not None:
+        sums = np.zeros(1, dtype=np.int64)
+        sizes = np.zeros(1, dtype=np.int8)
+        for unit in units:
+            sums = np.concatenate((sums, sums + unit))
+            sizes = np.concatenate((sizes, sizes + 1))
+        zero = sums == 0
+        best = np.zeros(full + 1, dtype=np.int8)
+        layers = np.argsort(sizes, kind='stable')
+        bounds = np.cumsum(np.bincount(sizes))
+        for size in range(1, n + 1):
+            if deadline is not None and time.perf_counter() > deadline:
+                return None
+            masks = layers[bounds[size - 1]:bounds[size]]
+            most = np.zeros(masks.size, dtype=np.int8)
+            for i in range(n):
+                # Masks without bit i look at a bigger mask that is still 0
+                np.maximum(most, best[masks ^ (1 << i)], out=most)
+            best[masks] = most + zero[masks]
+        zero = zero.tolist()
+        best = best.tolist()
+    else:
+        sums = array('q', bytes(8 << n))
+        best = bytearray(full + 1)
+        for mask in range(1, full + 1):
+            if mask & 0x3ff == 1 and deadline is not None \
+                    and time.perf_counter() > deadline:
+                return None
+            low = mask & -mask
+            sums[mask] = sums[mask ^ low] + units[low.bit_length() - 1]
+            most = 0
+            bits = mask
+            while bits:
+                bit = bits & -bits
+                if best[mask ^ bit] > most:
+                    most = best[mask ^ bit]
+                bits ^= bit
+            best[mask] = most + (sums[mask] == 0)
+        zero = [total == 0 for total in sums]
+
+    # Walk back from everyone to no one; consecutive zero-sum masks on the
+    # way differ by exactly one block
+    blocks = []
+    mask = blockEnd = full
+    while mask:
+        bits = mask
+        while bits:
+            bit = bits & -bits
+            if best[mask ^ bit] + zero[mask] == best[mask]:
+                break
+            bits ^= bit
+        mask ^= bit
+        if zero[mask]:
+            block = blockEnd ^ mask
+            blocks.append([i for i in range(n) if block >> i & 1])
+            blockEnd = mask
+    return blocks
+
+def estimatePartitionSeconds(n):
+    """
+    Estimates how long zeroSumPartition() takes for n balances
+
+    @param n: int. Number of non-zero balances
+    @return: float. Seconds, from the engine zeroSumPartition() would use
+    """
+    vectorized = n >= OPTIMAL_VECTORIZE_PEOPLE and loadNumpy() is not None
+    rate = OPTIMAL_NUMPY_STEPS_PER_SECOND if vectorized else OPTIMAL_PYTHON_STEPS_PER_SECOND
+    return (1 << n) * n / rate
+
+def simplifyBalancesOptimal(balances, timeBudget=OPTIMAL_TIME_BUDGET,
+                            maxPeople=OPTIMAL_MAX_PEOPLE, resolution=1e-6):
+    """
+    Settles a balance vector with the minimum possible number of payments
+
+    A group whose balances split into k separate zero-sum subsets needs
+    only (people - k) payments, which the greedy matching in
+    simplifyBalances() does not look for. Exactly opposite balances are
+    always one such subset, so they are paired off first and the rest is
+    partitioned with zeroSumPartition(). Each subset is then settled with
+    simplifyBalances().
+
+    @param balances: sequence of float or int. Net balance of each person id
+    @param timeBudget: float or None. Seconds to search before giving up.
+                       A search estimated to take longer is not started
+                       (see estimatePartitionSeconds)
+    @param maxPeople: int. Give up straight away above this many non-zero
+                      balances (the search is exponential)
+    @param resolution: float. Smallest amount of money told apart (floats only)
+    @return: tuple of columns (debtorIds, creditorIds, amounts) like
+             simplifyBalances(), or None if the group is too big or the
+             time budget ran out
+    """
+    exact = isExact(balances)
+    if exact:
+        checkZeroSum(balances)
+        units = list(balances)
+    else:
+        units = [round(balance / resolution) for balance in balances]
+
+    people = [i for i, unit in enumerate(units) if unit != 0]
+    blocks = []
+    unpaired = {}
+    rest = []
+    for i in people:
+        partners = unpaired.get(-units[i])
+        if partners:
+            blocks.append([partners.pop(), i])
+        else:
+            unpaired.setdefault(units[i], []).append(i)
+    for partners in unpaired.values():
+        rest.extend(partners)
+    rest.sort()
+
+    if len(rest) > maxPeople:
+        return None
+    if rest and timeBudget is not None and estimatePartitionSeconds(len(rest)) > timeBudget:
+        return None
+    if rest:
+        deadline = None if timeBudget is None else time.perf_counter() + timeBudget
+        partition = zeroSumPartition([units[i] for i in rest], deadline)
+        if partition is None:
+            return None
+        blocks.extend([rest[i] for i in block] for block in partition)
+
+    debtorIds = array('q')
+    creditorIds = array('q')
+    amounts = array('q' if exact else 'd')
+    for block in blocks:
+        owers, payers, paid = simplifyBalances(
+            array(amounts.typecode, (balances[i] for i in block)))
+        debtorIds.extend(block[i] for i in owers)
+        creditorIds.extend(block[i] for i in payers)
+        amounts.extend(paid)
+    return debtorIds, creditorIds, amounts
+
+def settleBalances(balances):
+    """
+    Settles one group's balance vector with the best engine for its size
+
+    Small groups get the minimum number of payments from
+    simplifyBalancesOptimal() if it finishes within OPTIMAL_TIME_BUDGET;
+    everything else is matched greedily, vectorized when that pays off.
+
+    @param balances: sequence of float. Net balance of each person id
+    @return: tuple of columns (debtorIds, creditorIds, amounts)
+    """
+    if len(balances) >= VECTORIZE_MIN_PEOPLE and loadNumpy() is not None:
+        return simplifyDebtsVectorized(balances)
+    # Opposite pairs are split off before the size check, so allow some slack
+    if len(balances) <= 2 * OPTIMAL_MAX_PEOPLE:
+        settlement = simplifyBalancesOptimal(balances)
+        if settlement is not None:
+            return settlement
+    return simplifyBalances(balances)
+
+def settleBalanceBatch(batch):
+    """
+    Settles a batch of balance vectors (runs inside a worker process)
+
+    @param batch: list of array('d'). One balance vector per group
+    @return: list of settlement columns, in the same order as batch
+    """
+    return [settleBalances(balances) for balances in batch]
+
+def groupBalances(group):
+    """
+    Flattens a group of PersonNodes into compact names and balances
+
+    @param group: iterable of PersonNode objects
+    @return: tuple (names, balances) with balances as an array('d'), or
+             an array('q') of minor units when every balance is exact
+    """
+    names = []
+    totals = []
+    for person in group:
+        names.append(person.getName())
+        totals.append(person.getTotalMoney())
+    return names, array('q' if isExact(totals) else 'd', totals)
+
+def peopleFromSettlement(names, settlement):
+    """
+    Builds simplified PersonNode objects from settlement columns
+
+    @param names: list of str. Name of each person id in the group
+    @param settlement: tuple of columns (debtorIds, creditorIds, amounts)
+    @return: list of PersonNode objects, like simplifyDebts2() returns
+    """
+    nodes = {}
+    for debtorId, creditorId, amount in zip(*settlement):
+        for personId in (creditorId, debtorId):
+            if personId not in nodes:
+                nodes[personId] = PersonNode(names[personId])
+        nodes[creditorId].addDebt(nodes[debtorId], plainNumber(amount))
+    return list(nodes.values())
+
+def settleGroups(allGroups, maxWorkers=None, batchPeople=PARALLEL_BATCH_PEOPLE,
+                 minParallelPeople=PARALLEL_MIN_PEOPLE):
+    """
+    Simplifies every independent group, in parallel when it is worth it
+
+    Groups are sent to a ProcessPoolExecutor as compact balance arrays
+    rather than pickled PersonNode graphs. Small groups are batched together
+    to amortize IPC cost, and results are merged back in group order, so
+    the output is the same no matter how the work was scheduled.
+
+    @param allGroups: list of sets of PersonNode objects (see splitUpGroups)
+    @param maxWorkers: int or None. Worker processes (None = one per core,
+                       1 = always settle in-process)
+    @param batchPeople: int. Minimum number of people sent per batch
+    @param minParallelPeople: int. Minimum total people before a pool is used
+    @return: list of PersonNode objects representing simplified transactions
+    """
+    payloads = [groupBalances(group) for group in allGroups]
+    settlements = settlePayloads(payloads, maxWorkers, batchPeople,
+                                 minParallelPeople)
+
+    simplifiedPeople = []
+    for (names, _), settlement in zip(payloads, settlements):
+        simplifiedPeople.extend(peopleFromSettlement(names, settlement))
+
+    return simplifiedPeople
+
+def settlePayloads(payloads, maxWorkers=None, batchPeople=PARALLEL_BATCH_PEOPLE,
+                   minParallelPeople=PARALLEL_MIN_PEOPLE):
+    """
+    Settles (names, balances) payloads, batched across a process pool
+
+    @param payloads: list of (names, balances) tuples, one per group
+    @param maxWorkers, batchPeople, minParallelPeople: see settleGroups()
+    @return: list of settlement columns, in the same order as payloads
+    """
+    batches = []
+    batchSize = batchPeople
+    for names, balances in payloads:
+        if batchSize >= batchPeople:
+            batches.append([])
+            batchSize = 0
+        batches[-1].append(balances)
+        batchSize += len(balances)
+
+    totalPeople = sum(len(names) for names, _ in payloads)
+    if maxWorkers == 1 or len(batches) < 2 or totalPeople < minParallelPeople:
+        results = map(settleBalanceBatch, batches)
+    else:
+        # Imported here: starting a pool is rare, importing it is not cheap
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=maxWorkers) as pool:
+            # map() yields in submission order, keeping the merge deterministic
+            results = list(pool.map(settleBalanceBatch, batches))
+
+    return list(itertools.chain.from_iterable(results))
+
+def settleBalanceColumns(table, maxWorkers=None, nodes=None):
+    """
+    Simplifies every component of a BalanceTable into one set of columns
+
+    No PersonNode objects are built; the payments refer to people by
+    their index in table.names.
+
+    @param table: BalanceTable (see readBalancesMapped, Ledger.toBalanceTable)
+    @param maxWorkers: int or None. See settleGroups()
+    @param nodes: list of (host, port) or None. Settle on these worker
+                  nodes instead of local processes (see settleDistributed)
+    @return: tuple of columns (debtorIds, creditorIds, amounts)
+    """
+    moneyType = columnType(table.balances)
+    payloads = []
+    for personId, componentId in enumerate(table.componentIds):
+        if componentId == len(payloads):
+            payloads.append(([], array(moneyType)))
+        personIds, balances = payloads[componentId]
+        personIds.append(personId)
+        balances.append(table.balances[personId])
+
+    debtorIds = array('q')
+    creditorIds = array('q')
+    amounts = array(moneyType)
+    if nodes:
+        # Imported here: only batch runs spread over machines need it
+        from .distributed import settleDistributed
+        settlements = settleDistributed(payloads, nodes)
+    else:
+        settlements = settlePayloads(payloads, maxWorkers)
+    for (personIds, _), (owers, payers, paid) in zip(payloads, settlements):
+        debtorIds.extend(personIds[i] for i in owers)
+        creditorIds.extend(personIds[i] for i in payers)
+        amounts.extend(map(plainNumber, paid))
+    return debtorIds, creditorIds, amounts
+
+def settleBalanceTable(table, maxWorkers=None):
+    """
+    Simplifies every component of a BalanceTable (see readBalancesMapped)
+
+    @param table: BalanceTable
+    @param maxWorkers: int or None. See settleGroups()
+    @return: list of PersonNode objects representing simplified transactions
+    """
+    return peopleFromSettlement(table.names,
+                                settleBalanceColumns(table, maxWorkers))
+
+def simplifyDebts2(people):
+    """
+    Simplifies debts by focusing only on net balances, ignoring individual transactions
+
+    This is the main debt simplification algorithm. It calculates each person's
+    net balance (total money owed to them minus total money they owe) and then
+    creates the minimum number of transactions to settle all debts.
+
+    Algorithm:
+    1. Separate people into creditors (net positive) and debtors (net negative)
+    2. Sort creditors by amount owed (descending) and debtors by amount owed (ascending)
+    3. Match debtors with creditors to minimize total number of transactions
+
+    @param people: list of PersonNode objects in a connected group
+    @return: list of PersonNode objects representing simplified transactions
+    """
+    # Sort out between creditors and debtors
+    sortedPeeps = sorted(people,
+                         key=lambda item: item.getTotalMoney())
+    creditors = []
+    debtors = []
+
+    for person in sortedPeeps:
+        if person.getTotalMoney() > 0:
+            creditors.append(person)
+        elif person.getTotalMoney() < 0:
+            debtors.append(person)
+
+    if len(creditors) == 0 and len(debtors) == 0:
+        return []
+    if isExact(p.getTotalMoney() for p in sortedPeeps):
+        # exact minor units never need the tolerance fallback below
+        checkZeroSum(p.getTotalMoney() for p in sortedPeeps)
+    if bool(len(creditors) == 0) ^ bool(len(debtors) == 0):
+        print(("Somehow creditors or debtors == 0, " +
+               "but the other was not. Printing." +
+               "\ncreditors: {0}\ndebtors: {1}").format(creditors, debtors))
+
+    creditors.sort(reverse=True, key=lambda x: x.getTotalMoney())
+    debtors.sort(key=lambda x: x.getTotalMoney())
+
+    simplifiedGroup = []
+
+    # Create new creditor and debtor nodes to
+    # represent the simplified transactions
+    i = 0
+    cMoney = creditors[i].getTotalMoney()
+    newCreditorNode = PersonNode(creditors[i].getName())
+    simplifiedGroup.append(newCreditorNode)
+
+    for d in debtors:
+        newDebtorNode = PersonNode(d.getName())
+        simplifiedGroup.append(newDebtorNode)
+        dMoney = d.getTotalMoney()
+
+        while True:
+            temp = cMoney + dMoney
+            if dMoney == 0:
+                break
+
+            if temp > SETTLEMENT_EPSILON:
+                newCreditorNode.addDebt(newDebtorNode, dMoney * -1)
+                cMoney = temp
+                break
+            else:
+                newCreditorNode.addDebt(newDebtorNode, cMoney)
+                # don't carry rounding dust over into an extra payment
+                dMoney = temp if temp < -SETTLEMENT_EPSILON else 0
+                i += 1
+                if len(creditors) > i:
+                    cMoney = creditors[i].getTotalMoney()
+                    newCreditorNode = PersonNode(creditors[i].getName())
+                    simplifiedGroup.append(newCreditorNode)
+                elif abs(temp) < 0.01:
+                    # tolerance comparison for floating point error
+                    break
+                else:
+                    print("Error: No more creditors left, " +
+                          "yet there is still debt to be paid.")
+                    break
+
+    return simplifiedGroup
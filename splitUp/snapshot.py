@@ -0,0 +1,314 @@
+"""
+Binary ledger snapshots: save a ledger once, reload it without reparsing
+
+A snapshot is a fixed header followed by columns, each padded to 8 bytes:
+
+    header          SNAPSHOT_HEADER: magic, version, flags, counts, checksum
+    name offsets    int64 x (people + 1), into the name bytes
+    name bytes      every name in id order, utf-8, back to back
+    balances        int64 (exact mode) or float64 x people
+    component ids   int64 x people
+    payer ids       int64 x edges
+    debtor ids      int64 x edges
+    amounts         int64 (exact mode) or float64 x edges
+
+Numbers are little-endian. The checksum is a CRC-32 of the header fields
+before it and of every byte after the header. readSnapshot() memory-maps
+the file and hands out memoryviews of the columns without copying them,
+and names are only decoded when they are looked up, so loading costs the
+same no matter how big the ledger is.
+"""
+
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from collections.abc import Sequence
+
+from .ledger import BalanceTable, Ledger, columnType
+
+SNAPSHOT_MAGIC = b'SPLTSNAP'
+SNAPSHOT_VERSION = 1
+
+# File extension of snapshots written by the batch command line
+SNAPSHOT_SUFFIX = '.snapshot'
+
+# magic, version, flags, people, transactions, edges, name bytes, checksum
+SNAPSHOT_HEADER = struct.Struct('<8sII4qI4x')
+
+# Length of the header fields covered by the checksum (all before it)
+CHECKSUMMED_HEADER_BYTES = SNAPSHOT_HEADER.size - 8
+
+# Header flag: amounts and balances are int64 minor units (see parseCents)
+SNAPSHOT_EXACT = 1
+
+# Columns are stored little-endian; big-endian machines swap a copy
+NATIVE_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+class SnapshotError(ValueError):
+    """
+    A file that is not a snapshot, is of another version, or is damaged.
+    """
+
+class NameTable(Sequence):
+    """
+    Read-only list of names decoded from the name bytes of a snapshot.
+
+    Each name is decoded from the mapped file when it is looked up, so
+    opening a snapshot builds no per-person objects.
+    """
+    def __init__(self, offsets, data):
+        self.__offsets = offsets
+        self.__data = data
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def __getitem__(self, personId):
+        if isinstance(personId, slice):
+            return [self[i] for i in range(*personId.indices(len(self)))]
+        if personId < 0:
+            personId += len(self)
+        if not 0 <= personId < len(self):
+            raise IndexError("name id out of range")
+        return str(self.__data[self.__offsets[personId]:self.__offsets[personId + 1]],
+                   'utf-8')
+
+def padding(size):
+    """
+    Returns the zero bytes that pad size bytes to a multiple of 8
+    """
+    return bytes(-size % 8)
+
+def columnBytes(column, typecode):
+    """
+    Returns the little-endian bytes of a column of ids or amounts
+    """
+    if columnType(column) != typecode:
+        column = array(typecode, column)
+    if NATIVE_LITTLE_ENDIAN:
+        return bytes(column)
+    swapped = array(typecode, column)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+def writeSnapshot(path, table, edges=None):
+    """
+    Writes a ledger's balances, components and transactions to a snapshot
+
+    @param path: str. File to write (replaced if it exists)
+    @param table: BalanceTable (see Ledger.toBalanceTable, readBalancesMapped)
+    @param edges: tuple of columns (payer ids, debtor ids, amounts) or None
+                  to store the balances only (see Ledger.getEdges)
+    @return: int. Size of the snapshot in bytes
+    """
+    moneyType = columnType(table.balances)
+    exact = moneyType == 'q'
+    if edges is None:
+        edges = (array('q'), array('q'), array(moneyType))
+    payerIds, debtorIds, amounts = edges
+
+    encoded = [name.encode('utf-8') for name in table.names]
+    offsets = array('q', [0])
+    for name in encoded:
+        offsets.append(offsets[-1] + len(name))
+    nameBytes = b''.join(encoded)
+
+    sections = [columnBytes(offsets, 'q'), nameBytes + padding(len(nameBytes)),
+                columnBytes(table.balances, moneyType),
+                columnBytes(table.componentIds, 'q'),
+                columnBytes(payerIds, 'q'), columnBytes(debtorIds, 'q'),
+                columnBytes(amounts, moneyType)]
+
+    fields = (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SNAPSHOT_EXACT if exact else 0,
+              len(table.names), table.numTransactions, len(amounts), len(nameBytes))
+    checksum = zlib.crc32(SNAPSHOT_HEADER.pack(*fields, 0)[:CHECKSUMMED_HEADER_BYTES])
+    for section in sections:
+        checksum = zlib.crc32(section, checksum)
+
+    with open(path, 'wb') as output:
+        output.write(SNAPSHOT_HEADER.pack(*fields, checksum))
+        for section in sections:
+            output.write(section)
+        return output.tell()
+
+def isSnapshot(path):
+    """
+    Returns True if the file at path starts with the snapshot magic bytes
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+class LedgerSnapshot():
+    """
+    A memory-mapped snapshot, read column by column without copying.
+
+    The columns are memoryviews of the file, cast to int64 or float64, and
+    stay valid until close(). toBalanceTable() feeds them straight into
+    settleBalanceColumns()/settleBalanceTable().
+    """
+    def __init__(self, mapped, verify=True):
+        self.__mapped = mapped
+        self.__views = []
+        try:
+            self.__load(memoryview(mapped), verify)
+        except SnapshotError:
+            self.close()
+            raise
+
+    def __load(self, view, verify):
+        """
+        Checks the header and checksum and maps every column
+        """
+        self.__views.append(view)
+        if len(view) < SNAPSHOT_HEADER.size:
+            raise SnapshotError("file is too short to be a snapshot")
+
+        (magic, version, flags, people, numTransactions, numEdges, nameBytes,
+         checksum) = SNAPSHOT_HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("not a ledger snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError("snapshot version {0} is not supported (expected {1})"
+                                .format(version, SNAPSHOT_VERSION))
+        self.__exact = bool(flags & SNAPSHOT_EXACT)
+        self.__numTransactions = numTransactions
+        moneyType = 'q' if self.__exact else 'd'
+
+        sizes = [8 * (people + 1), nameBytes + len(padding(nameBytes)),
+                 8 * people, 8 * people, 8 * numEdges, 8 * numEdges, 8 * numEdges]
+        if len(view) != SNAPSHOT_HEADER.size + sum(sizes):
+            raise SnapshotError("snapshot is truncated or has trailing data")
+        if verify:
+            expected = zlib.crc32(view[:CHECKSUMMED_HEADER_BYTES])
+            if zlib.crc32(view[SNAPSHOT_HEADER.size:], expected) != checksum:
+                raise SnapshotError("snapshot checksum does not match its contents")
+
+        columns = []
+        start = SNAPSHOT_HEADER.size
+        for size, typecode in zip(sizes, ('q', 'B', moneyType, 'q', 'q', 'q', moneyType)):
+            columns.append(self.__column(view[start:start + size], typecode))
+            start += size
+        offsets, names, balances, componentIds, payerIds, debtorIds, amounts = columns
+
+        self.__names = NameTable(offsets, names)
+        self.__balances = balances
+        self.__componentIds = componentIds
+        self.__edges = (payerIds, debtorIds, amounts)
+
+    def __column(self, section, typecode):
+        """
+        Returns a section of the file as a column of typecode
+        """
+        if typecode == 'B':
+            self.__views.append(section)
+            return section
+        if NATIVE_LITTLE_ENDIAN:
+            column = section.cast(typecode)
+            self.__views.extend((section, column))
+            return column
+        column = array(typecode, bytes(section))
+        column.byteswap()
+        return column
+
+    def __len__(self):
+        """
+        Returns the number of people in the snapshot
+        """
+        return len(self.__names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+    def isExact(self):
+        """
+        Returns True if amounts are stored as integer minor units
+        """
+        return self.__exact
+
+    def getNames(self):
+        """
+        Returns the names, indexed by id, as a read-only NameTable
+        """
+        return self.__names
+
+    def getBalances(self):
+        """
+        Returns the net balances, indexed by id
+        """
+        return self.__balances
+
+    def getComponentIds(self):
+        """
+        Returns the component number of every person id
+        """
+        return self.__componentIds
+
+    def getEdges(self):
+        """
+        Returns the transaction columns (payer ids, debtor ids, amounts)
+
+        The columns are empty if the snapshot only stored balances.
+        """
+        return self.__edges
+
+    def getNumTransactions(self):
+        """
+        Returns the number of transactions the balances were summed from
+        """
+        return self.__numTransactions
+
+    def toBalanceTable(self):
+        """
+        Returns the snapshot's balances and components as a BalanceTable
+        """
+        return BalanceTable(self.__names, self.__balances, self.__componentIds,
+                            self.__numTransactions)
+
+    def toLedger(self):
+        """
+        Rebuilds a Ledger, with every transaction, from the snapshot
+
+        @return: Ledger
+        @raise SnapshotError: if the snapshot only stored balances
+        """
+        payerIds, debtorIds, amounts = self.__edges
+        if len(amounts) != self.__numTransactions:
+            raise SnapshotError("snapshot only stores balances, not transactions")
+        ledger = Ledger(exact=self.__exact)
+        for name in self.__names:
+            ledger.internName(name)
+        ledger.addTransactionIds(payerIds, debtorIds, amounts)
+        return ledger
+
+    def close(self):
+        """
+        Unmaps the file; the columns cannot be used afterwards
+
+        @raise BufferError: if slices of the columns are still in use
+        """
+        while self.__views:
+            self.__views.pop().release()
+        self.__mapped.close()
+
+def readSnapshot(path, verify=True):
+    """
+    Opens a snapshot written by writeSnapshot()
+
+    @param path: str. Snapshot file
+    @param verify: bool. Check the checksum (reads the whole file once)
+    @return: LedgerSnapshot. Close it (or use it as a context manager)
+             once its columns are no longer needed
+    @raise SnapshotError: if the file is not a valid snapshot
+    """
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            raise SnapshotError("file is too short to be a snapshot")
+    return LedgerSnapshot(mapped, verify)
@@ -0,0 +1,98 @@
+"""
+Optional NumPy settlement engine
+
+NumPy is only imported the first time something asks for it (see
+loadNumpy), so the pure-Python paths start up without paying for it.
+"""
+
+import threading
+
+# The numpy module once loadNumpy() has run (None if it is not installed)
+np = None
+numpyLoaded = False
+numpyLock = threading.Lock()
+
+def loadNumpy():
+    """
+    Imports NumPy on first use
+
+    @return: module or None. numpy, or None if it is not installed
+    """
+    global np, numpyLoaded
+    if not numpyLoaded:
+        with numpyLock:
+            if not numpyLoaded:
+                try:
+                    import numpy
+                except ImportError:
+                    # NumPy is optional; every caller has a pure-Python path
+                    numpy = None
+                np = numpy
+                numpyLoaded = True
+    return np
+
+def simplifyDebtsVectorized(balances, resolution=1e-6):
+    """
+    Vectorized NumPy version of simplifyBalances() for very large groups
+
+    Creditors are sorted by amount owed (descending) and debtors by amount
+    owing (descending) with argsort. Laying both out on one money line, the
+    greedy matching pays debtor d to creditor c for every stretch where d's
+    and c's cumulative ranges overlap, so the payments are exactly the gaps
+    between the merged cumulative sums. searchsorted maps each gap back to
+    its debtor and creditor, with no Python-level loop.
+
+    The cumulative sums are taken in int64 multiples of resolution so that
+    ties stay exact over millions of people instead of drifting apart.
+    Integer balances are taken as exact minor units and settled as is.
+
+    @param balances: array-like of float or int. Net balance of each person id
+    @param resolution: float. Smallest amount of money told apart (floats only)
+    @return: tuple of NumPy arrays (debtorIds, creditorIds, amounts), with
+             int64 amounts for integer balances and float64 otherwise
+    """
+    np = loadNumpy()
+    if np is None:
+        raise ImportError("simplifyDebtsVectorized requires NumPy")
+
+    balances = np.asarray(balances)
+    exact = np.issubdtype(balances.dtype, np.integer)
+    if exact:
+        # Already exact minor units
+        units = balances.astype(np.int64, copy=False)
+        if units.sum() != 0:
+            raise ValueError("Balances are off by {0} minor units"
+                             .format(units.sum()))
+    else:
+        units = np.rint(balances.astype(np.float64) / resolution)
+        units = units.astype(np.int64)
+    creditorIds = np.flatnonzero(units > 0)
+    debtorIds = np.flatnonzero(units < 0)
+    if creditorIds.size == 0 or debtorIds.size == 0:
+        # Same dtypes as a non-empty settlement of the same input
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty.copy(), np.empty(0, dtype=np.int64 if exact else np.float64)
+
+    creditorIds = creditorIds[np.argsort(-units[creditorIds], kind='stable')]
+    debtorIds = debtorIds[np.argsort(units[debtorIds], kind='stable')]
+    creditCum = np.cumsum(units[creditorIds])
+    debtCum = np.cumsum(-units[debtorIds])
+
+    # Anything beyond the smaller total is rounding error
+    total = min(creditCum[-1], debtCum[-1])
+    # Both cumulative sums are already sorted, so a stable sort is a merge
+    edges = np.concatenate((creditCum, debtCum))
+    edges.sort(kind='stable')
+    edges = edges[edges < total]
+    edges = np.concatenate(([0], edges, [total]))
+    gaps = np.diff(edges)
+    keep = gaps > 0
+    starts = edges[:-1][keep]
+    gaps = gaps[keep]
+
+    # Each gap lies inside exactly one creditor's and one debtor's range
+    payers = creditorIds[np.searchsorted(creditCum, starts, side='right')]
+    owers = debtorIds[np.searchsorted(debtCum, starts, side='right')]
+    if exact:
+        return owers, payers, gaps
+    return owers, payers, gaps * resolution
@@ -3,6 +3,11 @@ let allTransactions = [];
 let allNames = new Set();
 let uploadedFiles = new Map();
 
+// Files bigger than this are settled on the server as a background job
+// instead of being parsed in the browser
+const LARGE_UPLOAD_BYTES = 5 * 1024 * 1024;
+const JOB_POLL_INTERVAL_MS = 500;
+
 // Transaction builder state
 let transactionBuilder = {
     creditor: null,
@@ -386,6 +391,11 @@ function loadCSV() {
             return;
         }
 
+        if (file.size > LARGE_UPLOAD_BYTES) {
+            uploadLargeCSV(file);
+            return;
+        }
+
         const reader = new FileReader();
         reader.onload = function(e) {
             try {
@@ -397,16 +407,19 @@ function loadCSV() {
                     line = line.trim();
                     if (line) {
                         const parts = line.split(',');
-                        if (parts.length === 3) {
+                        // An optional fourth column is the currency, converted on the server
+                        if (parts.length === 3 || parts.length === 4) {
                             const creditor = parts[0].trim();
                             const debtor = parts[1].trim();
                             const amount = parseFloat(parts[2]);
+                            const currency = parts.length === 4 ? parts[3].trim().toUpperCase() : '';
 
                             if (creditor && debtor && !isNaN(amount) && amount > 0) {
                                 csvTransactions.push({
                                     creditor: creditor,
                                     debtor: debtor,
                                     amount: amount,
+                                    currency: currency,
                                     source: 'csv',
                                     filename: file.name
                                 });
@@ -440,6 +453,65 @@ function loadCSV() {
     });
 }
 
+// Large files: upload as a background job, poll its progress, then show the results
+function uploadLargeCSV(file) {
+    const formData = new FormData();
+    formData.append('file', file);
+    showJobStatus(`Uploading "${file.name}"...`);
+
+    fetch('/jobs', { method: 'POST', body: formData })
+    .then(response => response.json().then(data => {
+        if (!response.ok) {
+            throw new Error(data.error || 'Upload failed');
+        }
+        pollUploadJob(file.name, data.status_url, data.result_url);
+    }))
+    .catch(error => {
+        showJobStatus(null);
+        showCSVError(`Error uploading "${file.name}": ${error.message}`);
+    });
+}
+
+function pollUploadJob(filename, statusUrl, resultUrl) {
+    fetch(statusUrl)
+    .then(response => response.json())
+    .then(job => {
+        if (job.status === 'failed') {
+            throw new Error(job.error);
+        }
+        if (job.status !== 'done') {
+            const stage = job.stage ? `${job.stage}, ` : '';
+            showJobStatus(`"${filename}": ${job.status} (${stage}${job.rows.toLocaleString()} rows)`);
+            setTimeout(() => pollUploadJob(filename, statusUrl, resultUrl), JOB_POLL_INTERVAL_MS);
+            return;
+        }
+
+        showJobStatus(`"${filename}": rendering results...`);
+        return fetch(resultUrl)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Could not fetch results');
+                }
+                return response.text();
+            })
+            .then(html => {
+                document.open();
+                document.write(html);
+                document.close();
+            });
+    })
+    .catch(error => {
+        showJobStatus(null);
+        showCSVError(`Error processing "${filename}": ${error.message}`);
+    });
+}
+
+function showJobStatus(message) {
+    const statusDiv = document.getElementById('jobStatus');
+    statusDiv.textContent = message || '';
+    statusDiv.style.display = message ? 'block' : 'none';
+}
+
 function showCSVError(message) {
     const errorDiv = document.getElementById('csvErrorMessage');
     errorDiv.textContent = message;
@@ -514,7 +586,7 @@ function updateTransactionsList() {
             return `
                 <div class="transaction-item">
                     <div class="transaction-info">
-                        <strong>${t.creditor}</strong> paid $${t.amount.toFixed(2)} to <strong>${t.debtor}</strong>
+                        <strong>${t.creditor}</strong> paid ${t.currency ? t.currency + ' ' : '$'}${t.amount.toFixed(2)} to <strong>${t.debtor}</strong>
                         ${splitInfoDisplay}
                         <span class="transaction-source">${sourceLabel}</span>
                     </div>
@@ -569,7 +641,8 @@ function processAllTransactions() {
             transactions: allTransactions.map(t => ({
                 creditor: t.creditor,
                 debtor: t.debtor,
-                amount: t.amount
+                amount: t.amount,
+                currency: t.currency || ''
             }))
         })
     })
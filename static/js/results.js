@@ -1,67 +1,174 @@
+// Virtualized lists: only the rows in view (plus a margin) are in the DOM,
+// fetched a page at a time from /results/<id>/rows/<list>
+const VIRTUAL_ROW_HEIGHT = 44;
+const VIRTUAL_LIST_OVERSCAN = 10;
+
+// Level of detail of the debt network: the server merges everyone past
+// NETWORK_MAX_NODES into one node and keeps the NETWORK_MAX_EDGES biggest
+// debts; amounts are only labelled when few enough arrows are drawn
+const NETWORK_MAX_NODES = 40;
+const NETWORK_MAX_EDGES = 120;
+const NETWORK_LABEL_EDGES = 40;
+
+const resultConfig = JSON.parse(document.getElementById('result-config').textContent);
+const virtualLists = [];
+let debtNetwork = null;
+
 // Initialize theme when page loads
 document.addEventListener('DOMContentLoaded', function() {
     initTheme();
-    createDebtNetwork();
+    document.querySelectorAll('.virtual-list').forEach(container => {
+        virtualLists.push(createVirtualList(container));
+    });
+    window.addEventListener('resize', refreshVirtualLists);
+    loadDebtNetwork();
 });
 
 // toggleCollapse function is now in shared.js
 
-// Create debt network visualization
-function createDebtNetwork() {
-    // Get data from hidden script tag to avoid Jinja2 syntax issues
-    const dataScript = document.getElementById('transaction-data');
-    if (!dataScript) {
-        console.error('transaction-data script tag not found');
-        return;
-    }
+function createVirtualList(container) {
+    const list = {
+        container: container,
+        name: container.dataset.list,
+        total: parseInt(container.dataset.total, 10),
+        pages: new Map(),
+        expired: false
+    };
 
-    let originalTransactions = [];
-    try {
-        originalTransactions = JSON.parse(dataScript.textContent);
-    } catch (e) {
-        console.error('Error parsing transaction data:', e);
-        return;
-    }
+    list.spacer = document.createElement('div');
+    list.spacer.className = 'virtual-list-spacer';
+    list.spacer.style.height = `${list.total * VIRTUAL_ROW_HEIGHT}px`;
+    container.appendChild(list.spacer);
+    container.addEventListener('scroll', () => renderVirtualList(list));
 
-    if (!originalTransactions || originalTransactions.length === 0) {
-        const svg = document.getElementById('debtNetworkSvg');
-        if (svg) {
-            svg.innerHTML = '<text x="400" y="300" text-anchor="middle" fill="#999999" font-size="16">No transactions to display</text>';
-        }
-        return;
-    }
+    renderVirtualList(list);
+    return list;
+}
 
-    // Build debt relationships from original transactions
-    const debtMap = new Map();
-    const people = new Set();
+function refreshVirtualLists() {
+    virtualLists.forEach(renderVirtualList);
+}
 
-    originalTransactions.forEach(transaction => {
-        // Handle both old dictionary format and new named tuple format
-        const creditor = transaction.creditor || transaction.creditor;
-        const debtor = transaction.debtor;
-        const amount = parseFloat(transaction.amount);
+function loadListPage(list, page) {
+    if (list.pages.has(page) || list.expired) return;
+    list.pages.set(page, null); // loading
 
-        if (!creditor || !debtor || isNaN(amount)) {
-            console.warn('Invalid transaction data:', transaction);
-            return;
+    const offset = page * resultConfig.page_rows;
+    fetch(`/results/${resultConfig.result_id}/rows/${list.name}?offset=${offset}&limit=${resultConfig.page_rows}`)
+    .then(response => {
+        if (response.status === 404) {
+            list.expired = true;
         }
+        if (!response.ok) {
+            throw new Error('Could not load transactions');
+        }
+        return response.json();
+    })
+    .then(data => {
+        list.pages.set(page, data.rows);
+        renderVirtualList(list);
+    })
+    .catch(error => {
+        list.pages.delete(page);
+        if (list.expired) {
+            list.container.textContent = 'These results have expired. Please process the transactions again.';
+        }
+        console.error('List page error:', error);
+    });
+}
 
-        people.add(creditor);
-        people.add(debtor);
+function renderVirtualList(list) {
+    const height = list.container.clientHeight;
+    if (height === 0 || list.expired) return; // collapsed; rendered once shown
+
+    const scrollTop = list.container.scrollTop;
+    const first = Math.max(0, Math.floor(scrollTop / VIRTUAL_ROW_HEIGHT) - VIRTUAL_LIST_OVERSCAN);
+    const last = Math.min(list.total, Math.ceil((scrollTop + height) / VIRTUAL_ROW_HEIGHT) + VIRTUAL_LIST_OVERSCAN);
+    const pageRows = resultConfig.page_rows;
+
+    const rows = [];
+    for (let index = first; index < last; index++) {
+        const page = Math.floor(index / pageRows);
+        loadListPage(list, page);
+        const pageData = list.pages.get(page);
+        const item = pageData ? pageData[index - page * pageRows] : null;
+
+        const row = document.createElement('div');
+        row.className = `virtual-row ${list.name === 'original' ? 'original-transaction-item' : 'transaction'}`;
+        row.style.top = `${index * VIRTUAL_ROW_HEIGHT}px`;
+        if (!item) {
+            row.textContent = 'Loading...';
+        } else if (list.name === 'original') {
+            // Display format: "creditor paid $Amount for Debtor"
+            appendRowParts(row, [[item.creditor, true], [' paid '], [`$${item.amount.toFixed(2)}`, true], [' for '], [item.debtor, true]]);
+        } else {
+            // Display format: "Debtor must pay $Amount to Creditor"
+            appendRowParts(row, [[item.debtor, true], [' must pay '], [`$${item.amount.toFixed(2)}`, true], [' to '], [item.creditor, true]]);
+        }
+        rows.push(row);
+    }
+    list.spacer.replaceChildren(...rows);
+}
 
-        const key = `${debtor}->${creditor}`; // debtor owes money to creditor
-        if (debtMap.has(key)) {
-            debtMap.set(key, debtMap.get(key) + amount);
+// Builds a row from [text, bold] parts without going through innerHTML
+function appendRowParts(row, parts) {
+    parts.forEach(([text, bold]) => {
+        if (bold) {
+            const strong = document.createElement('strong');
+            strong.textContent = text;
+            row.appendChild(strong);
         } else {
-            debtMap.set(key, amount);
+            row.appendChild(document.createTextNode(text));
         }
     });
+}
 
-    const peopleArray = Array.from(people);
-    const debts = Array.from(debtMap.entries()).map(([key, amount]) => {
-        const [from, to] = key.split('->');
-        return { from, to, amount };
+function loadDebtNetwork() {
+    fetch(`/results/${resultConfig.result_id}/network?max_nodes=${NETWORK_MAX_NODES}&max_edges=${NETWORK_MAX_EDGES}`)
+    .then(response => {
+        if (!response.ok) {
+            throw new Error('Could not load the debt network');
+        }
+        return response.json();
+    })
+    .then(network => {
+        debtNetwork = network;
+        createDebtNetwork();
+    })
+    .catch(error => {
+        console.error('Network error:', error);
     });
+}
+
+// Create debt network visualization (called again when the theme changes)
+function createDebtNetwork() {
+    if (!debtNetwork) {
+        return;
+    }
+
+    if (debtNetwork.nodes.length === 0) {
+        const svg = document.getElementById('debtNetworkSvg');
+        if (svg) {
+            svg.innerHTML = '<text x="400" y="300" text-anchor="middle" fill="#999999" font-size="16">No transactions to display</text>';
+        }
+        return;
+    }
+
+    const peopleArray = debtNetwork.nodes.map(node => node.name);
+    const debts = debtNetwork.edges.map(edge => ({
+        from: peopleArray[edge.from],
+        to: peopleArray[edge.to],
+        amount: edge.amount
+    }));
+    const mergedNodes = new Set(debtNetwork.nodes.filter(node => node.people > 1).map(node => node.name));
+    const showAmounts = debts.length <= NETWORK_LABEL_EDGES;
+
+    const detail = document.getElementById('networkDetail');
+    if (detail) {
+        detail.textContent = (peopleArray.length < debtNetwork.total_people || debts.length < debtNetwork.total_edges)
+            ? `Showing the ${debts.length} largest of ${debtNetwork.total_edges} debts between ${debtNetwork.total_people} people`
+            : '';
+    }
 
     // Create SVG visualization
     const svg = document.getElementById('debtNetworkSvg');
@@ -80,6 +187,7 @@ function createDebtNetwork() {
     const isDarkTheme = document.documentElement.getAttribute('data-theme') !== 'light';
     const colors = {
         nodeColor: isDarkTheme ? '#4a9eff' : '#007bff',
+        mergedNodeColor: isDarkTheme ? '#6b7280' : '#6c757d',
         nodeStroke: isDarkTheme ? '#2d2d2d' : '#ffffff',
         arrowColor: isDarkTheme ? '#ef4444' : '#dc3545',
         textColor: isDarkTheme ? '#ffffff' : '#333333',
@@ -156,6 +264,10 @@ function createDebtNetwork() {
             path.setAttribute('marker-end', 'url(#arrowhead)');
             svg.appendChild(path);
 
+            if (!showAmounts) {
+                return;
+            }
+
             // Add amount label
             const amountBg = document.createElementNS('http://www.w3.org/2000/svg', 'rect');
             const amountText = document.createElementNS('http://www.w3.org/2000/svg', 'text');
@@ -203,7 +315,7 @@ function createDebtNetwork() {
             circle.setAttribute('cx', pos.x);
             circle.setAttribute('cy', pos.y);
             circle.setAttribute('r', 30);
-            circle.setAttribute('fill', colors.nodeColor);
+            circle.setAttribute('fill', mergedNodes.has(person) ? colors.mergedNodeColor : colors.nodeColor);
             circle.setAttribute('stroke', colors.nodeStroke);
             circle.setAttribute('stroke-width', '3');
 
@@ -217,8 +329,9 @@ function createDebtNetwork() {
             text.setAttribute('text-anchor', 'middle');
             text.setAttribute('dominant-baseline', 'central');
 
-            // Truncate long names
-            const displayName = person.length > 8 ? person.substring(0, 6) + '...' : person;
+            // Truncate long names ("+N" for the node standing in for everyone else)
+            const displayName = mergedNodes.has(person) ? `+${person.split(' ')[0]}`
+                : person.length > 8 ? person.substring(0, 6) + '...' : person;
             text.textContent = displayName;
 
             // Add tooltip
@@ -233,9 +346,7 @@ function createDebtNetwork() {
     });
 }
 
-// Export transactions to CSV using shared function
+// Export the original transactions; the server streams the CSV file
 function exportTransactionsCSV() {
-    const dataScript = document.getElementById('transaction-data');
-    const originalTransactions = dataScript ? JSON.parse(dataScript.textContent) : [];
-    exportCSV(originalTransactions, 'combined_transactions.csv');
-}
\ No newline at end of file
+    window.location.href = `/results/${resultConfig.result_id}/original.csv`;
+}
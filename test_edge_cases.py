@@ -3,7 +3,34 @@
 Edge case tests for the splitUp algorithm
 """
 
-from splitUp import simplifyDebts2, PersonNode, splitUpGroups
+import gzip
+import io
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+import threading
+import warnings
+from array import array
+
+import benchmark
+from instrumentation import StageTimer, MetricsRegistry
+from jobs import JobQueue, JobQueueFull
+from resultStore import ResultStore
+from ledgerStore import LedgerStore
+
+from splitUp import simplifyDebts2, PersonNode, splitUpGroups, ingestUpload, readBalancesFromUpload, Ledger
+from splitUp import simplifyBalances, simplifyDebtsVectorized, np, settleGroups, parseCents, LedgerSession
+from splitUp import SettlementCache, TransactionDigest, transactionDigest, digestUpload
+from splitUp import iterTransactionBatches, LedgerParseError
+from splitUp import readBalancesMapped, settleBalanceTable, settleBalanceColumns
+from splitUp import simplifyBalancesOptimal, zeroSumPartition, settleBalances, estimatePartitionSeconds
+from splitUp import loadRateTable, convertCurrencies, iterTransactionRows
+from splitUp import writeSnapshot, readSnapshot, SnapshotError
+from splitUp import settleDistributed, settlePayloads, packShards, startLocalWorkers, stopLocalWorkers
+import splitUp
 
 def test_empty_group():
     """Test Case 1: Empty group"""
@@ -110,6 +137,894 @@ def test_group_isolation():
     
     print("✓ PASS")
 
+def test_streaming_upload():
+    """Test Case 7: Streaming upload ingest with tiny chunks"""
+    print("Test Case 7: Streaming Upload Ingest")
+    data = "Zoë,Bob,25.50\nBob,Charlie,15.00\nCharlie,Zoë,30.75\nAlice,David,10.00".encode('utf-8')
+
+    # A 3 byte chunk size splits rows and the multi-byte "ë" across chunks
+    result = ingestUpload(io.BytesIO(data), originalLimit=2, originalOffset=1, chunkSize=3)
+    print(f"Rows: {result.numTransactions}, kept: {len(result.originalTransactions)}")
+    assert result.numTransactions == 4, "All rows should be counted"
+    assert [t.creditor for t in result.originalTransactions] == ["Bob", "Charlie"], \
+        "Only the requested page of original transactions should be kept"
+    assert len(result.groups) == 2, "Should find exactly 2 disconnected groups"
+
+    balances, numTransactions = readBalancesFromUpload(io.BytesIO(data), chunkSize=3)
+    assert numTransactions == 4
+    assert abs(balances["Zoë"] - (25.50 - 30.75)) < 0.001, "Zoë's balance should be folded in"
+    assert abs(sum(balances.values())) < 0.001, "Balances must sum to zero"
+    print("✓ PASS")
+
+def test_ledger():
+    """Test Case 8: Array-backed ledger"""
+    print("Test Case 8: Array-Backed Ledger")
+    ledger = Ledger()
+    ledger.addTransaction("Alice", "Bob", 25.0)
+    ledger.addTransaction("Alice", "Bob", 5.0)
+    ledger.addTransaction("Charlie", "David", 20.0)
+
+    assert len(ledger) == 4, "Names should be interned once"
+    assert ledger.getId("Charlie") == 2, "Ids follow first appearance"
+    assert ledger.getNumTransactions() == 3
+    assert ledger.getBalance("Alice") == 30.0 and ledger.getBalance("Bob") == -30.0
+
+    people = ledger.toPeople()
+    assert [p.getName() for p in people] == ledger.getNames()
+    assert people[0].getTotalMoney() == 30.0, "PersonNodes should match ledger balances"
+    assert len(ledger.groups()) == 2, "Should find exactly 2 disconnected groups"
+    print("✓ PASS")
+
+def test_cached_balance():
+    """Test Case 9: Cached net balance stays consistent"""
+    print("Test Case 9: Cached Net Balance")
+    PersonNode.checkBalances = True
+    try:
+        alice = PersonNode("Alice")
+        bob = PersonNode("Bob")
+        charlie = PersonNode("Charlie")
+        alice.addDebt(bob, 12.5)
+        alice.addDebt(bob, 7.5)
+        charlie.addDebt(alice, 5.0)
+        bob.addCredit(charlie, 3.0)
+        assert alice.getTotalMoney() == 15.0
+        assert bob.getTotalMoney() == -23.0
+        assert charlie.getTotalMoney() == 8.0
+
+        alice.removeTransaction(charlie)
+        charlie.removeTransaction(alice)
+        assert alice.getTotalMoney() == 20.0 and charlie.getTotalMoney() == 3.0
+
+        bob.clearDebts()
+        for person in (alice, bob, charlie):
+            assert person.getTotalMoney() == 0, "Clearing debts should reset both sides"
+    finally:
+        PersonNode.checkBalances = False
+    print("✓ PASS")
+
+def test_long_chain_grouping():
+    """Test Case 10: Long payer chain doesn't hit the recursion limit"""
+    print("Test Case 10: Long Payer Chain Grouping")
+    chain = [PersonNode(f"P{i}") for i in range(5000)]
+    for payer, debtor in zip(chain, chain[1:]):
+        payer.addDebt(debtor, 1.0)
+    loner = PersonNode("Loner")
+
+    groups = splitUpGroups([loner] + chain[::-1])
+    print(f"Found {len(groups)} groups")
+    assert len(groups) == 2, "Chain and loner should be separate groups"
+    assert groups[0] == {loner}, "Groups keep the order people were passed in"
+    assert len(groups[1]) == 5000
+
+    ledger = Ledger()
+    for i in range(5000):
+        ledger.addTransaction(f"P{i}", f"P{i + 1}", 1.0)
+    assert len(ledger.groups()) == 1, "Ledger tracks components during ingest"
+    print("✓ PASS")
+
+def random_ledger(seed, numPeople=30, numTransactions=200):
+    """Builds a seeded random ledger with cent amounts"""
+    rng = random.Random(seed)
+    ledger = Ledger()
+    for _ in range(numTransactions):
+        payer, debtor = rng.sample(range(numPeople), 2)
+        ledger.addTransaction(f"P{payer}", f"P{debtor}", rng.randint(1, 10000) / 100)
+    return ledger
+
+def count_payments(people):
+    """Counts the payments in a simplified PersonNode group"""
+    return sum(1 for p in people for amount in p.getOwersAndCreditors().values() if amount < 0)
+
+def test_balance_settlement_engines():
+    """Test Case 11: Balance-vector engines match simplifyDebts2"""
+    print("Test Case 11: Balance-Vector Settlement Engines")
+    for seed in range(50):
+        ledger = random_ledger(seed)
+        expected = count_payments(simplifyDebts2(ledger.toPeople()))
+
+        debtorIds, creditorIds, amounts = simplifyBalances(ledger.getBalances())
+        assert len(amounts) == expected, "simplifyBalances should match simplifyDebts2"
+        settled = [0.0] * len(ledger)
+        for d, c, amount in zip(debtorIds, creditorIds, amounts):
+            settled[d] -= amount
+            settled[c] += amount
+        for name, balance in zip(ledger.getNames(), settled):
+            assert abs(balance - ledger.getBalance(name)) < 0.001, "Balances must be preserved"
+
+        if np is not None:
+            debtorIds, creditorIds, amounts = simplifyDebtsVectorized(ledger.getBalances())
+            assert len(amounts) == expected, "Vectorized engine should match simplifyDebts2"
+            assert abs(amounts.sum() - sum(simplifyBalances(ledger.getBalances())[2])) < 0.001
+
+    if np is not None:
+        # Empty and all-zero input keep the dtype of a non-empty settlement
+        for balances in ([], [0, 0, 0]):
+            assert simplifyDebtsVectorized(np.array(balances, dtype=np.int64))[2].dtype == np.int64
+            assert simplifyDebtsVectorized(np.array(balances, dtype=np.float64))[2].dtype == np.float64
+        assert simplifyDebtsVectorized(np.array([5, -5]))[2].dtype == np.int64
+
+    if np is None:
+        print("NumPy not installed, vectorized engine skipped")
+    print("✓ PASS")
+
+def test_parallel_settlement():
+    """Test Case 12: Process-pool settlement matches the serial loop"""
+    print("Test Case 12: Parallel Settlement Across Groups")
+    ledger = Ledger()
+    for g in range(40):
+        small = random_ledger(g, numPeople=3 + g % 5, numTransactions=10)
+        for payerId, debtorId, amount in zip(*small.getEdges()):
+            ledger.addTransaction(f"G{g}-{payerId}", f"G{g}-{debtorId}", amount)
+    allGroups = ledger.groups()
+
+    serial = []
+    for group in allGroups:
+        serial.extend(simplifyDebts2(list(group)))
+
+    parallel = settleGroups(allGroups, maxWorkers=2, batchPeople=16, minParallelPeople=0)
+    assert count_payments(parallel) == count_payments(serial), "Payment counts should match"
+    assert [p.getName() for p in parallel] == [p.getName() for p in settleGroups(allGroups, maxWorkers=1)], \
+        "Results should be merged in a deterministic order"
+    totals = {p.getName(): p.getTotalMoney() for p in parallel}
+    for name, total in totals.items():
+        assert abs(total - ledger.getBalance(name)) < 0.001, "Balances must be preserved"
+    print("✓ PASS")
+
+def test_exact_cents_mode():
+    """Test Case 13: Integer-cents exact mode"""
+    print("Test Case 13: Exact Integer Cents")
+    assert parseCents("25.50") == 2550 and parseCents("-0.1") == -10
+    try:
+        parseCents("1.005")
+        assert False, "Sub-cent amounts should be rejected"
+    except ValueError:
+        pass
+    for text in ("Infinity", "-inf", "NaN", "sNaN", "1e30"):
+        try:
+            parseCents(text)
+            assert False, f"{text} should be rejected"
+        except ValueError:
+            pass
+    assert parseCents("92233720368547758.07") == (1 << 63) - 1
+
+    data = b"A,B,0.10\nA,C,0.20\nB,C,0.30\nC,A,0.60\nD,A,0.05\nA,D,0.05\n"
+    result = ingestUpload(io.BytesIO(data), exact=True)
+    assert result.originalTransactions[0].amount == 0.1, "Display amounts stay in currency units"
+
+    simplified = settleGroups(result.groups)
+    for person in simplified:
+        for amount in person.getOwersAndCreditors().values():
+            assert isinstance(amount, int), "Settlement amounts should stay integer cents"
+    assert sum(p.getTotalMoney() for p in simplified) == 0, "Exact balances sum to exactly zero"
+    assert count_payments(simplified) == 2
+
+    debtorIds, creditorIds, amounts = simplifyBalances([2550, -550, -2000])
+    assert amounts.typecode == 'q' and list(amounts) == [2000, 550]
+    try:
+        simplifyBalances([100, -99])
+        assert False, "Unbalanced exact balances should be rejected"
+    except ValueError:
+        pass
+    print("✓ PASS")
+
+def test_ledger_session():
+    """Test Case 14: Incremental ledger session"""
+    print("Test Case 14: Incremental Ledger Session")
+    session = LedgerSession()
+    session.addTransaction("Alice", "Bob", 10.0)
+    session.addTransaction("Charlie", "David", 20.0)
+    assert len(session.settle()) == 2 and session.getNumGroups() == 2
+
+    # Only the group that changed is re-settled
+    session.addTransaction("Bob", "Alice", 4.0)
+    assert session.getDirtyGroupCount() == 1
+    payments = session.settle()
+    assert payments[0].debtor == "Bob" and abs(payments[0].amount - 6.0) < 0.001
+
+    # Joining and then splitting the groups again
+    session.addTransaction("Bob", "Charlie", 5.0)
+    assert session.getNumGroups() == 1
+    session.removeTransaction("Bob", "Charlie", 5.0)
+    assert session.getNumGroups() == 2 and session.getBalance("Charlie") == 20.0
+
+    # A batch removal that cannot be applied whole changes nothing
+    try:
+        session.removeTransactions([("Charlie", "David", 20.0), ("Charlie", "David", 20.0)])
+        assert False, "Removing a transaction twice should fail"
+    except KeyError:
+        pass
+    assert session.getBalance("Charlie") == 20.0 and session.getNumTransactions() == 3
+
+    # Only an amount that was added can be removed
+    for remove in (lambda: session.removeTransaction("Charlie", "David", 999.0),
+                   lambda: session.removeTransactions([("Charlie", "David", 5.0)])):
+        try:
+            remove()
+            assert False, "Removing an amount that was never added should fail"
+        except KeyError:
+            pass
+    assert session.getBalance("Charlie") == 20.0 and session.getNumGroups() == 2
+
+    # Random edits always agree with a full recompute
+    rng = random.Random(7)
+    rows = []
+    for step in range(500):
+        if rows and rng.random() < 0.4:
+            session.removeTransaction(*rows.pop(rng.randrange(len(rows))))
+        else:
+            payer, debtor = rng.sample(range(12), 2)
+            rows.append((f"R{payer}", f"R{debtor}", rng.randint(1, 1000) / 100))
+            session.addTransaction(*rows[-1])
+        if step % 25 == 0:
+            ledger = Ledger()
+            for row in rows + [("Alice", "Bob", 10.0), ("Bob", "Alice", 4.0), ("Charlie", "David", 20.0)]:
+                ledger.addTransaction(*row)
+            assert len(session.settle()) == count_payments(settleGroups(ledger.groups())), \
+                "Incremental settlement should match a full recompute"
+    print("✓ PASS")
+
+def test_result_cache():
+    """Test Case 15: Content-hash keyed LRU result cache"""
+    print("Test Case 15: Settlement Result Cache")
+    rows = [("Alice", "Bob", 25.5), ("Bob", "Charlie", 15.0), ("Alice", "Bob", 25.5)]
+    key = transactionDigest(rows)
+    assert key == transactionDigest(rows[::-1]), "Row order shouldn't change the key"
+    assert key == digestUpload(io.BytesIO(b"Bob,Charlie,15\nAlice,Bob,25.50\nAlice,Bob,25.5\n")), \
+        "Uploads should normalize to the same key"
+    digest = TransactionDigest()
+    splitUp.readLedgerFromUpload(io.BytesIO(b"Alice,Bob,25.5\nBob,Charlie,15\nAlice,Bob,25.5\n"),
+                         chunkSize=4, digest=digest)
+    assert digest.hexdigest() == key, "Parsing should digest the same rows"
+    digest.updateErrors([LedgerParseError(4, "bad amount")])
+    assert digest.hexdigest().startswith(key + '-') and digest.hexdigest() != key, \
+        "Skipped rows should be part of the key"
+    assert key != transactionDigest(rows[:2]), "Duplicate rows are part of the multiset"
+    assert key != transactionDigest([("Alice", "Bob", 2550), ("Bob", "Charlie", 1500),
+                                     ("Alice", "Bob", 2550)], exact=True)
+
+    cache = SettlementCache(maxBytes=100)
+    assert cache.put("a", "x", size=40) and cache.put("b", "y", size=40)
+    assert cache.get("a") == "x"  # "b" is now least recently used
+    cache.put("c", "z", size=40)
+    assert cache.get("b") is None and cache.get("c") == "z" and len(cache) == 2
+    assert not cache.put("huge", "w", size=101), "Entries over the budget aren't cached"
+    stats = cache.getStats()
+    assert stats['hits'] == 2 and stats['misses'] == 1 and stats['bytes'] == 80
+    print("✓ PASS")
+
+def test_benchmark_suite():
+    """Test Case 16: Benchmark generators and JSON report"""
+    print("Test Case 16: Benchmark Suite Smoke Test")
+    for shape, generator in benchmark.GENERATORS.items():
+        first = generator(200, random.Random(1))
+        assert first == generator(200, random.Random(1)), f"{shape} should be seeded"
+        assert len(first) == 200
+
+    report = json.loads(json.dumps(benchmark.runBenchmarks(list(benchmark.GENERATORS), 200, 0)))
+    for result in report['results']:
+        assert set(result['stages']) == {'ingest_per_row_baseline', 'ingest',
+                                         'aggregate_pairs', 'build_people',
+                                         'split_up_groups', 'simplify_debts2',
+                                         'settle_groups'}
+        assert result['settle_groups_edges'] <= result['settlement_edges'], \
+            "Hybrid settlement is never worse than greedy"
+        assert all(stage['peak_bytes'] > 0 for stage in result['stages'].values())
+    print("✓ PASS")
+
+def test_stage_instrumentation():
+    """Test Case 17: Per-stage timing and metrics histograms"""
+    print("Test Case 17: Stage Instrumentation")
+    registry = MetricsRegistry()
+    for _ in range(3):
+        timer = StageTimer()
+        with timer.stage('parse', rows=10):
+            sum(range(1000))
+        with timer.stage('render'):
+            pass
+        timer.setRows('render', 2)
+        registry.record('upload', timer)
+
+    header = timer.serverTimingHeader()
+    print(f"Server-Timing: {header}")
+    assert header.startswith("parse;dur=") and ", render;dur=" in header
+
+    parse = registry.snapshot()['upload']['parse']
+    assert parse['duration']['count'] == 3 and parse['rows_total'] == 30
+    assert parse['duration']['buckets_ms']['+Inf'] == 3, "Buckets are cumulative"
+
+    # Memory freed inside a stage still counts towards its allocations
+    registry.setTrackAllocations(True)
+    try:
+        timer = StageTimer()
+        with timer.stage('parse'):
+            buffer = bytearray(1 << 20)
+            del buffer
+        assert timer.getStages()['parse']['allocated_bytes'] >= 1 << 20
+    finally:
+        registry.setTrackAllocations(False)
+    print("✓ PASS")
+
+def test_fast_csv_parser():
+    """Test Case 18: Single-pass csv parser with strict and lenient modes"""
+    print("Test Case 18: Fast CSV Parser")
+    lines = ['Mary Ann,"Smith, Bob",12.50\n', '\n', 'Bob,Charlie,oops\n',
+             'Charlie,Mary Ann\n', 'Charlie, Bob ,3\n']
+
+    try:
+        list(iterTransactionBatches(lines))
+        assert False, "Strict mode should reject the bad amount"
+    except LedgerParseError as e:
+        print(f"Strict: {e}")
+        assert e.lineNumber == 3
+
+    errors = []
+    batches = list(iterTransactionBatches(lines, strict=False, errors=errors, batchSize=2))
+    payers = [p for batch in batches for p in batch[0]]
+    debtors = [d for batch in batches for d in batch[1]]
+    amounts = [a for batch in batches for a in batch[2]]
+    assert payers == ["Mary Ann", "Charlie"], "Names with spaces survive a single parse"
+    assert debtors == ["Smith, Bob", "Bob"], "Quoted names can contain commas"
+    assert amounts == [12.5, 3.0]
+    assert [e.lineNumber for e in errors] == [3, 4], "Lenient mode reports each bad line"
+
+    ledger = Ledger()
+    for batch in iterTransactionBatches(lines, strict=False):
+        ledger.addTransactions(*batch)
+    assert ledger.getBalance("Charlie") == 3.0 and ledger.getNumTransactions() == 2
+
+    # Amounts that overflow an exact column are skipped like any bad amount
+    errors = []
+    ledger, _ = splitUp.readLedgerFromUpload(io.BytesIO(b"a,b,10\na,b,Infinity\na,b,1e30\n"),
+                                             exact=True, strict=False, errors=errors)
+    assert ledger.getNumTransactions() == 1 and [e.lineNumber for e in errors] == [2, 3]
+    print("✓ PASS")
+
+def test_mapped_parallel_ingest():
+    """Test Case 19: Memory-mapped ingest merged from parallel byte ranges"""
+    print("Test Case 19: Mapped Parallel Ingest")
+    rng = random.Random(13)
+    rows = [(f"P{rng.randrange(40)}", f"P{rng.randrange(40, 80)}", rng.randint(1, 9999) / 100)
+            for _ in range(500)]
+    rows += [("X", "Y", 5.0), ("Y", "Z", 2.5)]
+    text = "".join(f"{a},{b},{c}\n" for a, b, c in rows)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+        f.write(text + "X,Y,oops\n")
+    try:
+        errors = []
+        table = readBalancesMapped(f.name, maxWorkers=2, strict=False, errors=errors,
+                                   rangeBytes=len(text) // 7)
+        assert [e.lineNumber for e in errors] == [len(rows) + 1], "Line numbers span ranges"
+        assert table.numTransactions == len(rows)
+
+        ledger = Ledger()
+        for payer, debtor, amount in rows:
+            ledger.addTransaction(payer, debtor, amount)
+        for name, balance in zip(table.names, table.balances):
+            assert abs(balance - ledger.getBalance(name)) < 1e-9, f"Balance of {name}"
+        assert max(table.componentIds) + 1 == len(ledger.groups()), "Components merge across ranges"
+
+        simplified = settleBalanceTable(table, maxWorkers=1)
+        for person in simplified:
+            assert abs(person.getTotalMoney() - ledger.getBalance(person.getName())) < 1e-6
+
+        try:
+            readBalancesMapped(f.name, maxWorkers=1, rangeBytes=len(text) // 7)
+            assert False, "Strict mode should reject the bad amount"
+        except LedgerParseError as e:
+            assert e.lineNumber == len(rows) + 1
+    finally:
+        os.unlink(f.name)
+    print("✓ PASS")
+
+def test_pair_aggregation():
+    """Test Case 20: Duplicate payer/debtor pairs are summed before graph construction"""
+    print("Test Case 20: Pair Pre-Aggregation")
+    ledger = Ledger()
+    for week in range(52):
+        ledger.addTransaction("Alice", "Bob", 10.0)
+        ledger.addTransaction("Alice", "Charlie", 10.0)
+    ledger.addTransaction("Bob", "Alice", 4.0)
+
+    payers, debtors, sums, counts = ledger.getPairEdges()
+    assert list(zip(payers, debtors)) == [(0, 1), (0, 2), (1, 0)], "One directed edge per pair"
+    assert list(sums) == [520.0, 520.0, 4.0] and list(counts) == [52, 52, 1]
+    assert ledger.getNumTransactions() == 105, "Row count is kept for the reduction statistic"
+
+    people = ledger.toPeople()
+    assert people[1].getOwersAndCreditors()[people[0]] == -516.0
+    assert people[0].getTotalMoney() == ledger.getBalance("Alice") == 1036.0
+
+    ledger.addTransaction("Charlie", "David", 1.0)
+    assert len(ledger.getPairEdges()[3]) == 4, "Cache is invalidated by new rows"
+    assert len(ledger.groups()) == 1
+    print("✓ PASS")
+
+def test_optimal_settlement():
+    """Test Case 21: Minimum-transaction solver finds zero-sum subsets greedy misses"""
+    print("Test Case 21: Optimal Settlement")
+    # Greedy pays -5 to 6 first and needs 4 payments; {6, -4, -2} and {5, -5} need 3
+    balances = array('q', [6, 5, -4, -2, -5])
+    greedy = simplifyBalances(balances)
+    optimal = simplifyBalancesOptimal(balances)
+    assert len(greedy[0]) == 4 and len(optimal[0]) == 3, "Two zero-sum subsets, so 5 - 2 payments"
+    for debtorIds, creditorIds, amounts in (greedy, optimal):
+        settled = list(balances)
+        for d, c, amount in zip(debtorIds, creditorIds, amounts):
+            settled[d] += amount
+            settled[c] -= amount
+        assert settled == [0] * 5, "Every payment plan must settle everyone"
+
+    blocks = zeroSumPartition([3, -1, -2, 4, -4, 1, -1])
+    assert sorted(len(block) for block in blocks) == [2, 2, 3], "Most zero-sum blocks possible"
+
+    floats = simplifyBalancesOptimal([10.1, -10.1, 0.2, -0.1, -0.1])
+    assert len(floats[0]) == 3, "Float balances are compared at a fixed resolution"
+    assert simplifyBalancesOptimal(list(range(1, 30)) + [-435], maxPeople=20) is None
+    assert simplifyBalancesOptimal([1, 2, 3, -6], timeBudget=-1) is None, "Out of time"
+
+    # Searches estimated to overrun the budget are skipped, not started
+    rng = random.Random(18)
+    units = [rng.randint(1, 10**6) for _ in range(17)]
+    units.append(-sum(units))
+    start = time.perf_counter()
+    assert simplifyBalancesOptimal(units, timeBudget=estimatePartitionSeconds(18) / 2) is None
+    assert time.perf_counter() - start < 0.05, "A hopeless search should not run"
+    assert len(settleBalances(array('q', [6, 5, -4, -2, -5]))[0]) == 3, "Small groups are solved exactly"
+    print("✓ PASS")
+
+def test_job_queue():
+    """Test Case 22: Background jobs report progress and cap concurrency"""
+    print("Test Case 22: Job Queue")
+    queue = JobQueue(maxWorkers=1, maxPending=1, keepFinished=2)
+    release = threading.Event()
+
+    def job(progress, rows):
+        progress('parse', rows)
+        release.wait(5)
+        return rows * 2
+
+    running = queue.submit(job, 7)
+    waiting = queue.submit(job, 3)
+    try:
+        queue.submit(job, 1)
+        assert False, "A third job should not fit in the queue"
+    except JobQueueFull:
+        pass
+
+    def waitFor(condition):
+        for _ in range(500):
+            if condition():
+                return
+            threading.Event().wait(0.01)
+
+    waitFor(lambda: queue.getStatus(running)['stage'] == 'parse')
+    status = queue.getStatus(running)
+    assert status['status'] == 'running' and status['rows'] == 7, "Progress is visible while running"
+    assert queue.getStatus(waiting)['status'] == 'queued', "Only maxWorkers jobs run at once"
+    assert queue.getResult(running) is None
+
+    release.set()
+    waitFor(lambda: queue.getResult(waiting) is not None)
+    assert queue.getResult(running) == 14 and queue.getResult(waiting) == 6
+    failed = queue.submit(lambda progress: 1 / 0)
+    waitFor(lambda: queue.getStatus(failed)['status'] == 'failed')
+    assert 'division' in queue.getStatus(failed)['error']
+    assert queue.getStatus(running) is None, "Only keepFinished finished jobs are kept"
+    assert queue.getStatus("nope") is None
+    print("✓ PASS")
+
+def test_settlement_columns():
+    """Test Case 23: Settling straight to columns of interned name ids"""
+    print("Test Case 23: Columnar Settlement")
+    ledger = Ledger(exact=True)
+    ledger.addTransactions(["Alice", "Bob", "Eve"], ["Bob", "Carol", "Dan"],
+                           [parseCents("10.10"), parseCents("0.20"), parseCents("3")])
+    table = ledger.toBalanceTable()
+    assert table.names == ["Alice", "Bob", "Eve", "Carol", "Dan"] and table.numTransactions == 3
+
+    debtorIds, creditorIds, amounts = settleBalanceColumns(table, maxWorkers=1)
+    assert amounts.typecode == 'q', "Exact ledgers settle in minor units"
+    payments = sorted((table.names[d], table.names[c], a)
+                      for d, c, a in zip(debtorIds, creditorIds, amounts))
+    assert payments == [("Bob", "Alice", 990), ("Carol", "Alice", 20), ("Dan", "Eve", 300)]
+    print("✓ PASS")
+
+def test_ledger_store():
+    """Test Case 24: Persistent ledgers keep materialized balances up to date"""
+    print("Test Case 24: Persistent Ledger Store")
+    path = os.path.join(tempfile.mkdtemp(), "ledgers.sqlite3")
+    store = LedgerStore(path, exact=True)
+    store.addTransaction("trip", "Alice", "Bob", parseCents("10.00"))
+    store.importUpload("trip", io.BytesIO(b"Bob,Carol,4.00\nAlice,Bob,1.50\n"))
+    store.addTransaction("rent", "Alice", "Dan", parseCents("500"))
+    try:
+        store.importUpload("trip", io.BytesIO(b"Carol,Eve,1\nEve,Carol,oops\n"))
+        assert False, "A malformed row should reject the import"
+    except LedgerParseError:
+        pass
+    store.close()
+
+    # Reopened from disk; the failed import left nothing behind
+    store = LedgerStore(path, exact=True)
+    assert store.getLedgerNames() == ["trip", "rent"]
+    assert store.getNumTransactions("trip") == 3
+    assert store.getBalance("trip", "Bob") == -750 and store.getBalance("trip", "Eve") == 0
+    table = store.toBalanceTable("trip")
+    assert table.names == ["Alice", "Bob", "Carol"] and list(table.balances) == [1150, -750, -400]
+
+    payments = sorted((person.getName(), creditor.getName(), -amount)
+                      for person in store.settle("trip")
+                      for creditor, amount in person.getOwersAndCreditors().items() if amount < 0)
+    assert payments == [("Bob", "Alice", 750), ("Carol", "Alice", 400)]
+    people = store.toPeople("trip")
+    assert len(splitUpGroups(people)) == 1
+    assert [person.getTotalMoney() for person in people] == [1150, -750, -400]
+
+    assert store.verifyLedger("trip") == []
+    try:
+        LedgerStore(path, exact=False)
+        assert False, "Opening an exact store in float mode should fail"
+    except ValueError:
+        pass
+    try:
+        store.toBalanceTable("nope")
+        assert False, "Unknown ledgers should raise KeyError"
+    except KeyError:
+        pass
+    print("✓ PASS")
+
+def test_batch_cli():
+    """Test Case 25: Headless batch run over a glob of ledger files"""
+    print("Test Case 25: Batch Command Line")
+    directory = tempfile.mkdtemp()
+    for name, rows in (("trip", "Alice,Bob,10\nBob,Carol,4\n"),
+                       ("rent", "Dan,Eve,500\n"),
+                       ("broken", "Dan,Eve,five\n")):
+        with open(os.path.join(directory, name + ".csv"), "w") as f:
+            f.write(rows)
+    outputDir = os.path.join(directory, "settled")
+
+    status = splitUp.main([os.path.join(directory, "*.csv"), "-o", outputDir,
+                           "--workers", "1", "--quiet"])
+    assert status == 1, "A malformed ledger should fail the run"
+    assert sorted(os.listdir(outputDir)) == ["rent.settlement.csv", "trip.settlement.csv"]
+    with open(os.path.join(outputDir, "trip.settlement.csv")) as f:
+        assert sorted(f.read().splitlines()) == ["Bob,Alice,6.0", "Carol,Alice,4.0"]
+
+    # Settlement files are skipped by globs, and appending one settles the ledger
+    status = splitUp.main([os.path.join(outputDir, "*.csv"), "--quiet"])
+    assert status == 1, "Only settlement files matched, so nothing was settled"
+    with open(os.path.join(outputDir, "q3.settlements.csv"), "w") as f:
+        f.write("Ann,Bob,1\n")
+    assert splitUp.expandInputs([os.path.join(outputDir, "*.csv")])[0] == \
+        [os.path.join(outputDir, "q3.settlements.csv")], "Only the settlement suffix is skipped"
+    table = readBalancesMapped(os.path.join(directory, "trip.csv"))
+    with open(os.path.join(outputDir, "trip.settlement.csv"), "rb") as f:
+        ledger, _ = splitUp.readLedgerFromUpload(f, keepOriginal=False)
+    for name, balance in zip(table.names, table.balances):
+        assert ledger.getBalance(name) == -balance
+
+    status = splitUp.main([os.path.join(directory, "broken.csv"), "--lenient",
+                           "--format", "ndjson", "-o", outputDir, "--quiet"])
+    assert status == 0
+    with open(os.path.join(outputDir, "broken.settlement.ndjson")) as f:
+        summary = json.loads(f.read().splitlines()[-1])
+    assert summary['type'] == 'summary' and summary['skipped_rows'] == 1
+    print("✓ PASS")
+
+def test_currency_conversion():
+    """Test Case 26: Currency column converted in batches from a cached rate table"""
+    print("Test Case 26: Multi-Currency Ingest")
+    path = os.path.join(tempfile.mkdtemp(), "rates.csv")
+    with open(path, "w") as f:
+        f.write("# one unit in USD\nUSD,1\nEUR,1.08\ngbp,1.25\n")
+    rates = loadRateTable(path)
+    assert loadRateTable(path) is rates, "An unchanged rate table should come from the cache"
+    assert rates.rates["GBP"] == 1.25 and rates.ratios["EUR"] == (27, 25)
+
+    lines = ["Alice,Bob,10,EUR\n", "Bob,Carol,4\n", "Carol,Alice,2,GBP\n", "Alice,Carol,1,usd\n"]
+    assert [amount for _, _, amount in iterTransactionRows(lines, exact=True, rates=rates)] \
+        == [1080, 400, 250, 100]
+    floats = [amount for _, _, amount in iterTransactionRows(lines, rates=rates)]
+    assert all(abs(a - b) < 1e-9 for a, b in zip(floats, [10.8, 4.0, 2.5, 1.0]))
+
+    # Mixed and single-currency batches, with half a cent rounded up
+    assert list(convertCurrencies(array('d', [1.0, 2.0, 4.0]), ["EUR", "", "GBP"], rates)) \
+        == [1.08, 2.0, 5.0]
+    assert list(convertCurrencies(array('q', [50, 100]), ["EUR", "EUR"], rates)) == [54, 108]
+    assert list(convertCurrencies(array('q', [1, 100]), ["GBP", "EUR"], rates)) == [1, 108]
+
+    errors = []
+    rows = list(iterTransactionRows(lines + ["Dan,Eve,5,JPY\n"], strict=False,
+                                    errors=errors, rates=rates))
+    assert len(rows) == 4 and errors[0].lineNumber == 5 and "JPY" in str(errors[0])
+    try:
+        list(iterTransactionRows(lines))
+        assert False, "A currency column needs a rate table"
+    except LedgerParseError:
+        pass
+
+    # Rewriting the file invalidates the cached table
+    with open(path, "a") as f:
+        f.write("JPY,0.0067\n")
+    assert "JPY" in loadRateTable(path).rates
+    ledger, _ = splitUp.readLedgerFromUpload(io.BytesIO(b"Dan,Eve,1000,JPY\n"),
+                                             keepOriginal=False, exact=True,
+                                             rates=loadRateTable(path))
+    assert ledger.getBalance("Dan") == 670
+    print("✓ PASS")
+
+def test_lazy_package_import():
+    """Test Case 27: Importing the settlement core leaves the heavy parts unloaded"""
+    print("Test Case 27: Lazy Package Import")
+    imported = benchmark.measureImportTime(runs=1)
+    assert imported['heavy_modules'] == [], imported['heavy_modules']
+    assert imported['seconds'] > 0
+
+    # Names resolve through their submodules and are cached on the package
+    assert splitUp.writeSettlement is splitUp.exporters.writeSettlement
+    assert 'writeSettlement' in vars(splitUp)
+    assert 'iterNdjson' in dir(splitUp) and 'iterNdjson' in splitUp.__all__
+    try:
+        splitUp.notAThing
+        assert False, "Unknown names should raise AttributeError"
+    except AttributeError:
+        pass
+    print("✓ PASS")
+
+def test_ledger_snapshot():
+    """Test Case 28: Binary snapshots reload into the settlement pipeline"""
+    print("Test Case 28: Ledger Snapshot Round Trip")
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "trip.snapshot")
+    for exact in (False, True):
+        ledger = Ledger(exact=exact)
+        ledger.addTransactions(["Zoë", "Bob", "Cy", "Dee"], ["Bob", "Cy", "Zoë", "Eve"],
+                               [1250, 300, 75, 10] if exact else [12.5, 3.0, 0.75, 0.1])
+        writeSnapshot(path, ledger.toBalanceTable(), ledger.getEdges())
+        with readSnapshot(path) as snapshot:
+            assert snapshot.isExact() == exact
+            assert list(snapshot.getNames()) == ledger.getNames()
+            assert list(snapshot.getBalances()) == list(ledger.getBalances())
+            assert settleBalanceColumns(snapshot.toBalanceTable(), maxWorkers=1) == \
+                settleBalanceColumns(ledger.toBalanceTable(), maxWorkers=1)
+            rebuilt = snapshot.toLedger()
+            assert rebuilt.getPairEdges() == ledger.getPairEdges()
+            assert rebuilt.getComponentIds() == ledger.getComponentIds()
+
+    # Damaged, truncated and foreign files are rejected
+    with open(path, "rb") as f:
+        data = f.read()
+    flipped = bytearray(data)
+    flipped[-1] ^= 0xff
+    for damaged in (data[:-8], data[:20], flipped, b"Ann,Bob,5\n"):
+        with open(path, "wb") as f:
+            f.write(damaged)
+        try:
+            readSnapshot(path)
+            assert False, "A damaged snapshot should be rejected"
+        except SnapshotError:
+            pass
+
+    # The batch run saves snapshots and takes them as input
+    with open(os.path.join(directory, "trip.csv"), "w") as f:
+        f.write("Ann,Bob,10\nBob,Cy,4\n")
+    assert splitUp.main([os.path.join(directory, "trip.csv"), "--snapshot", "-q"]) == 0
+    os.remove(os.path.join(directory, "trip.settlement.csv"))
+    assert splitUp.main([path, "-q"]) == 0
+    with open(os.path.join(directory, "trip.settlement.csv")) as f:
+        assert f.read() == "Bob,Ann,6.0\nCy,Ann,4.0\n"
+    print("✓ PASS")
+
+def test_distributed_settlement():
+    """Test Case 29: Shards settled on worker processes, surviving failed workers"""
+    print("Test Case 29: Distributed Settlement With Worker Failover")
+    sizes = [5, 900, 40, 300, 2000, 7, 650]
+    shards = packShards(sizes, shardPeople=1000)
+    assert sorted(groupId for shard in shards for groupId in shard) == list(range(len(sizes)))
+    assert all(sum(sizes[i] for i in shard) <= 1000 for shard in shards if len(shard) > 1)
+
+    rng = random.Random(7)
+    payloads = []
+    for g in range(120):
+        units = [rng.randint(-5000, 5000) for _ in range(rng.randint(1, 9))]
+        units.append(-sum(units))
+        balances = array('q', units) if g % 2 else array('d', [unit / 100 for unit in units])
+        payloads.append((list(range(len(units))), balances))
+    expected = settlePayloads(payloads, maxWorkers=1)
+
+    # A node that hangs up on every shard, and an address nobody listens on
+    dropper = socket.create_server(("127.0.0.1", 0))
+    def dropShards():
+        try:
+            while True:
+                conn, _ = dropper.accept()
+                conn.recv(16)
+                conn.close()
+        except OSError:
+            pass  # closed at the end of the test
+    threading.Thread(target=dropShards, daemon=True).start()
+    closed = socket.create_server(("127.0.0.1", 0))
+    deadAddress = closed.getsockname()
+    closed.close()
+
+    workers = startLocalWorkers(2)
+    try:
+        nodes = [dropper.getsockname(), deadAddress] + [address for _, address in workers]
+        assert settleDistributed(payloads, nodes, shardPeople=64) == expected
+
+        # Malformed frames are answered with an error, not settled
+        with socket.create_connection(workers[0][1], timeout=5) as conn:
+            conn.sendall(b"not a frame, just some bytes")
+            frameType, _, message = splitUp.distributed.recvFrame(conn)
+            assert frameType == splitUp.distributed.FRAME_ERROR and message
+
+        # The batch command line settles on the same workers
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "nodes.csv"), "w") as f:
+            f.write("Ann,Bob,10\nBob,Cy,4\nDee,Eve,1\n")
+        workerList = ",".join("{0}:{1}".format(*address) for _, address in workers)
+        assert splitUp.main([os.path.join(directory, "nodes.csv"), "--nodes", workerList, "-q"]) == 0
+        with open(os.path.join(directory, "nodes.settlement.csv")) as f:
+            assert f.read() == "Bob,Ann,6.0\nCy,Ann,4.0\nEve,Dee,1.0\n"
+    finally:
+        stopLocalWorkers(workers)
+        dropper.close()
+
+    # With every worker gone the shards are settled in-process
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assert settleDistributed(payloads, [address for _, address in workers],
+                                 shardPeople=64, timeout=1) == expected
+    assert any("every worker failed" in str(warning.message) for warning in caught)
+
+    # A shard that takes longer than the timeout is kept alive by heartbeats
+    class QuickHeartbeats(splitUp.distributed.WorkerHandler):
+        heartbeatSeconds = 0.01
+    units = [rng.randint(1, 10**6) for _ in range(100000)]
+    units.append(-sum(units))
+    bigPayload = [(list(range(len(units))), array('q', units))]
+    with splitUp.WorkerServer(("127.0.0.1", 0), QuickHeartbeats) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            settled = settleDistributed(bigPayload, [server.server_address], timeout=0.05,
+                                        localFallback=False)
+        server.shutdown()
+    assert [list(map(list, columns)) for columns in settled] == \
+        [list(map(list, columns)) for columns in settlePayloads(bigPayload, maxWorkers=1)]
+    print("✓ PASS")
+
+def test_csv_export_errors():
+    """Test Case 30: A CSV export cut short by bad input says so"""
+    print("Test Case 30: CSV Export Errors")
+    body = io.BytesIO(b'{"transactions": [{"creditor": "Ann", "debtor": "Bob", "amount": 5},'
+                      b' {"creditor": "Bob", "debtor": oops}]}')
+    csvText = b"".join(splitUp.iterCsvChunks(splitUp.iterJsonArray(body, 'transactions'),
+                                             chunkRows=1)).decode()
+    lines = csvText.splitlines()
+    assert lines[0] == "Ann,Bob,5", "Rows before the error are still sent"
+    assert len(lines) == 2 and lines[1].startswith(splitUp.EXPORT_ERROR_MARKER + ","), \
+        "The export should end with an error marker"
+
+    # Items that aren't objects end the export the same way
+    items = [{"creditor": "Ann", "debtor": "Bob", "amount": 5}, 1, [2]]
+    lines = b"".join(splitUp.iterCsvChunks(iter(items), chunkRows=1)).decode().splitlines()
+    assert lines[0] == "Ann,Bob,5" and len(lines) == 2 and \
+        lines[1].startswith(splitUp.EXPORT_ERROR_MARKER + ",")
+    print("✓ PASS")
+
+def test_result_store():
+    """Test Case 31: Results spilled to disk outlive the result cache"""
+    print("Test Case 31: Result Store")
+    store = ResultStore(tempfile.mkdtemp(), maxBytes=250)
+    store.put("f2-aa", {"rows": list(range(20))})
+    store.put("f2-aa", "ignored, already stored")
+    assert store.get("f2-aa") == {"rows": list(range(20))}
+    assert store.get("f2-bb") is None and store.get("../f2-aa") is None
+
+    # Over the disk budget the least recently used result goes first
+    store.put("f2-bb", "x" * 100)
+    store.get("f2-aa")
+    store.put("f2-cc", "y" * 100)
+    assert store.get("f2-bb") is None and store.get("f2-aa") is not None and len(store) == 2
+    try:
+        store.put("../escape", 1)
+        assert False, "Only digests become file names"
+    except ValueError:
+        pass
+
+    # A store opened on the same directory (a restart, or another worker
+    # process) sees what is already there and what is stored later
+    directory = tempfile.mkdtemp()
+    first = ResultStore(directory)
+    first.put("f1-aa", "kept")
+    second = ResultStore(directory)
+    assert len(second) == 1 and second.get("f1-aa") == "kept"
+    first.put("f1-bb", "later")
+    assert second.get("f1-bb") == "later" and len(second) == 2
+    print("✓ PASS")
+
+def test_route_errors():
+    """Test Case 32: Bad request bodies get a 400, not a 500"""
+    print("Test Case 32: Route Error Handling")
+    try:
+        import app as webApp
+    except ImportError:
+        print("Flask not installed, routes skipped")
+        print("✓ PASS")
+        return
+    client = webApp.app.test_client()
+
+    # /api/settle: bad bytes, corrupt gzip and non-finite amounts
+    gzipped = {'Content-Encoding': 'gzip'}
+    for body, headers in ((b"\xff\xfe,Bob,10\n", {}), (b"not gzip", gzipped),
+                          (gzip.compress(b"Alice,Bob,10\n" * 100)[:30], gzipped),
+                          (b"Alice,Bob,1e400\n", {}), (b"Alice,Bob,nan\n", {})):
+        response = client.post('/api/settle', data=body, headers=headers)
+        assert response.status_code == 400, (body, response.status_code)
+        assert 'error' in response.get_json()
+    response = client.post('/api/settle', data=b"\xff\n",
+                           content_type='application/x-ndjson')
+    assert response.status_code == 400
+    assert client.post('/api/settle', data=b"Alice,Bob,10\n").status_code == 200
+
+    # /export_csv
+    for body in (b"{x", b"\xff", b'{"transactions": []}', b'{"transactions": [1, 2, 3]}'):
+        response = client.post('/export_csv', data=body, content_type='application/json')
+        assert response.status_code == 400, (body, response.status_code)
+    # Past the buffered head the status is sent, so the CSV ends with a marker
+    late = [{'creditor': 'Alice', 'debtor': 'Bob', 'amount': 1}] * splitUp.EXPORT_CHUNK_ROWS + [1]
+    response = client.post('/export_csv?gzip=0', json={'transactions': late})
+    assert response.status_code == 200
+    assert response.data.decode().splitlines()[-1].startswith(splitUp.EXPORT_ERROR_MARKER + ",")
+
+    # /session/*: malformed transactions and bodies
+    good = {'creditor': 'Alice', 'debtor': 'Bob', 'amount': 5}
+    assert client.post('/session', json={'transactions': [{'creditor': 'Alice'}]}).status_code == 400
+    assert client.post('/session', json=[1]).status_code == 400
+    response = client.post('/session', json={'transactions': [good]})
+    assert response.status_code == 201
+    path = '/session/{0}/transactions'.format(response.get_json()['session_id'])
+    for body in ({'transactions': [{'creditor': 'Alice'}]}, {'transactions': [1]}, [1],
+                 {'transactions': [dict(good, amount='inf')]}):
+        assert client.post(path, json=body).status_code == 400, body
+    assert client.post(path, data=b"{x", content_type='application/json').status_code == 400
+    assert client.delete(path, json={'transactions': [dict(good, amount=7)]}).status_code == 400
+    assert client.post('/session/unknown/transactions', json={'transactions': []}).status_code == 404
+    assert client.get('/session/unknown').status_code == 404
+
+    # /results/<id>/*
+    assert client.post('/process_manual', json={'transactions': [good]}).status_code == 200
+    resultId = transactionDigest([("Alice", "Bob", 5.0)])
+    assert client.get(f'/results/{resultId}/rows/simplified').get_json()['total'] == 1
+    assert client.get(f'/results/{resultId}/rows/unknown').status_code == 404
+    assert client.get(f'/results/{resultId}/original.csv').data == b"Alice,Bob,5.0\r\n"
+    for suffix in ('rows/original', 'network', 'original.csv'):
+        assert client.get(f'/results/f1-unknown/{suffix}').status_code == 404
+    print("✓ PASS")
+
 def run_all_tests():
     """Run all edge case tests"""
     print("=== Edge Case Testing ===\n")
@@ -125,6 +1040,58 @@ def run_all_tests():
     test_large_decimals()
     print()
     test_group_isolation()
+    print()
+    test_streaming_upload()
+    print()
+    test_ledger()
+    print()
+    test_cached_balance()
+    print()
+    test_long_chain_grouping()
+    print()
+    test_balance_settlement_engines()
+    print()
+    test_parallel_settlement()
+    print()
+    test_exact_cents_mode()
+    print()
+    test_ledger_session()
+    print()
+    test_result_cache()
+    print()
+    test_benchmark_suite()
+    print()
+    test_stage_instrumentation()
+    print()
+    test_fast_csv_parser()
+    print()
+    test_mapped_parallel_ingest()
+    print()
+    test_pair_aggregation()
+    print()
+    test_optimal_settlement()
+    print()
+    test_job_queue()
+    print()
+    test_settlement_columns()
+    print()
+    test_ledger_store()
+    print()
+    test_batch_cli()
+    print()
+    test_currency_conversion()
+    print()
+    test_lazy_package_import()
+    print()
+    test_ledger_snapshot()
+    print()
+    test_distributed_settlement()
+    print()
+    test_csv_export_errors()
+    print()
+    test_result_store()
+    print()
+    test_route_errors()
     
     print("\n=== All Edge Cases Passed! ===")
 